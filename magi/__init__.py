@@ -0,0 +1,15 @@
+"""MAGI SYSTEM - 複数の人格による意思決定支援
+
+Streamlitに依存しないコアライブラリ。UIはmagi_streamlit.py、CLIはmagi.cli。
+"""
+from .engine import analyze_joint, analyze_proposal, deliberate, tally_votes
+from .personas import MAGI_PERSONAS, MAGI_TYPES
+
+__all__ = [
+    "MAGI_PERSONAS",
+    "MAGI_TYPES",
+    "analyze_joint",
+    "analyze_proposal",
+    "deliberate",
+    "tally_votes",
+]
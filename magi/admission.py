@@ -0,0 +1,140 @@
+"""アドミッション制御（利用者ごとの公平なキュー・優先度・日次枠が足りない場合の負荷制限）
+
+待機中のジョブは到着順ではなく、利用者ごとの直近の利用実績を優先度の重みで割った
+仮想終了時刻の順に実行する（重み付き公平キューイング）。たくさん投入した利用者が
+他の利用者を待たせることはなく、対話の審議（interactive）はバッチより先に実行される。
+日次枠の残りが少なくなると、バッチは枠が戻るまで投入せず（defer）、
+残りで審議できない対話の審議はキャッシュの判定だけで応答する（shed）。
+"""
+import json
+import time
+
+from .config import BATCH_RESERVE, FAIR_WINDOW, KEY_COOLDOWN_SECONDS, PRIORITY_WEIGHTS
+from .keys import get_api_keys, get_key_bucket, get_key_pool_status
+from .models import get_model_chain
+from .personas import MAGI_TYPES
+from .ratelimit import get_day_releases, get_model_limits
+from .state import connect_state_db
+
+WEIGHTS = json.loads(PRIORITY_WEIGHTS)
+DEFAULT_PRIORITY = "interactive"
+
+# 完了したジョブがまだない場合の、1件あたりの所要時間の見込み（秒）
+DEFAULT_JOB_SECONDS = 10.0
+
+
+def priority_weight(priority):
+    """優先度の重み（未設定の優先度は1）"""
+    return float(WEIGHTS.get(priority, 1))
+
+
+def requests_per_job(mode):
+    """審議1回で使うリクエスト数の見込み（比較審議は分割審議と同じく人格ごとに1回）"""
+    return 1 if mode == "joint" else len(MAGI_TYPES)
+
+
+def get_capacity():
+    """全モデル・全キーの残り枠 {"minute", "day", "rpm", "rpd"}（rpm/rpdは枠の合計）"""
+    capacity = {"minute": 0, "day": 0, "rpm": 0, "rpd": 0}
+    for model_name in get_model_chain():
+        rpm, rpd = get_model_limits(model_name)
+        for key in get_key_pool_status(model_name):
+            capacity["rpm"] += rpm
+            capacity["rpd"] += rpd
+            # 長いクールダウン（日次枠切れ・無効なキー）のキーは残り枠に数えない
+            if key["cooldown"] > KEY_COOLDOWN_SECONDS:
+                continue
+            capacity["minute"] += max(0, rpm - key["minute"])
+            capacity["day"] += max(0, rpd - key["day"])
+    return capacity
+
+
+def seconds_until_capacity(needed):
+    """日次枠の残りがneeded件以上に戻るまでの秒数（0なら今すぐ、戻る見込みがなければNone）
+
+    台帳は直近24時間の窓で数えるため、古い記録が窓から外れた時点で1件ずつ枠が戻る。
+    長いクールダウン中のキーの枠は、クールダウンが明けるまで戻らないものとして数える。
+    """
+    now = time.time()
+    available = 0
+    releases = []
+    conn = connect_state_db()
+    try:
+        for model_name in get_model_chain():
+            rpm, rpd = get_model_limits(model_name)
+            for api_key, key in zip(get_api_keys(), get_key_pool_status(model_name)):
+                used = get_day_releases(get_key_bucket(api_key, model_name), conn)
+                # 枠を超えて記録されている分は、外れても残りが枠を下回るまでは戻らない
+                key_releases = used[max(0, len(used) - rpd):]
+                free = max(0, rpd - len(used))
+                if key["cooldown"] > KEY_COOLDOWN_SECONDS:
+                    until = now + key["cooldown"]
+                    releases += [until] * free + [max(until, t) for t in key_releases]
+                else:
+                    available += free
+                    releases += key_releases
+    finally:
+        conn.close()
+    if available >= needed:
+        return 0.0
+    releases.sort()
+    shortfall = needed - available
+    if shortfall > len(releases):
+        return None
+    return max(0.0, releases[shortfall - 1] - now)
+
+
+def admission_decision(priority, mode, capacity):
+    """ジョブを実行してよいか: "run" / "defer"（枠が戻るまで待機）/ "shed"（キャッシュのみで応答）"""
+    needed = requests_per_job(mode)
+    if priority == "batch":
+        # バッチは対話の審議のための枠（BATCH_RESERVE）を残して、余った枠だけを使う
+        return "run" if capacity["day"] - needed >= BATCH_RESERVE * capacity["rpd"] else "defer"
+    return "run" if capacity["day"] >= needed else "shed"
+
+
+def get_recent_service(conn, now):
+    """利用者ごとの直近FAIR_WINDOW秒に実行を始めたジョブのリクエスト数"""
+    service = {}
+    for user, mode, count in conn.execute(
+        "SELECT user, mode, COUNT(*) FROM jobs WHERE started > ? GROUP BY user, mode", (now - FAIR_WINDOW,)
+    ):
+        service[user] = service.get(user, 0) + requests_per_job(mode) * count
+    return service
+
+
+def fair_order(queued, service):
+    """待機中のジョブを実行する順に並べる
+
+    queuedは {"user", "priority", "mode", "created", ...} の一覧、serviceは利用者ごとの利用実績。
+    各ジョブに (利用実績 + その利用者の先に並んでいるジョブ分 + 自分の分) / 優先度の重み を
+    仮想終了時刻として付け、小さい順（同じなら到着順）にする。
+    """
+    used = dict(service)
+    tagged = []
+    for job in sorted(queued, key=lambda job: job["created"]):
+        used[job["user"]] = used.get(job["user"], 0) + requests_per_job(job["mode"])
+        tagged.append((used[job["user"]] / priority_weight(job["priority"]), job["created"], job))
+    tagged.sort(key=lambda item: item[:2])
+    return [job for _, _, job in tagged]
+
+
+def get_throughput(conn, now):
+    """(直近に動いていたワーカー数, 1件あたりの平均所要時間)"""
+    workers = conn.execute(
+        "SELECT COUNT(DISTINCT worker) FROM jobs WHERE heartbeat > ?", (now - FAIR_WINDOW,)
+    ).fetchone()[0]
+    average = conn.execute(
+        "SELECT AVG(finished - started) FROM (SELECT finished, started FROM jobs"
+        " WHERE status = 'done' ORDER BY finished DESC LIMIT 20)"
+    ).fetchone()[0]
+    return max(1, workers), average or DEFAULT_JOB_SECONDS
+
+
+def estimate_wait(jobs_ahead, requests_ahead, workers, job_seconds, capacity):
+    """実行開始までの待ち時間の見込み（秒）: ワーカーの処理速度とRPM枠のうち遅い方"""
+    by_workers = jobs_ahead / workers * job_seconds
+    # 今の1分間に残っている枠を超える分は、RPMの速さでしか進まない
+    by_rate = max(0, requests_ahead - capacity["minute"]) * 60 / max(1, capacity["rpm"])
+    return max(by_workers, by_rate)
+
@@ -0,0 +1,218 @@
+"""生成バックエンド（Gemini API と、ベンチマーク用のローカルな疑似バックエンド）
+
+審議エンジンはバックエンドの list_models / generate_content だけを使う。
+使うバックエンドは MAGI_BACKEND（gemini / fake）で選び、set_backend で差し替えられる。
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from .config import BACKEND, FAKE_BACKEND_OPTIONS
+
+_lock = threading.Lock()
+_clients = {}
+_models = {}
+_backend = None
+
+
+def get_generative_client(api_key):
+    """キーごとのAPIクライアント（genai.configureのグローバル設定を使わない）"""
+    with _lock:
+        client = _clients.get(api_key)
+        if client is None:
+            from google.ai import generativelanguage as glm
+
+            client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            _clients[api_key] = client
+        return client
+
+
+def get_generative_model(model_name, api_key, system_instruction=None):
+    """指定したキー・システム指示で呼び出すGenerativeModel（作成済みなら再利用）"""
+    with _lock:
+        model = _models.get((model_name, api_key, system_instruction))
+    if model is not None:
+        return model
+
+    import google.generativeai as genai
+
+    model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+    model._client = get_generative_client(api_key)
+    with _lock:
+        return _models.setdefault((model_name, api_key, system_instruction), model)
+
+
+class GeminiBackend:
+    """Gemini API（google.generativeaiは呼び出し時に読み込む）"""
+
+    name = "gemini"
+
+    def list_models(self, api_key):
+        from google.ai import generativelanguage as glm
+
+        client = glm.ModelServiceClient(client_options={"api_key": api_key})
+        return [
+            m.name for m in client.list_models()
+            if 'generateContent' in m.supported_generation_methods
+        ]
+
+    def generate_content(self, model_name, api_key, prompt, generation_config, safety_settings, stream=False,
+                         system_instruction=None, timeout=None):
+        model = get_generative_model(model_name, api_key, system_instruction)
+        return model.generate_content(
+            prompt,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+            stream=stream,
+            request_options={"timeout": max(1, timeout)} if timeout is not None else None
+        )
+
+
+class FakeResponse:
+    """generate_contentの応答と同じ形（.text、チャンクの反復、usage_metadata）"""
+
+    def __init__(self, text, chunks, prompt_tokens, chunk_delay=0.0):
+        self.text = text
+        self._chunks = chunks
+        self._chunk_delay = chunk_delay
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=max(1, len(text) // 2),
+        )
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            time.sleep(self._chunk_delay)
+            yield SimpleNamespace(text=chunk)
+
+
+class FakeBackend:
+    """ネットワークを使わない疑似バックエンド（負荷試験・ベンチマーク用）
+
+    latency_median / latency_sigma   通信時間の対数正規分布（秒）
+    burst_rate / burst_length        429を返し続けるバーストの発生率と長さ（呼び出し数）
+    unavailable_rate                 503（一時的な障害）を返す割合
+    malformed_rate                   JSONでない応答を返す割合
+    truncated_rate                   出力上限で途切れた応答を返す割合
+    approve_rate                     承認の割合（提案と人格から決定的に決める）
+    """
+
+    name = "fake"
+
+    def __init__(self, latency_median=0.3, latency_sigma=0.5, burst_rate=0.0, burst_length=5,
+                 malformed_rate=0.0, truncated_rate=0.0, approve_rate=0.6, models=None, seed=0,
+                 unavailable_rate=0.0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.burst_rate = burst_rate
+        self.burst_length = burst_length
+        self.unavailable_rate = unavailable_rate
+        self.malformed_rate = malformed_rate
+        self.truncated_rate = truncated_rate
+        self.approve_rate = approve_rate
+        self.models = models or ["models/magi-fake"]
+        self._random = random.Random(seed)
+        self._burst_remaining = 0
+        self._lock = threading.Lock()
+
+    def list_models(self, api_key):
+        return list(self.models)
+
+    def _roll(self):
+        """1回分の乱数（遅延・429・壊れた応答）をまとめて引く"""
+        with self._lock:
+            if self._burst_remaining == 0 and self._random.random() < self.burst_rate:
+                self._burst_remaining = self.burst_length
+            in_burst = self._burst_remaining > 0
+            if in_burst:
+                self._burst_remaining -= 1
+            return {
+                "latency": self._random.lognormvariate(0, self.latency_sigma) * self.latency_median,
+                "quota": in_burst,
+                "unavailable": self._random.random() < self.unavailable_rate,
+                "malformed": self._random.random() < self.malformed_rate,
+                "truncated": self._random.random() < self.truncated_rate,
+                "cut": self._random.random(),
+            }
+
+    def _verdict(self, prompt, name):
+        seed = int(hashlib.sha256(f"{name}\n{prompt}".encode("utf-8")).hexdigest()[:8], 16)
+        decision = (seed % 1000) / 1000 < self.approve_rate
+        return {
+            "decision": decision,
+            "reason": f"疑似応答（{name}）: {'利点が上回る' if decision else 'リスクが上回る'}と判断する。",
+            "score": 6 + seed % 5 if decision else 1 + seed % 5,
+        }
+
+    def generate_content(self, model_name, api_key, prompt, generation_config, safety_settings, stream=False,
+                         system_instruction=None, timeout=None):
+        roll = self._roll()
+        content = prompt
+        prompt = f"{system_instruction or ''}\n{prompt}"
+        if roll["quota"]:
+            time.sleep(min(roll["latency"], 0.05))
+            raise Exception("429 RESOURCE_EXHAUSTED: Quota exceeded for GenerateRequestsPerMinutePerProjectPerModel. "
+                            "Please retry in 1.5s")
+        if roll["unavailable"]:
+            time.sleep(min(roll["latency"], 0.05))
+            raise Exception("503 UNAVAILABLE: The service is currently unavailable")
+        if timeout is not None and roll["latency"] > timeout:
+            time.sleep(max(0, timeout))
+            raise TimeoutError("504 DEADLINE_EXCEEDED")
+
+        # スキーマの項目がdecisionでもrankingsでもなければ、人格ごとの判定をまとめた共同審議の応答にする
+        properties = (generation_config or {}).get("response_schema", {}).get("properties", {})
+        if not properties:
+            # スキーマのない呼び出し（要約など）は入力の先頭を返す
+            text = f"要約: {content[:200]}"
+        elif "rankings" in properties:
+            # 比較モードは選択肢ごとの判定をスコアの高い順に並べる
+            ids = properties["rankings"]["items"]["properties"]["option"]["enum"]
+            verdicts = {option_id: self._verdict(f"{prompt}\n{option_id}", "option") for option_id in ids}
+            ordered = sorted(ids, key=lambda option_id: -verdicts[option_id]["score"])
+            text = json.dumps({"rankings": [
+                dict(verdicts[option_id], option=option_id, rank=rank) for rank, option_id in enumerate(ordered, 1)
+            ]}, ensure_ascii=False)
+        elif "decision" in properties:
+            text = json.dumps(self._verdict(prompt, "single"), ensure_ascii=False)
+        else:
+            text = json.dumps({name: self._verdict(prompt, name) for name in properties}, ensure_ascii=False)
+        if roll["malformed"]:
+            text = f"判定: {'承認' if 'true' in text else '否決'}（形式外の応答）"
+        elif roll["truncated"]:
+            text = text[:max(1, int(len(text) * roll["cut"]))]
+
+        prompt_tokens = max(1, len(prompt) // 2)
+        if not stream:
+            time.sleep(roll["latency"])
+            return FakeResponse(text, [text], prompt_tokens)
+        chunks = [text[i:i + 16] for i in range(0, len(text), 16)]
+        return FakeResponse(text, chunks, prompt_tokens, roll["latency"] / len(chunks))
+
+
+def create_backend(name, options=None):
+    """名前からバックエンドを作成"""
+    if name == "gemini":
+        return GeminiBackend()
+    if name == "fake":
+        return FakeBackend(**(options or {}))
+    raise ValueError(f"unknown backend: {name}")
+
+
+def get_backend():
+    """現在のバックエンド（初回はMAGI_BACKENDから作成）"""
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = create_backend(BACKEND, json.loads(FAKE_BACKEND_OPTIONS) if BACKEND == "fake" else None)
+        return _backend
+
+
+def set_backend(backend):
+    """バックエンドを差し替える（list_models / generate_contentを持つオブジェクト）"""
+    global _backend
+    with _lock:
+        _backend = backend
@@ -0,0 +1,234 @@
+"""バッチ審議
+
+CSV/JSONLの提案をバッチの優先度でジョブキューに入れ、完了した判定から順にJSONLへ書き出す。
+出力ファイル自体がチェックポイントになっており、429やクラッシュで中断しても
+同じ出力先を指定して再実行すれば、完了済みの提案は再審議せずに続きから再開する。
+
+    magi batch proposals.csv -o verdicts.jsonl --mode joint
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+from .admission import admission_decision, get_capacity
+from .cache import normalize_proposal
+from .config import JOB_POLL_INTERVAL
+from .jobs import cancel_job, get_job, submit_job, work
+
+# 提案本文として扱う列名（先頭から順に探す）
+PROPOSAL_FIELDS = ["proposal", "text", "content", "提案", "提案内容"]
+
+# これらで始まる理由は枠切れのため、バッチを止めて後で再開する
+QUOTA_ERROR_PREFIXES = ("ERROR: 429", "ERROR: RATE LIMIT")
+
+
+class QuotaExhausted(Exception):
+    """APIの枠切れでバッチを中断した場合の例外"""
+
+
+def proposal_id(proposal_text):
+    """IDのない提案に、内容から安定したIDを割り当てる"""
+    return hashlib.sha256(normalize_proposal(proposal_text).encode("utf-8")).hexdigest()[:16]
+
+
+def _pick_proposal(row):
+    for field in PROPOSAL_FIELDS:
+        if row.get(field):
+            return str(row[field])
+    # 該当する列がなければ最初の値を使う
+    for value in row.values():
+        if value:
+            return str(value)
+    return ""
+
+
+def read_proposals(stream, fmt):
+    """CSV/JSONLから(id, 提案本文)を順に読み出す"""
+    if fmt == "csv":
+        rows = csv.DictReader(stream)
+    elif fmt == "jsonl":
+        rows = (json.loads(line) for line in stream if line.strip())
+    else:
+        raise ValueError(f"unsupported format: {fmt}")
+
+    for row in rows:
+        if isinstance(row, str):
+            row = {"proposal": row}
+        text = _pick_proposal(row).strip()
+        if not text:
+            continue
+        yield str(row.get("id") or proposal_id(text)), text
+
+
+def detect_format(filename):
+    """拡張子から入力形式を判定"""
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+
+def read_uploaded(uploaded_file):
+    """Streamlitのアップロードファイルから提案を読み込む"""
+    text = uploaded_file.getvalue().decode("utf-8-sig")
+    return list(read_proposals(io.StringIO(text, newline=""), detect_format(uploaded_file.name)))
+
+
+def compact_output(output_path):
+    """出力を提案ごとに1件（エラーなしで完了した最後の判定）にまとめ、完了済みのIDを返す
+
+    エラーの判定は再開時に審議し直すため出力から除く。これにより再開後も同じIDの
+    レコードが重複しない。
+    """
+    records = {}
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中でクラッシュした最終行は無視
+                continue
+            if record.get("status") == "ok":
+                records[record["id"]] = record
+    temp_path = output_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as out:
+        for record in records.values():
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temp_path, output_path)
+    return set(records)
+
+
+def describe_record(record, total_personas):
+    """進捗表示用の1行（エラーのあった人格があれば理由を添える）"""
+    line = f"{record['id']} {record['final_decision'].upper()} ({record['approvals']}/{total_personas})"
+    if record["status"] != "ok":
+        errors = [str(r.get("reason", "")) for r in record["results"].values() if str(r.get("reason", "")).startswith("ERROR:")]
+        line += f" WITH ERRORS ({len(errors)}): {errors[0][:60]}"
+    return line
+
+
+def is_quota_error(result):
+    return str(result.get("reason", "")).startswith(QUOTA_ERROR_PREFIXES)
+
+
+def _job_record(pid, job):
+    """終わったジョブから出力用のレコードを作る"""
+    results = job["results"]
+    errors = [r for r in results.values() if str(r.get("reason", "")).startswith("ERROR:")]
+    return {
+        "id": pid,
+        "proposal": job["proposal"],
+        "mode": job["mode"],
+        "status": "error" if errors else "ok",
+        "final_decision": job["final_decision"],
+        "approvals": job["approvals"],
+        "results": results,
+        "elapsed": round(job["finished"] - job["started"], 3),
+    }
+
+
+def submit_batch(proposals, output_path, mode="separate", short_circuit=None, user=""):
+    """出力にまだない提案をバッチの優先度でジョブキューに入れ、{提案ID: ジョブID}を返す
+
+    実行する順番と日次枠の扱いは1件ずつの審議と同じキューが決める（対話の審議が先に実行され、
+    日次枠の残りが対話用に残す分（MAGI_BATCH_RESERVE）を下回ると枠が戻るまで待つ）。
+    """
+    completed = compact_output(output_path)
+    jobs = {}
+    for pid, text in proposals:
+        if pid not in completed and pid not in jobs:
+            jobs[pid] = submit_job(text, mode, short_circuit, user=user, priority="batch")
+    return jobs
+
+
+def collect_batch(jobs, output_path):
+    """終わったジョブの判定を出力JSONLに追記し、終わったジョブをjobsから除く
+
+    戻り値は (書き出したレコードの一覧, 書き出さなかった提案の {ID: 理由})。
+    理由は "quota"（枠切れの判定）/ "failed" / "cancelled"。書き出さなかった提案は
+    同じ出力先で再実行したときに審議し直す。
+    """
+    records = []
+    skipped = {}
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "a", encoding="utf-8") as out:
+        for pid, job_id in list(jobs.items()):
+            job = get_job(job_id)
+            status = job["status"] if job else "cancelled"
+            if status in ("queued", "running"):
+                continue
+            del jobs[pid]
+            if status != "done":
+                skipped[pid] = status
+                continue
+            if any(is_quota_error(r) for r in job["results"].values()):
+                # 枠切れの判定はチェックポイントに残さない（再開時に審議し直す）
+                skipped[pid] = "quota"
+                continue
+            record = _job_record(pid, job)
+            # 1件ごとにflushしてチェックポイントにする
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+            records.append(record)
+    return records, skipped
+
+
+def _batch_deferred(jobs, mode):
+    """日次枠の残りが少なく、待機中のバッチが枠の戻りを待つしかない状態か"""
+    if admission_decision("batch", mode, get_capacity()) != "defer":
+        return False
+    return not any((get_job(job_id) or {}).get("status") == "running" for job_id in jobs.values())
+
+
+def run_batch(proposals, output_path, mode="separate", workers=1, on_record=None, short_circuit=None, user=""):
+    """提案をバッチの優先度でジョブキューに入れ、プロセス内のワーカーで審議して完了順に出力JSONLに追記する
+
+    short_circuit="cancel"にすると、2人の判定が一致した提案では3人目を呼ばない。
+
+    枠切れの判定が返った場合や、日次枠の残りが対話用に残す分を下回って実行できない場合は、
+    待機中のジョブを取り消し、実行中のジョブの完了を待ってQuotaExhaustedを送出する。
+    書き出したレコード数を返す。
+    """
+    jobs = submit_batch(proposals, output_path, mode, short_circuit, user)
+    total = len(jobs)
+    written = 0
+    quota_hit = False
+
+    stop_event = threading.Event()
+    threads = [
+        threading.Thread(target=work, kwargs={"stop_event": stop_event}, name=f"magi-batch-{i}", daemon=True)
+        for i in range(max(1, workers))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while jobs:
+            records, skipped = collect_batch(jobs, output_path)
+            for record in records:
+                written += 1
+                if on_record:
+                    on_record(record, written, total)
+            if not quota_hit and ("quota" in skipped.values() or (jobs and _batch_deferred(jobs, mode))):
+                quota_hit = True
+            if quota_hit:
+                for job_id in jobs.values():
+                    cancel_job(job_id)
+            if jobs:
+                time.sleep(JOB_POLL_INTERVAL)
+    finally:
+        # 中断された場合も、まだ始まっていないジョブを残さない
+        for job_id in jobs.values():
+            cancel_job(job_id)
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+    if quota_hit:
+        raise QuotaExhausted("API quota exhausted; re-run with the same output to resume")
+    return written
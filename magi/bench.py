@@ -0,0 +1,136 @@
+"""オフラインのベンチマーク（疑似バックエンドで審議パイプラインの性能を測る）
+
+同時審議数とキャッシュ設定の組み合わせごとに、設定を環境変数で渡した子プロセスを起動し、
+空の状態DBと疑似バックエンドで審議を流して、審議数/秒・レイテンシの分位点・
+審議あたりのAPI呼び出し数・キャッシュヒット率を集計する。
+実際のAPIやネットワークは使わないため、CIなどで性能の劣化を検出できる。
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# キャッシュ設定ごとの環境変数
+CACHE_SETTINGS = {
+    "off": {"MAGI_CACHE_TTL": "0", "MAGI_SIMILARITY_THRESHOLD": "1"},
+    "exact": {"MAGI_SIMILARITY_THRESHOLD": "1"},
+    "similar": {"MAGI_SIMILARITY_THRESHOLD": "0.8"},
+}
+
+FAKE_MODEL = "magi-fake"
+
+_SUBJECTS = ["全社へのAIツール導入", "新規事業への投資", "本社オフィスの移転", "週休3日制の試験導入",
+             "基幹システムのクラウド移行", "海外拠点の新設", "社内公用語の英語化", "副業の全面解禁"]
+_SCOPES = ["来期から段階的に", "今年度中に全部門で", "まず一部の部署で半年間", "予算を倍にして"]
+_GOALS = ["採用競争力を高める", "固定費を削減する", "意思決定を速める", "新しい顧客層を開拓する"]
+
+
+def make_proposals(count, repeat_rate=0.3, seed=0):
+    """ベンチマーク用の提案を作る（repeat_rateの割合で既出の提案や言い換えを混ぜる）"""
+    rng = random.Random(seed)
+    proposals = []
+    for _ in range(count):
+        if proposals and rng.random() < repeat_rate:
+            original = rng.choice(proposals)
+            # 半分は完全一致、残りは末尾だけ違う言い換え
+            proposals.append(original if rng.random() < 0.5 else original.replace("べきか。", "べきでしょうか。"))
+        else:
+            subject, scope, goal = rng.choice(_SUBJECTS), rng.choice(_SCOPES), rng.choice(_GOALS)
+            proposals.append(f"{goal}ため、{subject}を{scope}実施するべきか。")
+    return proposals
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_scenario(proposals, concurrency, mode="separate", short_circuit=None):
+    """現在のプロセスの設定で審議を流して計測する（子プロセスで実行される）"""
+    from .engine import deliberate
+    from .metrics import get_counter_total
+
+    def timed(proposal_text):
+        started = time.perf_counter()
+        results = deliberate(proposal_text, mode=mode, short_circuit=short_circuit)
+        failed = any(str(r.get("reason", "")).startswith("ERROR:") for r in results.values())
+        return time.perf_counter() - started, failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, proposals))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in outcomes]
+    calls = get_counter_total("magi_calls_total")
+    cached = get_counter_total("magi_calls_total", cache="exact") + get_counter_total("magi_calls_total", cache="neighbor")
+    api_calls = get_counter_total("magi_calls_total", cache="miss") + get_counter_total("magi_retries_total")
+    return {
+        "deliberations": len(proposals),
+        "elapsed_s": round(elapsed, 3),
+        "deliberations_per_s": round(len(proposals) / elapsed, 3) if elapsed else 0.0,
+        "p50_s": round(_percentile(latencies, 0.5), 3),
+        "p95_s": round(_percentile(latencies, 0.95), 3),
+        "p99_s": round(_percentile(latencies, 0.99), 3),
+        "api_calls_per_deliberation": round(api_calls / len(proposals), 3) if proposals else 0.0,
+        "cache_hit_rate": round(cached / calls, 3) if calls else 0.0,
+        "failed_deliberations": sum(failed for _, failed in outcomes),
+    }
+
+
+def scenario_env(cache, backend_options, keys, rpm, state_dir):
+    """子プロセスの環境変数（疑似バックエンド・空の状態DB・疑似キー）"""
+    env = dict(os.environ)
+    env.pop("GOOGLE_API_KEY", None)
+    env.update({
+        "MAGI_BACKEND": "fake",
+        "MAGI_FAKE_BACKEND": json.dumps(backend_options),
+        "MAGI_STATE_DIR": state_dir,
+        "GEMINI_API_KEY": ",".join(f"fake-key-{i}" for i in range(keys)),
+        "MAGI_MODEL_LIMITS": json.dumps({FAKE_MODEL: [rpm, rpm * 1440]}),
+        "MAGI_KEY_COOLDOWN": "1",
+        "MAGI_METRICS_PORT": "0",
+    })
+    env.update(CACHE_SETTINGS[cache])
+    return env
+
+
+def run_bench(proposals, concurrency_levels, caches, mode="separate", short_circuit=None,
+              backend_options=None, keys=4, rpm=1000):
+    """同時審議数×キャッシュ設定ごとに子プロセスで計測し、結果の一覧を返す"""
+    rows = []
+    for cache in caches:
+        for concurrency in concurrency_levels:
+            with tempfile.TemporaryDirectory(prefix="magi-bench-") as state_dir:
+                spec = {"proposals": proposals, "concurrency": concurrency, "mode": mode, "short_circuit": short_circuit}
+                completed = subprocess.run(
+                    [sys.executable, "-m", "magi.bench"],
+                    input=json.dumps(spec), capture_output=True, text=True, check=True,
+                    env=scenario_env(cache, backend_options or {}, keys, rpm, state_dir),
+                )
+            row = {"cache": cache, "concurrency": concurrency, "mode": mode}
+            row.update(json.loads(completed.stdout))
+            rows.append(row)
+    return rows
+
+
+def format_table(rows):
+    """結果を表形式の文字列にする"""
+    columns = ["cache", "concurrency", "deliberations_per_s", "p50_s", "p95_s", "p99_s",
+               "api_calls_per_deliberation", "cache_hit_rate", "failed_deliberations"]
+    widths = [max(len(c), *(len(str(row[c])) for row in rows)) for c in columns]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    for row in rows:
+        lines.append("  ".join(str(row[c]).ljust(w) for c, w in zip(columns, widths)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    spec = json.load(sys.stdin)
+    print(json.dumps(run_scenario(spec["proposals"], spec["concurrency"], spec["mode"], spec["short_circuit"])))
@@ -0,0 +1,106 @@
+"""判定キャッシュ（全プロセス共有、TTL＋LRUで削除）"""
+import hashlib
+import json
+import time
+import unicodedata
+
+from .config import CACHE_MAX_ENTRIES, CACHE_TTL
+from .personas import PROMPT_VERSION, prompt_digest
+from .state import connect_state_db
+
+
+def normalize_proposal(proposal_text):
+    """提案文を正規化（全角/半角の統一と空白の圧縮）"""
+    return " ".join(unicodedata.normalize("NFKC", proposal_text).split())
+
+
+def get_cache_key(proposal_text, magi_type, model_name, generation_config):
+    """キャッシュキーを生成（プロセスをまたいで安定したダイジェスト）"""
+    payload = json.dumps({
+        "proposal": normalize_proposal(proposal_text),
+        "magi": magi_type,
+        "model": model_name,
+        "prompt_version": PROMPT_VERSION,
+        "prompt": prompt_digest(magi_type),
+        "generation_config": generation_config,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _count_cache_stat(conn, name):
+    conn.execute(
+        "INSERT INTO cache_stats (name, value) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+        (name,)
+    )
+
+
+def count_cache_stat(name):
+    """キャッシュの統計カウンタを1増やす"""
+    conn = connect_state_db()
+    try:
+        _count_cache_stat(conn, name)
+    finally:
+        conn.close()
+
+
+def cache_get(cache_key, count_stats=True):
+    """キャッシュから取得（期限切れ・未登録ならNone）
+
+    count_stats=Falseの場合はヒット/ミスを数えない（呼び出し側で数える）。
+    """
+    now = time.time()
+    conn = connect_state_db()
+    try:
+        row = conn.execute(
+            "SELECT value, created FROM verdict_cache WHERE key = ?", (cache_key,)
+        ).fetchone()
+        if row and now - row[1] < CACHE_TTL:
+            conn.execute("UPDATE verdict_cache SET accessed = ? WHERE key = ?", (now, cache_key))
+            if count_stats:
+                _count_cache_stat(conn, "hits")
+            return json.loads(row[0])
+        if row:
+            conn.execute("DELETE FROM verdict_cache WHERE key = ?", (cache_key,))
+        if count_stats:
+            _count_cache_stat(conn, "misses")
+        return None
+    finally:
+        conn.close()
+
+
+def cache_put(cache_key, value):
+    """キャッシュに保存し、期限切れと上限超過分を削除"""
+    now = time.time()
+    conn = connect_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT OR REPLACE INTO verdict_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+            (cache_key, json.dumps(value, ensure_ascii=False), now, now)
+        )
+        conn.execute("DELETE FROM verdict_cache WHERE created <= ?", (now - CACHE_TTL,))
+        conn.execute(
+            "DELETE FROM verdict_cache WHERE key IN ("
+            "SELECT key FROM verdict_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (CACHE_MAX_ENTRIES,)
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def get_cache_stats():
+    """キャッシュのヒット数・ミス数・件数を取得"""
+    conn = connect_state_db()
+    try:
+        stats = dict(conn.execute("SELECT name, value FROM cache_stats").fetchall())
+        entries = conn.execute("SELECT COUNT(*) FROM verdict_cache").fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        "hits": stats.get("hits", 0),
+        "neighbor_hits": stats.get("neighbor_hits", 0),
+        "misses": stats.get("misses", 0),
+        "entries": entries,
+    }
@@ -0,0 +1,268 @@
+"""magi コマンド
+
+    magi analyze "新プロジェクトに予算を投じるべきか"
+    magi batch proposals.csv -o verdicts.jsonl --mode joint
+    magi models --refresh
+    magi bench --concurrency 1,4,16 --cache off,exact,similar
+    magi serve --port 8000
+    magi history "AIツール" --limit 10
+    magi worker --workers 4
+    magi submit "新プロジェクトに予算を投じるべきか" && magi job <ID>
+    magi compare "来期の予算の使い道" -o "社内カフェ" -o "研修予算の倍増"
+"""
+import argparse
+import getpass
+import json
+import sys
+import time
+
+from .config import METRICS_PORT, PRIORITY_WEIGHTS
+
+
+def cmd_analyze(args):
+    from .engine import deliberate, tally_votes
+
+    proposal_text = args.proposal if args.proposal != "-" else sys.stdin.read()
+    results = deliberate(proposal_text, mode=args.mode, short_circuit=args.short_circuit)
+    final_decision, approvals = tally_votes(results)
+    print(json.dumps({
+        "final_decision": final_decision,
+        "approvals": approvals,
+        "results": results,
+    }, ensure_ascii=False, indent=2))
+    return 0
+
+
+def cmd_compare(args):
+    from .compare import compare
+
+    try:
+        comparison = compare(args.option, question=args.question)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(comparison, ensure_ascii=False, indent=2))
+    return 0 if comparison["winner"] else 1
+
+
+def cmd_batch(args):
+    from .batch import QuotaExhausted, describe_record, detect_format, read_proposals, run_batch
+    from .personas import MAGI_TYPES
+    from .metrics import start_metrics_server
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    fmt = args.format or detect_format(args.input)
+    with open(args.input, encoding="utf-8-sig", newline="") as f:
+        proposals = list(read_proposals(f, fmt))
+
+    errors = []
+
+    def report(record, done, total):
+        if record["status"] != "ok":
+            errors.append(record["id"])
+        print(f"[{done}/{total}] {describe_record(record, len(MAGI_TYPES))}", file=sys.stderr)
+
+    try:
+        written = run_batch(
+            proposals, args.output,
+            mode=args.mode, workers=args.workers, on_record=report, short_circuit=args.short_circuit,
+            user=getpass.getuser()
+        )
+    except QuotaExhausted as e:
+        print(f"STOPPED: {e}", file=sys.stderr)
+        return 2
+    print(f"DONE: {written} verdicts written to {args.output}", file=sys.stderr)
+    if errors:
+        print(f"WARNING: {len(errors)} verdicts have persona errors; re-run with the same output to retry them", file=sys.stderr)
+    return 0
+
+
+def cmd_models(args):
+    from .models import get_discovery_error, get_model_chain, route_model
+
+    chain = get_model_chain(refresh=args.refresh)
+    error = get_discovery_error()
+    if error:
+        print(error, file=sys.stderr)
+    print(json.dumps({"chain": chain, "active": route_model()}, indent=2))
+    return 1 if error else 0
+
+
+def cmd_bench(args):
+    from .bench import format_table, make_proposals, run_bench
+
+    proposals = make_proposals(args.deliberations, repeat_rate=args.repeat_rate, seed=args.seed)
+    backend_options = {
+        "latency_median": args.latency,
+        "burst_rate": args.burst_rate,
+        "unavailable_rate": args.unavailable_rate,
+        "malformed_rate": args.malformed_rate,
+        "truncated_rate": args.truncated_rate,
+        "seed": args.seed,
+    }
+    rows = run_bench(
+        proposals,
+        [int(c) for c in args.concurrency.split(",")],
+        args.cache.split(","),
+        mode=args.mode, short_circuit=args.short_circuit,
+        backend_options=backend_options, keys=args.keys, rpm=args.rpm
+    )
+    print(json.dumps(rows, indent=2) if args.json else format_table(rows))
+
+    # 指定した審議数/秒を下回る組み合わせがあれば失敗（CIでの劣化検出用）
+    slow = [row for row in rows if row["deliberations_per_s"] < args.min_throughput]
+    for row in slow:
+        print(f"SLOW: cache={row['cache']} concurrency={row['concurrency']} "
+              f"{row['deliberations_per_s']}/s < {args.min_throughput}/s", file=sys.stderr)
+    return 1 if slow else 0
+
+
+def cmd_serve(args):
+    from .metrics import start_metrics_server
+    from .server import serve
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    serve(host=args.host, port=args.port)
+    return 0
+
+
+def cmd_history(args):
+    from .history import get_deliberation, search_history
+
+    if args.show is not None:
+        record = get_deliberation(args.show)
+        if record is None:
+            print(f"NOT FOUND: #{args.show}", file=sys.stderr)
+            return 1
+        print(json.dumps(record, ensure_ascii=False, indent=2))
+        return 0
+
+    records, total = search_history(args.query, limit=args.limit, offset=args.offset)
+    for record in records:
+        finished = time.strftime("%Y-%m-%d %H:%M", time.localtime(record["finished"]))
+        print(f"#{record['id']}\t{finished}\t{record['final_decision'].upper()} "
+              f"({record['approvals']}/{len(record['results'])})\t{record['proposal'][:60]}")
+    print(f"{len(records)} of {total} deliberations", file=sys.stderr)
+    return 0
+
+
+def cmd_worker(args):
+    from .jobs import start_workers
+
+    print(f"{start_workers(args.workers)} workers polling the job queue (Ctrl+C to stop)", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        return 0
+
+
+def cmd_submit(args):
+    from .jobs import submit_job
+
+    proposal_text = args.proposal if args.proposal != "-" else sys.stdin.read()
+    print(submit_job(
+        proposal_text, mode=args.mode, short_circuit=args.short_circuit,
+        user=args.user or getpass.getuser(), priority=args.priority
+    ))
+    return 0
+
+
+def cmd_job(args):
+    from .jobs import get_job, get_queue_position
+
+    job = get_job(args.job_id)
+    if job is None:
+        print(f"NOT FOUND: {args.job_id}", file=sys.stderr)
+        return 1
+    job["queue"] = get_queue_position(args.job_id)
+    print(json.dumps(job, ensure_ascii=False, indent=2))
+    return 0 if job["status"] != "failed" else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="magi", description="MAGI SYSTEM decision support")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyze = subparsers.add_parser("analyze", help="deliberate a single proposal")
+    analyze.add_argument("proposal", help="proposal text ('-' to read from stdin)")
+    analyze.add_argument("--mode", choices=["separate", "joint"], default="separate")
+    analyze.add_argument("--short-circuit", choices=["cancel", "advisory"], help="stop once two personas agree")
+    analyze.set_defaults(func=cmd_analyze)
+
+    compare = subparsers.add_parser("compare", help="rank several options in one call per persona")
+    compare.add_argument("question", nargs="?", default="", help="what the options are for")
+    compare.add_argument("-o", "--option", action="append", required=True, help="an option to compare (repeat 2-8 times)")
+    compare.set_defaults(func=cmd_compare)
+
+    batch = subparsers.add_parser("batch", help="deliberate proposals from a CSV/JSONL file")
+    batch.add_argument("input", help="proposals file (.csv or .jsonl)")
+    batch.add_argument("-o", "--output", required=True, help="verdicts JSONL (also used as the resume checkpoint)")
+    batch.add_argument("--format", choices=["csv", "jsonl"], help="input format (default: by extension)")
+    batch.add_argument("--mode", choices=["separate", "joint"], default="separate")
+    batch.add_argument("--workers", type=int, default=1, help="in-process queue workers (proposals deliberated in parallel)")
+    batch.add_argument("--short-circuit", choices=["cancel", "advisory"], help="skip the third persona once two agree")
+    batch.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="serve /metrics and /metrics.json on this port")
+    batch.set_defaults(func=cmd_batch)
+
+    models = subparsers.add_parser("models", help="show the model fallback chain")
+    models.add_argument("--refresh", action="store_true", help="ignore the on-disk model list cache")
+    models.set_defaults(func=cmd_models)
+
+    bench = subparsers.add_parser("bench", help="benchmark the pipeline offline against a fake backend")
+    bench.add_argument("--deliberations", type=int, default=60, help="proposals per scenario")
+    bench.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrent deliberations")
+    bench.add_argument("--cache", default="off,exact,similar", help="comma-separated cache settings (off, exact, similar)")
+    bench.add_argument("--mode", choices=["separate", "joint"], default="separate")
+    bench.add_argument("--short-circuit", choices=["cancel", "advisory"])
+    bench.add_argument("--repeat-rate", type=float, default=0.3, help="share of repeated or reworded proposals")
+    bench.add_argument("--latency", type=float, default=0.2, help="median fake network latency in seconds")
+    bench.add_argument("--burst-rate", type=float, default=0.0, help="chance that a call starts a burst of 429s")
+    bench.add_argument("--unavailable-rate", type=float, default=0.0, help="share of 503 replies")
+    bench.add_argument("--malformed-rate", type=float, default=0.0, help="share of non-JSON replies")
+    bench.add_argument("--truncated-rate", type=float, default=0.0, help="share of truncated replies")
+    bench.add_argument("--keys", type=int, default=4, help="fake API keys in the pool")
+    bench.add_argument("--rpm", type=int, default=1000, help="fake per-key requests per minute")
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--json", action="store_true", help="print results as JSON")
+    bench.add_argument("--min-throughput", type=float, default=0.0, help="exit 1 if any scenario is slower (deliberations/s)")
+    bench.set_defaults(func=cmd_bench)
+
+    serve = subparsers.add_parser("serve", help="serve the HTTP deliberation API (requires uvicorn)")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="also serve metrics on a separate port")
+    serve.set_defaults(func=cmd_serve)
+
+    history = subparsers.add_parser("history", help="list or search past deliberations")
+    history.add_argument("query", nargs="?", help="full-text search over proposals and reasons")
+    history.add_argument("--limit", type=int, default=20)
+    history.add_argument("--offset", type=int, default=0)
+    history.add_argument("--show", type=int, metavar="ID", help="print one deliberation as JSON")
+    history.set_defaults(func=cmd_history)
+
+    worker = subparsers.add_parser("worker", help="run job queue workers")
+    worker.add_argument("--workers", type=int, default=2)
+    worker.set_defaults(func=cmd_worker)
+
+    submit = subparsers.add_parser("submit", help="queue a deliberation and print its job id")
+    submit.add_argument("proposal", help="proposal text ('-' to read from stdin)")
+    submit.add_argument("--mode", choices=["separate", "joint"], default="separate")
+    submit.add_argument("--short-circuit", choices=["cancel", "advisory"])
+    submit.add_argument("--user", help="submitter for fair queueing (default: login name)")
+    submit.add_argument("--priority", choices=list(json.loads(PRIORITY_WEIGHTS)), default="interactive",
+                        help="batch jobs only use quota left over by interactive ones")
+    submit.set_defaults(func=cmd_submit)
+
+    job = subparsers.add_parser("job", help="show a queued deliberation's status and result")
+    job.add_argument("job_id")
+    job.set_defaults(func=cmd_job)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
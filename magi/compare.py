@@ -0,0 +1,231 @@
+"""比較審議（複数の選択肢を1回の呼び出しで順位付けし、ボルダ得点で集計する）
+
+各人格には全選択肢を1つのプロンプトで渡し、選択肢ごとの順位・スコア・判定を得る。
+選択肢がいくつあっても呼び出しは人格の数（既定で3回）で済み、
+同じ基準で並べて評価するため、選択肢を1つずつ審議するより順位が安定する。
+人格ごとの順位はボルダ得点（n個中の1位にn-1点、最下位に0点）に人格の重みを掛けて合計する。
+"""
+import functools
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .backends import get_backend
+from .cache import cache_get, cache_put, get_cache_key
+from .config import DELIBERATION_DEADLINE, MAX_CONCURRENCY, MAX_PROPOSAL_TOKENS
+from .engine import SAFETY_SETTINGS, make_error_result
+from .governor import estimate_tokens, summarize, truncate_tokens
+from .keys import get_api_keys
+from .metrics import add_usage, finish_call, start_call
+from .models import route_model
+from .personas import MAGI_PERSONAS, MAGI_TYPES, passes_vote, stamp_persona
+from .retry import RetryGiveUp, remaining_seconds, run_with_retries
+from .verdict import comparison_schema, parse_comparison
+
+MIN_OPTIONS = 2
+MAX_OPTIONS = 8
+
+# 選択肢1つあたりの出力トークン（理由が途中で切れない程度）
+OUTPUT_TOKENS_PER_OPTION = 160
+
+COMPARISON_INSTRUCTION = """
+上記の個別の回答形式ではなく、提示された全ての選択肢を同じ基準で比較し、以下のJSON形式でのみ回答してください：
+{"rankings": [{"option": "選択肢の記号", "rank": 1, "decision": true/false, "reason": "...", "score": 1-10}, ...]}
+全ての選択肢を1回ずつ含め、rankは最も良い選択肢を1として重複なく付けてください。
+decisionはその選択肢単独で承認できるか、scoreはその選択肢の評価です。
+各reasonは100文字以内としてください。JSON以外の文字は含めないでください。"""
+
+
+def option_ids(count):
+    """選択肢の記号（A, B, C, ...）"""
+    return list(string.ascii_uppercase[:count])
+
+
+def clean_options(options):
+    """空の選択肢を除き、選択肢の数を確認する（範囲外ならValueError）"""
+    options = [text.strip() for text in options if text and text.strip()]
+    if not MIN_OPTIONS <= len(options) <= MAX_OPTIONS:
+        raise ValueError(f"comparison needs {MIN_OPTIONS}-{MAX_OPTIONS} options, got {len(options)}")
+    return options
+
+
+def comparison_generation_config(ids):
+    """選択肢の数に合わせた生成設定"""
+    return {
+        "max_output_tokens": 64 + OUTPUT_TOKENS_PER_OPTION * len(ids),
+        "temperature": 0.7,
+        "response_mime_type": "application/json",
+        "response_schema": comparison_schema(ids),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def build_comparison_prompt(magi_type):
+    """人格のプロンプトに比較モードの回答形式を加える"""
+    return MAGI_PERSONAS[magi_type]["prompt"] + "\n" + COMPARISON_INSTRUCTION
+
+
+def prepare_options(options, deadline=None):
+    """選択肢を入力の上限に収める（長い選択肢は要約し、合計が上限を超えないように切る）"""
+    budget = max(1, MAX_PROPOSAL_TOKENS // len(options))
+    prepared = []
+    for text in options:
+        if estimate_tokens(text) > budget:
+            text = summarize(text, deadline)
+        prepared.append(truncate_tokens(text, budget))
+    return prepared
+
+
+def format_comparison(question, ids, options):
+    """人格に渡す本文"""
+    lines = [f"議題: {question}" if question else "議題: 次の選択肢のうち、どれを採るべきか", "", "選択肢:"]
+    lines.extend(f"{option_id}. {text}" for option_id, text in zip(ids, options))
+    return "\n".join(lines)
+
+
+def analyze_comparison(question, options, magi_type, max_retries=None, queue_seconds=0.0, deadline=None):
+    """1人の人格に全選択肢を渡し、選択肢ごとの順位と判定を得る"""
+    call = start_call(magi_type, queue_seconds)
+    result = _analyze_comparison(call, question, options, magi_type, max_retries, deadline)
+    finish_call(call, result)
+    return result
+
+
+def _analyze_comparison(call, question, options, magi_type, max_retries, deadline):
+
+    persona = MAGI_PERSONAS[magi_type]
+
+    def error_result(reason):
+        result = make_error_result(persona, reason)
+        result["options"] = {}
+        return result
+
+    if not get_api_keys():
+        return error_result("ERROR: API KEY NOT SET.")
+
+    ids = option_ids(len(options))
+    generation_config = comparison_generation_config(ids)
+    model_name = route_model()
+    call["model"] = model_name
+
+    # 比較の本文は選択肢の組み合わせごとに異なるため、完全一致のキャッシュだけを使う
+    cache_key = get_cache_key(format_comparison(question, ids, options), magi_type, model_name, generation_config)
+    cached_data = cache_get(cache_key)
+    if cached_data is not None:
+        cached_data["cache"] = call["cache"] = "exact"
+        return cached_data
+    call["cache"] = "miss"
+
+    content = format_comparison(question, ids, prepare_options(options, deadline))
+
+    def request(model_name, api_key):
+        sent_at = time.monotonic()
+        try:
+            response = get_backend().generate_content(
+                model_name, api_key, content,
+                generation_config, SAFETY_SETTINGS,
+                system_instruction=build_comparison_prompt(magi_type),
+                timeout=remaining_seconds(deadline)
+            )
+        finally:
+            call["network_seconds"] += time.monotonic() - sent_at
+        add_usage(call, response)
+        return parse_comparison(response.text, ids)
+
+    try:
+        verdicts, model_name = run_with_retries(call, model_name, request, max_retries, deadline)
+    except RetryGiveUp as e:
+        return error_result(str(e))
+
+    # 1位の選択肢の判定を人格の判定として表示する
+    best = min(verdicts, key=lambda option_id: verdicts[option_id]["rank"])
+    result = stamp_persona({
+        "decision": verdicts[best]["decision"],
+        "reason": f"{best}: {verdicts[best]['reason']}",
+        "score": verdicts[best]["score"],
+        "model": model_name,
+        "options": verdicts,
+    }, persona)
+
+    # 全選択肢の判定がそろった場合のみキャッシュに保存
+    if len(verdicts) == len(ids):
+        cache_put(cache_key, result)
+
+    return result
+
+
+def borda_ranking(results, ids):
+    """人格ごとの順位をボルダ得点で集計し、得点の高い順の一覧を返す
+
+    各要素は {"option", "points", "mean_score", "approvals", "approved", "first_places"}。
+    順位を返さなかった人格（エラー）は集計に含めない。得点が同じ場合は平均スコアの高い順。
+    """
+    total_weight = sum(persona["weight"] for persona in MAGI_PERSONAS.values())
+    rows = {option_id: {"option": option_id, "points": 0.0, "scores": [], "approved_weight": 0.0,
+                        "approvals": 0, "first_places": 0} for option_id in ids}
+    for magi_type, result in results.items():
+        weight = MAGI_PERSONAS[magi_type]["weight"]
+        for option_id, verdict in (result.get("options") or {}).items():
+            row = rows[option_id]
+            row["points"] += weight * (len(ids) - verdict["rank"])
+            row["scores"].append(verdict["score"])
+            if verdict["decision"]:
+                row["approved_weight"] += weight
+                row["approvals"] += 1
+            if verdict["rank"] == 1:
+                row["first_places"] += 1
+
+    ranking = []
+    for row in rows.values():
+        scores = row.pop("scores")
+        approved_weight = row.pop("approved_weight")
+        row["points"] = round(row["points"], 3)
+        row["mean_score"] = round(sum(scores) / len(scores), 2) if scores else 0.0
+        row["approved"] = passes_vote(approved_weight, row["approvals"], total_weight)
+        ranking.append(row)
+    ranking.sort(key=lambda row: (-row["points"], -row["mean_score"], ids.index(row["option"])))
+    return ranking
+
+
+def compare(options, question="", on_result=None, deadline_seconds=None):
+    """全人格に選択肢を比較させ、完了順にon_result(magi_type, result, done)を呼ぶ
+
+    戻り値は {"question", "options": [{"id", "text"}], "results": {magi_type: 判定},
+    "ranking": borda_rankingの一覧, "winner": 1位の選択肢の記号（全員エラーならNone）}。
+    呼び出しは選択肢の数によらず人格ごとに1回。
+    """
+    options = clean_options(options)
+    ids = option_ids(len(options))
+
+    deadline_seconds = DELIBERATION_DEADLINE if deadline_seconds is None else deadline_seconds
+    deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+
+    def run(magi_type, submitted_at):
+        try:
+            return analyze_comparison(
+                question, options, magi_type,
+                queue_seconds=time.monotonic() - submitted_at, deadline=deadline
+            )
+        except Exception as e:
+            result = make_error_result(MAGI_PERSONAS[magi_type], f"ERROR: {str(e)[:50]}")
+            result["options"] = {}
+            return result
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(MAGI_TYPES))) as executor:
+        futures = {executor.submit(run, magi_type, time.monotonic()): magi_type for magi_type in MAGI_TYPES}
+        for future in as_completed(futures):
+            magi_type = futures[future]
+            results[magi_type] = future.result()
+            if on_result:
+                on_result(magi_type, results[magi_type], len(results))
+
+    ranking = borda_ranking(results, ids)
+    ranked = any(result.get("options") for result in results.values())
+    return {
+        "question": question,
+        "options": [{"id": option_id, "text": text} for option_id, text in zip(ids, options)],
+        "results": {magi_type: results[magi_type] for magi_type in MAGI_TYPES},
+        "ranking": ranking,
+        "winner": ranking[0]["option"] if ranked else None,
+    }
@@ -0,0 +1,92 @@
+"""設定の読み込み
+
+設定はすべて環境変数から読む。Streamlitアプリから使う場合は、
+magi_streamlit.pyがStreamlit Secretsを環境変数に反映してからこのパッケージを読み込む。
+"""
+import os
+
+
+def get_config(name, default=None):
+    """設定値を環境変数から取得"""
+    return os.environ.get(name, default)
+
+
+def load_api_keys():
+    """API Keyを読み込む（カンマ区切りで複数キーをサポート）"""
+    key_str = get_config("GEMINI_API_KEY") or get_config("GOOGLE_API_KEY")
+    if not key_str:
+        return []
+    return [k.strip() for k in key_str.split(",") if k.strip()]
+
+
+# 同時に実行するMAGI数の上限（1で逐次実行）
+MAX_CONCURRENCY = max(1, int(get_config("MAGI_MAX_CONCURRENCY", 3)))
+
+# 全プロセスで共有する状態（レート制限の台帳など）の保存先
+STATE_DIR = get_config("MAGI_STATE_DIR", os.path.join(os.path.expanduser("~"), ".magi"))
+STATE_DB = os.path.join(STATE_DIR, "magi_state.db")
+
+# 判定キャッシュの有効期限（秒）と最大件数（超えたら最終アクセスが古い順に削除）
+CACHE_TTL = float(get_config("MAGI_CACHE_TTL", 86400))
+CACHE_MAX_ENTRIES = int(get_config("MAGI_CACHE_MAX_ENTRIES", 5000))
+
+# 類似提案のキャッシュを使う類似度のしきい値（0〜1、1以上で無効）
+# 言い換えでも判定が変わりうるため既定では無効。使う場合は0.9前後を目安にする
+SIMILARITY_THRESHOLD = float(get_config("MAGI_SIMILARITY_THRESHOLD", 1))
+
+# 429を返したキーを休ませる秒数
+KEY_COOLDOWN_SECONDS = float(get_config("MAGI_KEY_COOLDOWN", 60))
+
+# 枠が空くまで待機する上限（これを超える場合は即エラー）
+MAX_RATE_LIMIT_WAIT = float(get_config("MAGI_MAX_RATE_LIMIT_WAIT", 120))
+
+# モデル一覧のディスクキャッシュの有効期限（秒）
+MODELS_CACHE_TTL = float(get_config("MAGI_MODELS_TTL", 86400))
+
+# メトリクスのHTTPエンドポイントのポート（0で無効）
+METRICS_PORT = int(get_config("MAGI_METRICS_PORT", 0))
+
+# 人格定義と投票ルールのJSON（未設定なら既定の3人格・多数決）
+PERSONAS_FILE = get_config("MAGI_PERSONAS_FILE")
+
+# 生成バックエンド（gemini / fake）と、fakeの場合の設定（JSON、magi.backends.FakeBackendの引数）
+BACKEND = get_config("MAGI_BACKEND", "gemini")
+FAKE_BACKEND_OPTIONS = get_config("MAGI_FAKE_BACKEND", "{}")
+
+# モデルごとのRPM/RPD枠の上書き（JSON、例: {"gemini-2.5-flash": [1000, 10000]}）
+MODEL_LIMITS_OVERRIDE = get_config("MAGI_MODEL_LIMITS", "{}")
+
+# 審議履歴を状態DBに記録するか（0で無効）
+HISTORY_ENABLED = get_config("MAGI_HISTORY", "1") != "0"
+
+# 一時的な障害（5xx・タイムアウト）の再試行回数と、ジッター付きバックオフの基準・上限（秒）
+RETRY_ATTEMPTS = int(get_config("MAGI_RETRY_ATTEMPTS", 4))
+RETRY_BASE_DELAY = float(get_config("MAGI_RETRY_BASE_DELAY", 0.5))
+RETRY_MAX_DELAY = float(get_config("MAGI_RETRY_MAX_DELAY", 8))
+
+# 同じモデル×キーで続けてこの回数失敗したら、BREAKER_COOLDOWN秒そのキーを使わない
+BREAKER_FAILURES = int(get_config("MAGI_BREAKER_FAILURES", 3))
+BREAKER_COOLDOWN = float(get_config("MAGI_BREAKER_COOLDOWN", 30))
+
+# 1回の審議の期限（秒、0で無制限）。過ぎても届かない判定はエラーとして扱う
+DELIBERATION_DEADLINE = float(get_config("MAGI_DELIBERATION_DEADLINE", 90))
+
+# 人格に渡す提案の上限（見積もりトークン数）。超える提案は要約してから渡す
+MAX_PROPOSAL_TOKENS = int(get_config("MAGI_MAX_PROPOSAL_TOKENS", 1500))
+# これを超える提案はチャンクに分けて要約する（map-reduce）
+MAP_REDUCE_TOKENS = int(get_config("MAGI_MAP_REDUCE_TOKENS", 12000))
+CHUNK_TOKENS = int(get_config("MAGI_CHUNK_TOKENS", 4000))
+MAX_CHUNKS = int(get_config("MAGI_MAX_CHUNKS", 8))
+
+# ジョブキューのワーカー数（UIのプロセス内で起動する数、0なら`magi worker`に任せる）
+EMBEDDED_WORKERS = int(get_config("MAGI_WORKERS", 2))
+# 空のキューを確認する間隔と、ワーカーが止まったとみなして再実行するまでの秒数
+JOB_POLL_INTERVAL = float(get_config("MAGI_JOB_POLL_INTERVAL", 0.5))
+JOB_STALE_SECONDS = float(get_config("MAGI_JOB_STALE_SECONDS", 300))
+
+# 利用者ごとの公平なキューの優先度の重み（JSON）。重いほど同じ利用実績でも先に実行される
+PRIORITY_WEIGHTS = get_config("MAGI_PRIORITY_WEIGHTS", '{"interactive": 4, "batch": 1}')
+# 利用実績として数える期間（秒）。この間に多く実行した利用者ほど後回しになる
+FAIR_WINDOW = float(get_config("MAGI_FAIR_WINDOW", 600))
+# 日次枠の残りがこの割合を下回ったら、バッチは投入せず対話の審議のために残す
+BATCH_RESERVE = float(get_config("MAGI_BATCH_RESERVE", 0.2))
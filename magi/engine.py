@@ -0,0 +1,412 @@
+"""審議エンジン（人格ごとの分析・共同審議・並行実行・多数決）
+
+Streamlitに依存しないため、UI・CLI・バッチから共通で使える。
+"""
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import cache_get, cache_put, count_cache_stat, get_cache_key
+from .config import DELIBERATION_DEADLINE, HISTORY_ENABLED, MAX_CONCURRENCY, SIMILARITY_THRESHOLD
+from .governor import prepare_proposal
+from .history import record_deliberation
+from .keys import get_api_keys
+from .metrics import add_usage, finish_call, start_call
+from .backends import get_backend
+from .models import get_model_chain, route_model
+from .personas import MAGI_PERSONAS, MAGI_TYPES, build_joint_prompt, passes_vote, stamp_persona
+from .retry import RetryGiveUp, remaining_seconds, run_with_retries
+from .similarity import find_similar, index_proposal
+from .verdict import VERDICT_SCHEMA, joint_schema, parse_joint_verdicts, parse_partial_verdict, parse_verdict
+
+# JSONモードとスキーマで形式を強制する（reasonが途中で切れない程度の上限にする）
+GENERATION_CONFIG = {
+    "max_output_tokens": 256,
+    "temperature": 0.7,
+    "response_mime_type": "application/json",
+    "response_schema": VERDICT_SCHEMA,
+}
+
+SAFETY_SETTINGS = {
+    'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
+    'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
+    'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
+}
+
+# 共同審議モードの人格1人あたりの出力トークン（人格が増えても判定が途中で切れないようにする）
+JOINT_OUTPUT_TOKENS_PER_PERSONA = 192
+
+# 共同審議モード（1リクエストで全人格の判定を得る）の設定
+JOINT_GENERATION_CONFIG = {
+    "max_output_tokens": 64 + JOINT_OUTPUT_TOKENS_PER_PERSONA * len(MAGI_TYPES),
+    "temperature": 0.7,
+    "response_mime_type": "application/json",
+    "response_schema": joint_schema(MAGI_TYPES),
+}
+
+
+def make_error_result(persona, reason):
+    """エラー時の判定結果（否決扱い）を作成"""
+    return stamp_persona({"decision": False, "reason": reason, "score": 0}, persona)
+
+
+def _mark_cached(cached_data, cache_type, similarity=None, neighbor=None):
+    """キャッシュから返す判定に、どのように得たかを記録する"""
+    verdicts = cached_data.values() if "magi" not in cached_data else [cached_data]
+    for verdict in verdicts:
+        verdict["cache"] = cache_type
+        if similarity is not None:
+            verdict["similarity"] = round(similarity, 3)
+            verdict["neighbor_proposal"] = neighbor[:100]
+    return cached_data
+
+
+def lookup_cache(proposal_text, magi_type, model_name, generation_config):
+    """完全一致、なければ類似提案のキャッシュから判定を探す（なければNone）"""
+    cached_data = cache_get(get_cache_key(proposal_text, magi_type, model_name, generation_config), count_stats=False)
+    if cached_data is not None:
+        count_cache_stat("hits")
+        return _mark_cached(cached_data, "exact")
+
+    if SIMILARITY_THRESHOLD < 1:
+        for neighbor, similarity in find_similar(proposal_text, SIMILARITY_THRESHOLD):
+            cached_data = cache_get(get_cache_key(neighbor, magi_type, model_name, generation_config), count_stats=False)
+            if cached_data is not None:
+                count_cache_stat("neighbor_hits")
+                return _mark_cached(cached_data, "neighbor", similarity, neighbor)
+
+    count_cache_stat("misses")
+    return None
+
+
+def store_cache(proposal_text, magi_type, model_name, generation_config, value):
+    """判定をキャッシュし、類似検索のインデックスに提案を登録する"""
+    cache_put(get_cache_key(proposal_text, magi_type, model_name, generation_config), value)
+    if SIMILARITY_THRESHOLD < 1:
+        index_proposal(proposal_text)
+
+
+def format_proposal(prepared):
+    """人格に渡す本文（要約した場合はそう明記する）"""
+    if prepared["strategy"] == "direct":
+        return f"提案内容: {prepared['text']}"
+    return f"提案内容（長文のため要約）: {prepared['text']}"
+
+
+def extract_partial_reason(partial_text):
+    """ストリーミング途中の応答から、生成済みのreasonを取り出す"""
+    return parse_partial_verdict(partial_text).get("reason", "")
+
+
+def analyze_proposal(proposal_text, magi_type, max_retries=None, on_chunk=None, queue_seconds=0.0, deadline=None):
+    """Gemini APIを使って提案を分析（エラーの種類に応じて別のキー・モデルで再試行）
+
+    on_chunkを渡すとストリーミングで生成し、受信するたびに
+    on_chunk(magi_type, それまでの応答テキスト)を呼ぶ。
+    queue_secondsは実行開始までの待ち時間で、メトリクスに記録される。
+    deadline（time.monotonic()の値）を過ぎると再試行せずにエラーの判定を返す。
+    """
+    call = start_call(magi_type, queue_seconds)
+    result = _analyze_proposal(call, proposal_text, magi_type, max_retries, on_chunk, deadline)
+    finish_call(call, result)
+    return result
+
+
+def _analyze_proposal(call, proposal_text, magi_type, max_retries, on_chunk, deadline):
+
+    persona = MAGI_PERSONAS.get(magi_type)
+    if not persona:
+        return {"error": "Invalid MAGI type"}
+
+    if not get_api_keys():
+        return make_error_result(persona, "ERROR: API KEY NOT SET.")
+
+    # キャッシュチェック（現在使用中のモデルの判定のみ、類似提案も含む）
+    model_name = route_model()
+    cached_data = lookup_cache(proposal_text, magi_type, model_name, GENERATION_CONFIG)
+    call["model"] = model_name
+    if cached_data is not None:
+        call["cache"] = cached_data.get("cache")
+        return cached_data
+    call["cache"] = "miss"
+
+    # 長い提案は要約してから渡す（要約は全人格で共有される）
+    content = format_proposal(prepare_proposal(proposal_text, deadline))
+
+    def request(model_name, api_key):
+        # 人格のプロンプトはシステム指示として渡し、本文は提案だけにする
+        sent_at = time.monotonic()
+        try:
+            response = get_backend().generate_content(
+                model_name, api_key, content,
+                GENERATION_CONFIG, SAFETY_SETTINGS,
+                stream=on_chunk is not None,
+                system_instruction=persona["prompt"],
+                timeout=remaining_seconds(deadline)
+            )
+            if on_chunk:
+                response_text = ""
+                for chunk in response:
+                    response_text += chunk.text
+                    on_chunk(magi_type, response_text)
+            else:
+                response_text = response.text
+        finally:
+            call["network_seconds"] += time.monotonic() - sent_at
+        add_usage(call, response)
+        return parse_verdict(response_text)
+
+    try:
+        result, model_name = run_with_retries(call, model_name, request, max_retries, deadline)
+    except RetryGiveUp as e:
+        return make_error_result(persona, str(e))
+
+    stamp_persona(result, persona)
+    result["model"] = model_name
+
+    # キャッシュに保存（判定したモデルのキーで）
+    store_cache(proposal_text, magi_type, model_name, GENERATION_CONFIG, result)
+
+    return result
+
+
+def analyze_joint(proposal_text, max_retries=None, deadline=None):
+    """1回のリクエストで全MAGIの判定をまとめて取得（共同審議モード）"""
+    call = start_call("joint")
+    results = _analyze_joint(call, proposal_text, max_retries, deadline)
+    finish_call(call, results)
+    return results
+
+
+def _analyze_joint(call, proposal_text, max_retries, deadline):
+
+    def error_results(reason):
+        return {magi_type: make_error_result(MAGI_PERSONAS[magi_type], reason) for magi_type in MAGI_TYPES}
+
+    if not get_api_keys():
+        return error_results("ERROR: API KEY NOT SET.")
+
+    # キャッシュチェック
+    model_name = route_model()
+    cached_data = lookup_cache(proposal_text, "joint", model_name, JOINT_GENERATION_CONFIG)
+    call["model"] = model_name
+    if cached_data is not None:
+        call["cache"] = next(iter(cached_data.values())).get("cache")
+        return cached_data
+    call["cache"] = "miss"
+    content = format_proposal(prepare_proposal(proposal_text, deadline))
+
+    def request(model_name, api_key):
+        sent_at = time.monotonic()
+        try:
+            response = get_backend().generate_content(
+                model_name, api_key, content,
+                JOINT_GENERATION_CONFIG, SAFETY_SETTINGS,
+                system_instruction=build_joint_prompt(),
+                timeout=remaining_seconds(deadline)
+            )
+        finally:
+            call["network_seconds"] += time.monotonic() - sent_at
+        add_usage(call, response)
+        return parse_joint_verdicts(response.text, MAGI_TYPES)
+
+    try:
+        verdicts, model_name = run_with_retries(call, model_name, request, max_retries, deadline)
+    except RetryGiveUp as e:
+        return error_results(str(e))
+
+    # 人格ごとの判定に分割（個別モードと同じ形式）
+    results = {}
+    for magi_type in MAGI_TYPES:
+        persona = MAGI_PERSONAS[magi_type]
+        verdict = verdicts[magi_type]
+        if verdict is None:
+            results[magi_type] = make_error_result(persona, "ERROR: NO VERDICT IN JOINT RESPONSE")
+            continue
+        result = stamp_persona(dict(verdict), persona)
+        result["model"] = model_name
+        results[magi_type] = result
+
+    # 全人格の判定がそろった場合のみキャッシュに保存
+    if all("magi" in r and not str(r.get("reason", "")).startswith("ERROR:") for r in results.values()):
+        store_cache(proposal_text, "joint", model_name, JOINT_GENERATION_CONFIG, results)
+
+    return results
+
+
+def lookup_cached_results(proposal_text, mode="separate"):
+    """APIを呼ばずにキャッシュだけで全人格の判定をそろえる（そろわなければNone）"""
+    for model_name in get_model_chain():
+        if mode == "joint":
+            results = lookup_cache(proposal_text, "joint", model_name, JOINT_GENERATION_CONFIG)
+        else:
+            results = {}
+            for magi_type in MAGI_TYPES:
+                cached_data = lookup_cache(proposal_text, magi_type, model_name, GENERATION_CONFIG)
+                if cached_data is None:
+                    results = None
+                    break
+                results[magi_type] = cached_data
+        if results is not None:
+            return results
+    return None
+
+
+def count_votes(results):
+    """承認の重みの合計と承認数"""
+    approved = [magi_type for magi_type, r in results.items() if r.get("decision", False)]
+    return sum(MAGI_PERSONAS[magi_type]["weight"] for magi_type in approved), len(approved)
+
+
+def is_decided(results):
+    """残りの判定に関係なく最終判定が確定しているか"""
+    total_weight = sum(persona["weight"] for persona in MAGI_PERSONAS.values())
+    approved_weight, approvals = count_votes(results)
+    remaining = [magi_type for magi_type in MAGI_TYPES if magi_type not in results]
+    remaining_weight = sum(MAGI_PERSONAS[magi_type]["weight"] for magi_type in remaining)
+    # 残りが全員承認しても全員否決しても結果が変わらなければ確定
+    return passes_vote(approved_weight, approvals, total_weight) == passes_vote(
+        approved_weight + remaining_weight, approvals + len(remaining), total_weight
+    )
+
+
+def first_wave_size():
+    """全員が同じ判定なら結果が確定する、先頭からの最小の人数"""
+    for size in range(1, len(MAGI_TYPES)):
+        wave = MAGI_TYPES[:size]
+        if all(is_decided({magi_type: {"decision": vote} for magi_type in wave}) for vote in (True, False)):
+            return size
+    return len(MAGI_TYPES)
+
+
+def make_skipped_result(persona):
+    """最終判定が確定したため実行しなかった判定"""
+    result = make_error_result(persona, "SKIPPED: DECISION ALREADY REACHED")
+    result["skipped"] = True
+    return result
+
+
+def deliberate(proposal_text, on_result=None, mode="separate", on_chunk=None, on_decision=None, short_circuit=None,
+               deadline_seconds=None):
+    """各MAGIを並行に実行し、完了順にon_result(magi_type, result, done)を呼ぶ
+
+    mode="joint"の場合は1回のリクエストで全人格の判定をまとめて取得する。
+    on_chunk(magi_type, partial_text)を渡すと各MAGIの応答をストリーミングで受け取れる。
+    on_decision(final_decision, approvals)は最終判定が確定した時点で1回だけ呼ばれる。
+    コールバックはすべて呼び出し元のスレッドで実行される。
+
+    short_circuit:
+        None       全員の判定を待つ
+        "cancel"   先に判定の確定に必要な数だけ実行し、確定したら残りは実行しない
+        "advisory" 全員を同時に実行し、確定後に届いた判定は参考扱い(advisory)にする
+
+    deadline_seconds（既定はMAGI_DELIBERATION_DEADLINE、0で無制限）を過ぎても
+    判定が届かない人格は "ERROR: DEADLINE EXCEEDED" として扱い、投票を待たせない。
+    結果は審議履歴にも記録される（MAGI_HISTORY=0で無効）。
+    """
+    started = time.time()
+    deadline_seconds = DELIBERATION_DEADLINE if deadline_seconds is None else deadline_seconds
+    deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+    results = _deliberate(proposal_text, on_result, mode, on_chunk, on_decision, short_circuit, deadline)
+    if HISTORY_ENABLED:
+        record_deliberation(proposal_text, results, *tally_votes(results), mode, short_circuit, started, time.time())
+    return results
+
+
+def _deliberate(proposal_text, on_result, mode, on_chunk, on_decision, short_circuit, deadline):
+    if mode == "joint":
+        results = analyze_joint(proposal_text, deadline=deadline)
+        if on_result:
+            for done, magi_type in enumerate(MAGI_TYPES, 1):
+                on_result(magi_type, results[magi_type], done)
+        if on_decision:
+            on_decision(*tally_votes(results))
+        return results
+
+    # ワーカーからのイベントはキューで受け取り、呼び出し元のスレッドで処理する
+    events = queue.Queue()
+
+    def run(magi_type, submitted_at):
+        try:
+            chunk_callback = (lambda t, text: events.put(("chunk", t, text))) if on_chunk else None
+            result = analyze_proposal(
+                proposal_text, magi_type, on_chunk=chunk_callback,
+                queue_seconds=time.monotonic() - submitted_at, deadline=deadline
+            )
+        except Exception as e:
+            result = make_error_result(MAGI_PERSONAS[magi_type], f"ERROR: {str(e)[:50]}")
+        events.put(("result", magi_type, result))
+
+    if short_circuit == "cancel":
+        wave_size = first_wave_size()
+        first_wave, second_wave = MAGI_TYPES[:wave_size], MAGI_TYPES[wave_size:]
+    else:
+        first_wave, second_wave = MAGI_TYPES, []
+
+    results = {}
+    decided = False
+    expired = False
+    executor = ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(MAGI_TYPES)))
+    try:
+        pending = set(first_wave)
+        for magi_type in first_wave:
+            executor.submit(run, magi_type, time.monotonic())
+
+        while pending:
+            try:
+                timeout = None if deadline is None or expired else max(0, remaining_seconds(deadline))
+                kind, magi_type, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                # 期限切れ: 届いていない人格は期限切れの判定として扱い、遅れて届いた判定は捨てる
+                expired = True
+                for late_type in pending:
+                    events.put(("result", late_type, make_error_result(MAGI_PERSONAS[late_type], "ERROR: DEADLINE EXCEEDED")))
+                continue
+            if magi_type not in pending:
+                continue
+            if kind == "chunk":
+                on_chunk(magi_type, payload)
+                continue
+
+            pending.discard(magi_type)
+            if decided and short_circuit == "advisory":
+                payload["advisory"] = True
+            results[magi_type] = payload
+            if on_result:
+                on_result(magi_type, payload, len(results))
+
+            if not decided and is_decided(results):
+                decided = True
+                if on_decision:
+                    on_decision(*tally_votes(dict(results, **{
+                        t: make_skipped_result(MAGI_PERSONAS[t]) for t in MAGI_TYPES if t not in results
+                    })))
+
+            # 第1陣で確定しなければ残りを実行する
+            if not pending and second_wave:
+                if decided:
+                    for skipped_type in second_wave:
+                        results[skipped_type] = make_skipped_result(MAGI_PERSONAS[skipped_type])
+                        if on_result:
+                            on_result(skipped_type, results[skipped_type], len(results))
+                else:
+                    pending = set(second_wave)
+                    for next_type in second_wave:
+                        executor.submit(run, next_type, time.monotonic())
+                second_wave = []
+    finally:
+        # 期限切れで待たずに戻る場合も、未実行の人格は取り消す
+        executor.shutdown(wait=not expired, cancel_futures=True)
+
+    if not decided and on_decision:
+        on_decision(*tally_votes(results))
+    return {magi_type: results[magi_type] for magi_type in MAGI_TYPES}
+
+
+def tally_votes(results):
+    """投票ルールで最終判定を出す（既定は過半数の承認で承認）"""
+    approved_weight, approvals = count_votes({magi_type: results[magi_type] for magi_type in MAGI_TYPES})
+    total_weight = sum(persona["weight"] for persona in MAGI_PERSONAS.values())
+    final_decision = "approved" if passes_vote(approved_weight, approvals, total_weight) else "rejected"
+    return final_decision, approvals
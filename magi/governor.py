@@ -0,0 +1,227 @@
+"""長文の提案の前処理（トークン数の見積もり・要約・分割とmap-reduce）
+
+送信前に提案のトークン数を見積もり、上限を超える提案は1回だけ要約して
+全人格で共有する（要約はキャッシュするため、同じ提案で再び要約することはない）。
+さらに長い提案は段落ごとのチャンクに分けて要約し（map）、要約をまとめて
+上限に収まるまで要約し直す（reduce）。人格に渡る入力は常に上限以下になるため、
+審議1回あたりの入力トークンは提案の長さによらず一定の範囲に収まる。
+"""
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .backends import get_backend
+from .cache import cache_get, cache_put, normalize_proposal
+from .config import CHUNK_TOKENS, MAP_REDUCE_TOKENS, MAX_CONCURRENCY, MAX_CHUNKS, MAX_PROPOSAL_TOKENS
+from .keys import get_api_keys
+from .metrics import add_usage, finish_call, start_call
+from .models import route_model
+from .retry import RetryGiveUp, remaining_seconds, run_with_retries
+
+SUMMARY_PROMPT = """あなたは意思決定会議の書記です。与えられた提案文書を、審議に必要な情報を落とさずに要約してください。
+目的・具体的な施策・費用や数値・期限・想定されるリスクと利点は必ず残し、意見や評価は加えないでください。
+要約は日本語の平文で、見出しや箇条書きは使わずに書いてください。"""
+
+# 要約1回の出力上限（人格に渡す上限より十分小さくする）
+SUMMARY_GENERATION_CONFIG = {
+    "max_output_tokens": 512,
+    "temperature": 0.2,
+}
+
+# 日本語などの全角文字は1文字あたり約1トークン、それ以外は約4文字で1トークンとみなす
+_WIDE_PATTERN = re.compile(r"[　-ヿ㐀-鿿豈-﫿＀-￯]")
+
+TRUNCATION_MARK = "（以下省略）"
+
+_lock = threading.Lock()
+_in_flight = {}
+
+
+def estimate_tokens(text):
+    """トークン数の見積もり（APIを呼ばない）"""
+    wide = len(_WIDE_PATTERN.findall(text))
+    return wide + math.ceil((len(text) - wide) / 4)
+
+
+def plan_proposal(proposal_text):
+    """提案の扱い方を決める（direct: そのまま / summary: 要約 / map_reduce: 分割して要約）"""
+    tokens = estimate_tokens(proposal_text)
+    if tokens <= MAX_PROPOSAL_TOKENS:
+        strategy = "direct"
+    elif tokens <= MAP_REDUCE_TOKENS:
+        strategy = "summary"
+    else:
+        strategy = "map_reduce"
+    return {"strategy": strategy, "tokens": tokens}
+
+
+def _split_by_tokens(text, max_tokens):
+    """区切りのない長い文を、見積もりがmax_tokens以下になる文字数ごとに切る"""
+    windows = []
+    while estimate_tokens(text) > max_tokens:
+        low, high = 1, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate_tokens(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        windows.append(text[:low])
+        text = text[low:]
+    if text.strip():
+        windows.append(text)
+    return windows
+
+
+def split_chunks(text, chunk_tokens):
+    """段落（なければ文、それでも長ければ文字数）の区切りで、chunk_tokens以下のチャンクに分ける"""
+    pieces = [p for p in re.split(r"\n\s*\n", text) if p.strip()]
+    units = []
+    for piece in pieces:
+        if estimate_tokens(piece) <= chunk_tokens:
+            units.append(piece)
+            continue
+        # 英文の文末（"."の後に空白）でも区切る
+        for sentence in re.split(r"(?<=[。．！？!?\n])|(?<=\.)(?=\s)", piece):
+            if sentence.strip():
+                units.extend(_split_by_tokens(sentence, chunk_tokens))
+
+    # 短い文ごとに見積もりを切り上げると合計が過大になるため、全角とそれ以外の文字数で数える
+    chunks, current, wide, narrow = [], [], 0, 0
+    for unit in units:
+        unit_wide = len(_WIDE_PATTERN.findall(unit))
+        # 結合する改行の分も数える
+        unit_narrow = len(unit) - unit_wide + (1 if current else 0)
+        if current and wide + unit_wide + math.ceil((narrow + unit_narrow) / 4) > chunk_tokens:
+            chunks.append("\n".join(current))
+            current, wide, narrow = [], 0, 0
+            unit_narrow -= 1
+        current.append(unit)
+        wide += unit_wide
+        narrow += unit_narrow
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def truncate_tokens(text, max_tokens):
+    """見積もりがmax_tokens以下になるように末尾を切る"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) + estimate_tokens(TRUNCATION_MARK) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + TRUNCATION_MARK
+
+
+def _summary_cache_key(text):
+    payload = json.dumps({
+        "summary": normalize_proposal(text),
+        "prompt": hashlib.sha256(SUMMARY_PROMPT.encode("utf-8")).hexdigest()[:12],
+        "generation_config": SUMMARY_GENERATION_CONFIG,
+    }, sort_keys=True, ensure_ascii=False)
+    return "summary:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def summarize(text, deadline=None):
+    """テキストを要約する（キャッシュ済みならAPIを呼ばない、失敗したら先頭を残して切る）
+
+    複数の人格から同時に呼ばれても、同じテキストの要約は1回だけ行う。
+    """
+    cache_key = _summary_cache_key(text)
+    with _lock:
+        key_lock = _in_flight.setdefault(cache_key, threading.Lock())
+    try:
+        with key_lock:
+            cached = cache_get(cache_key, count_stats=False)
+            if cached is not None:
+                return cached
+            return _summarize(text, cache_key, deadline)
+    finally:
+        with _lock:
+            _in_flight.pop(cache_key, None)
+
+
+def _summarize(text, cache_key, deadline):
+
+    call = start_call("summary")
+    call["cache"] = "miss"
+
+    def request(model_name, api_key):
+        sent_at = time.monotonic()
+        try:
+            response = get_backend().generate_content(
+                model_name, api_key, text,
+                SUMMARY_GENERATION_CONFIG, None,
+                system_instruction=SUMMARY_PROMPT,
+                timeout=remaining_seconds(deadline)
+            )
+            summary = response.text.strip()
+        finally:
+            call["network_seconds"] += time.monotonic() - sent_at
+        add_usage(call, response)
+        if not summary:
+            raise ValueError("empty summary")
+        return summary
+
+    try:
+        if not get_api_keys():
+            raise RetryGiveUp("ERROR: API KEY NOT SET.")
+        summary, _ = run_with_retries(call, route_model(), request, deadline=deadline)
+    except RetryGiveUp as e:
+        finish_call(call, {"magi": "summary", "reason": str(e)})
+        # 要約できなくても、入力の上限は守る
+        return truncate_tokens(text, MAX_PROPOSAL_TOKENS)
+
+    finish_call(call, {"magi": "summary", "reason": ""})
+    cache_put(cache_key, summary)
+    return summary
+
+
+def prepare_proposal(proposal_text, deadline=None):
+    """人格に渡す提案文を用意する
+
+    戻り値は {"text": 人格に渡す文, "strategy": ..., "tokens": 元の見積もり,
+    "prompt_tokens": 渡す文の見積もり, "chunks": チャンク数}。
+    """
+    plan = plan_proposal(proposal_text)
+    chunks = 1
+    if plan["strategy"] == "direct":
+        text = proposal_text
+    elif plan["strategy"] == "summary":
+        text = summarize(proposal_text, deadline)
+    else:
+        # チャンク数に上限を設け、要約の呼び出し回数も一定の範囲に収める
+        chunk_tokens = max(CHUNK_TOKENS, math.ceil(plan["tokens"] / MAX_CHUNKS))
+        parts = split_chunks(proposal_text, chunk_tokens)
+        # 区切りの位置によってはチャンクが埋まりきらず上限を超えるため、大きくして分け直す
+        while len(parts) > MAX_CHUNKS:
+            chunk_tokens = math.ceil(chunk_tokens * len(parts) / MAX_CHUNKS)
+            parts = split_chunks(proposal_text, chunk_tokens)
+        chunks = len(parts)
+        while len(parts) > 1:
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+                summaries = list(executor.map(lambda part: summarize(part, deadline), parts))
+            combined = "\n\n".join(summaries)
+            if estimate_tokens(combined) <= MAX_PROPOSAL_TOKENS:
+                parts = [combined]
+                break
+            # まとめても長い場合は、要約をチャンクにまとめ直してもう一段要約する
+            next_parts = split_chunks(combined, chunk_tokens)
+            if len(next_parts) >= len(parts):
+                parts = [truncate_tokens(combined, MAX_PROPOSAL_TOKENS)]
+                break
+            parts = next_parts
+        text = parts[0]
+        if estimate_tokens(text) > MAX_PROPOSAL_TOKENS:
+            text = summarize(text, deadline)
+    text = truncate_tokens(text, MAX_PROPOSAL_TOKENS)
+    return dict(plan, text=text, prompt_tokens=estimate_tokens(text), chunks=chunks)
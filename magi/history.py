@@ -0,0 +1,100 @@
+"""審議履歴（状態DBに保存し、提案と理由を全文検索する）
+
+審議ごとに提案・各人格の判定・使ったモデル・時刻を記録する。
+記録した判定はそのまま再表示できるため、過去の結果を見るためにAPIを呼ぶ必要はない。
+"""
+import json
+import sqlite3
+
+from .state import connect_state_db
+
+# trigramの索引で検索できる最短の語の長さ（これより短い語は部分一致で探す）
+MIN_FTS_QUERY = 3
+
+
+def record_deliberation(proposal_text, results, final_decision, approvals, mode, short_circuit, started, finished):
+    """審議結果を履歴に追加してIDを返す"""
+    reasons = "\n".join(str(r.get("reason", "")) for r in results.values())
+    models = sorted({r["model"] for r in results.values() if r.get("model")})
+    conn = connect_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(
+                "INSERT INTO deliberations (proposal, mode, short_circuit, final_decision, approvals,"
+                " results, models, started, finished, reasons) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (proposal_text, mode, short_circuit, final_decision, approvals,
+                 json.dumps(results, ensure_ascii=False), ",".join(models), started, finished, reasons)
+            )
+            try:
+                conn.execute(
+                    "INSERT INTO deliberations_fts (rowid, proposal, reasons) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, proposal_text, reasons)
+                )
+            except sqlite3.OperationalError:
+                pass  # FTS5が使えない環境では部分一致検索のみ
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def _row_to_record(row):
+    record = dict(zip(
+        ["id", "proposal", "mode", "short_circuit", "final_decision", "approvals", "results", "models", "started", "finished"],
+        row
+    ))
+    record["results"] = json.loads(record["results"])
+    record["models"] = record["models"].split(",") if record["models"] else []
+    record["latency"] = round(record["finished"] - record["started"], 3)
+    return record
+
+
+_COLUMNS = "d.id, d.proposal, d.mode, d.short_circuit, d.final_decision, d.approvals, d.results, d.models, d.started, d.finished"
+
+
+def search_history(query=None, limit=20, offset=0):
+    """履歴を新しい順に取得（queryがあれば提案と理由を全文検索）し、(記録, 総件数)を返す"""
+    conn = connect_state_db()
+    try:
+        query = (query or "").strip()
+        if not query:
+            total = conn.execute("SELECT COUNT(*) FROM deliberations").fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {_COLUMNS} FROM deliberations d ORDER BY d.id DESC LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+            return [_row_to_record(row) for row in rows], total
+
+        terms = query.split()
+        try:
+            if min(len(term) for term in terms) < MIN_FTS_QUERY:
+                raise sqlite3.OperationalError("query too short for trigram index")
+            match = " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            where, params = "d.id IN (SELECT rowid FROM deliberations_fts WHERE deliberations_fts MATCH ?)", [match]
+            total = conn.execute(f"SELECT COUNT(*) FROM deliberations d WHERE {where}", params).fetchone()[0]
+        except sqlite3.OperationalError:
+            # 短い語やFTS5のない環境では、提案と理由の本文を部分一致で探す（判定のJSONのキーや人格名には一致させない）
+            where = " AND ".join("(d.proposal LIKE ? OR d.reasons LIKE ?)" for _ in terms)
+            params = [value for term in terms for value in (f"%{term}%", f"%{term}%")]
+            total = conn.execute(f"SELECT COUNT(*) FROM deliberations d WHERE {where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT {_COLUMNS} FROM deliberations d WHERE {where} ORDER BY d.id DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+        return [_row_to_record(row) for row in rows], total
+    finally:
+        conn.close()
+
+
+def get_deliberation(deliberation_id):
+    """IDで履歴を1件取得（なければNone）"""
+    conn = connect_state_db()
+    try:
+        row = conn.execute(f"SELECT {_COLUMNS} FROM deliberations d WHERE d.id = ?", (deliberation_id,)).fetchone()
+    finally:
+        conn.close()
+    return _row_to_record(row) if row else None
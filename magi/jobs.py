@@ -0,0 +1,322 @@
+"""審議のジョブキュー（状態DB上のキューとワーカープール）
+
+submit_jobはすぐにジョブIDを返し、ワーカーが共有のレート制限の範囲で審議を実行する。
+途中経過（届いた判定・生成途中の理由）と結果は状態DBに保存されるため、
+UIはIDで進捗を問い合わせればよく、再接続後も結果を取得できる。
+ワーカーが止まったジョブはハートビートが途絶えた時点で他のワーカーが再実行する。
+実行する順番と、日次枠が足りない場合の扱いはmagi.admissionが決める（利用者ごとの公平なキュー）。
+比較審議も同じキューで実行する（mode="compare"、proposalには議題と選択肢のJSONを入れる）。
+
+    magi worker --workers 4
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+from .admission import (
+    DEFAULT_PRIORITY, WEIGHTS, admission_decision, estimate_wait, fair_order, get_capacity,
+    get_recent_service, get_throughput, requests_per_job, seconds_until_capacity,
+)
+from .compare import clean_options, compare
+from .config import JOB_POLL_INTERVAL, JOB_STALE_SECONDS
+from .engine import deliberate, lookup_cached_results, tally_votes
+from .metrics import inc, observe
+from .state import connect_state_db
+
+# 生成途中の理由を保存する間隔（秒）。チャンクごとに書き込まないよう間引く
+PROGRESS_INTERVAL = 0.5
+
+# 実行中のジョブのハートビートを更新する間隔（秒）。止まったと見なされる時間より十分短くする
+HEARTBEAT_INTERVAL = JOB_STALE_SECONDS / 3
+
+_lock = threading.Lock()
+_workers = []
+
+_COLUMNS = ["id", "proposal", "mode", "short_circuit", "status", "progress", "results",
+            "final_decision", "approvals", "error", "worker", "created", "started", "finished", "heartbeat",
+            "user", "priority"]
+
+
+def submit_job(proposal_text, mode="separate", short_circuit=None, user="", priority=DEFAULT_PRIORITY):
+    """審議をキューに入れてジョブIDを返す（userごとに公平に、priorityの重みで順番が決まる）"""
+    if priority not in WEIGHTS:
+        raise ValueError(f"unknown priority: {priority}")
+    job_id = uuid.uuid4().hex[:16]
+    conn = connect_state_db()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, proposal, mode, short_circuit, status, created, user, priority)"
+            " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, proposal_text, mode, short_circuit, time.time(), user or "", priority)
+        )
+    finally:
+        conn.close()
+    return job_id
+
+
+def submit_comparison(options, question="", user="", priority=DEFAULT_PRIORITY):
+    """比較審議をキューに入れてジョブIDを返す（選択肢の数が範囲外ならValueError）"""
+    comparison = {"question": question, "options": clean_options(options)}
+    return submit_job(json.dumps(comparison, ensure_ascii=False), "compare", user=user, priority=priority)
+
+
+def cancel_job(job_id):
+    """待機中のジョブを取り消す（実行中・終了済みなら何もせずFalse）"""
+    conn = connect_state_db()
+    try:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'", (time.time(), job_id)
+        )
+    finally:
+        conn.close()
+    return cursor.rowcount == 1
+
+
+def _row_to_job(row):
+    job = dict(zip(_COLUMNS, row))
+    job["progress"] = json.loads(job["progress"] or "{}")
+    job["results"] = json.loads(job["results"]) if job["results"] else None
+    return job
+
+
+def get_job(job_id):
+    """ジョブを取得（なければNone）"""
+    conn = connect_state_db()
+    try:
+        row = conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return _row_to_job(row) if row else None
+
+
+def _queued_jobs(conn):
+    rows = conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE status = 'queued'").fetchall()
+    return [_row_to_job(row) for row in rows]
+
+
+def get_queue_order(conn=None):
+    """待機中のジョブを実行される順に返す"""
+    own_conn = conn is None
+    conn = conn or connect_state_db()
+    try:
+        return fair_order(_queued_jobs(conn), get_recent_service(conn, time.time()))
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def get_queue_position(job_id):
+    """待機中のジョブの順番と待ち時間の見込み（待機中でなければNone）
+
+    戻り値は {"position": 前に並んでいる件数, "requests_ahead": 前のジョブのリクエスト数,
+    "eta_seconds": 実行開始までの見込み秒数, "admission": "run" / "defer" / "shed"}。
+    """
+    conn = connect_state_db()
+    try:
+        order = get_queue_order(conn)
+        ids = [job["id"] for job in order]
+        if job_id not in ids:
+            return None
+        position = ids.index(job_id)
+        workers, job_seconds = get_throughput(conn, time.time())
+    finally:
+        conn.close()
+    ahead = order[:position]
+    requests_ahead = sum(requests_per_job(job["mode"]) for job in ahead)
+    capacity = get_capacity()
+    job = order[position]
+    # 前に並んでいるジョブが使う分を除いた枠で、このジョブを実行できるかを見る
+    remaining = dict(capacity, day=max(0, capacity["day"] - requests_ahead))
+    return {
+        "position": position,
+        "requests_ahead": requests_ahead,
+        "eta_seconds": round(estimate_wait(position, requests_ahead, workers, job_seconds, capacity), 1),
+        "admission": admission_decision(job["priority"], job["mode"], remaining),
+    }
+
+
+def claim_job(worker_id):
+    """次に実行するジョブ（またはワーカーが止まったジョブ）を取得して実行中にする
+
+    待機中のジョブは公平なキューの順に、日次枠の状況で実行できるものを選ぶ。
+    枠を残すために待たせるバッチは飛ばし、枠が足りない対話の審議はadmission="shed"で返す。
+    """
+    now = time.time()
+    conn = connect_state_db()
+    try:
+        # ワーカーが止まったジョブは受け付け済みのため、待機中のジョブより先に再実行する
+        row = conn.execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE status = 'running' AND heartbeat < ?"
+            " ORDER BY created LIMIT 1",
+            (now - JOB_STALE_SECONDS,)
+        ).fetchone()
+        candidates = [_row_to_job(row)] if row else []
+        if not candidates:
+            order = get_queue_order(conn)
+            capacity = get_capacity() if order else None
+            for job in order:
+                job["admission"] = admission_decision(job["priority"], job["mode"], capacity)
+                if job["admission"] != "defer":
+                    candidates.append(job)
+
+        # 他のワーカーと同じジョブを取り合った場合は、状態が変わっていなければ取得できる
+        for job in candidates:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ?, heartbeat = ?, progress = '{}'"
+                " WHERE id = ? AND status = ? AND heartbeat IS ?",
+                (worker_id, now, now, job["id"], job["status"], job["heartbeat"])
+            )
+            if cursor.rowcount == 1:
+                if job["status"] == "queued":
+                    # 投入から実行開始までのキューの待ち時間（人格の呼び出しのqueueは審議の中の待ちだけ）
+                    observe("magi_job_queue_seconds", now - job["created"], priority=job["priority"], mode=job["mode"])
+                job.update(status="running", worker=worker_id, started=now, heartbeat=now, progress={})
+                return job
+    finally:
+        conn.close()
+    return None
+
+
+def _update_job(job_id, **fields):
+    fields["heartbeat"] = time.time()
+    conn = connect_state_db()
+    try:
+        conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+            list(fields.values()) + [job_id]
+        )
+    finally:
+        conn.close()
+
+
+def shed_job(job):
+    """日次枠が足りないジョブに、キャッシュの判定だけで応答する（なければ失敗にする）"""
+    # 比較審議は選択肢の組み合わせごとに異なるため、キャッシュでは応答しない
+    results = None if job["mode"] == "compare" else lookup_cached_results(job["proposal"], job["mode"])
+    if results is None:
+        inc("magi_shed_total", outcome="rejected")
+        # 台帳の24時間の窓から記録が外れて、このジョブを実行できる枠が戻るまでの見込み
+        wait = seconds_until_capacity(requests_per_job(job["mode"]))
+        if wait is None:
+            error = "SHED: DAILY QUOTA EXHAUSTED AND NO CACHED VERDICT. THE DAILY LIMIT IS TOO SMALL FOR THIS JOB"
+        else:
+            error = f"SHED: DAILY QUOTA EXHAUSTED AND NO CACHED VERDICT. CAPACITY RETURNS IN {int(wait // 3600)}H {int(wait % 3600 // 60)}M"
+        _update_job(job["id"], status="failed", finished=time.time(), error=error)
+        return None
+    inc("magi_shed_total", outcome="cached")
+    final_decision, approvals = tally_votes(results)
+    _update_job(
+        job["id"], status="done", results=json.dumps(results, ensure_ascii=False),
+        final_decision=final_decision, approvals=approvals,
+        progress=json.dumps({"shed": True}), finished=time.time()
+    )
+    return results
+
+
+def run_comparison_job(job):
+    """比較審議のジョブを実行する（届いた人格の判定を途中経過に、比較の結果をresultsに保存する）"""
+    progress = {"results": {}}
+
+    def on_result(magi_type, result, done):
+        progress["results"][magi_type] = result
+        _update_job(job["id"], progress=json.dumps(progress, ensure_ascii=False))
+
+    comparison = json.loads(job["proposal"])
+    try:
+        result = compare(comparison["options"], question=comparison["question"], on_result=on_result)
+    except Exception as e:
+        _update_job(job["id"], status="failed", error=f"ERROR: {str(e)[:200]}", finished=time.time())
+        return None
+
+    _update_job(
+        job["id"], status="done", results=json.dumps(result, ensure_ascii=False),
+        progress=json.dumps(progress, ensure_ascii=False), finished=time.time()
+    )
+    return result
+
+
+def _keep_alive(job_id, stop_event):
+    while not stop_event.wait(HEARTBEAT_INTERVAL):
+        _update_job(job_id)
+
+
+def run_job(job):
+    """ジョブの審議を実行し、途中経過と結果を保存する
+
+    進捗が保存されない間（レート制限の待機など）もハートビートを更新し続けるため、
+    審議の期限がない場合でも、実行中のジョブが他のワーカーに再実行されることはない。
+    """
+    stop_event = threading.Event()
+    threading.Thread(target=_keep_alive, args=(job["id"], stop_event), daemon=True).start()
+    try:
+        return _run_job(job)
+    finally:
+        stop_event.set()
+
+
+def _run_job(job):
+    if job.get("admission") == "shed":
+        return shed_job(job)
+    if job["mode"] == "compare":
+        return run_comparison_job(job)
+    progress = {"results": {}, "partials": {}, "decision": None}
+    last_saved = [0.0]
+
+    def save_progress(force=False):
+        now = time.monotonic()
+        if force or now - last_saved[0] >= PROGRESS_INTERVAL:
+            last_saved[0] = now
+            _update_job(job["id"], progress=json.dumps(progress, ensure_ascii=False))
+
+    def on_chunk(magi_type, partial_text):
+        progress["partials"][magi_type] = partial_text
+        save_progress()
+
+    def on_result(magi_type, result, done):
+        progress["results"][magi_type] = result
+        progress["partials"].pop(magi_type, None)
+        save_progress(force=True)
+
+    def on_decision(final_decision, approvals):
+        progress["decision"] = [final_decision, approvals]
+        save_progress(force=True)
+
+    try:
+        results = deliberate(
+            job["proposal"], on_result=on_result, mode=job["mode"], on_chunk=on_chunk,
+            on_decision=on_decision, short_circuit=job["short_circuit"]
+        )
+    except Exception as e:
+        _update_job(job["id"], status="failed", error=f"ERROR: {str(e)[:200]}", finished=time.time())
+        return None
+
+    final_decision, approvals = tally_votes(results)
+    _update_job(
+        job["id"], status="done", results=json.dumps(results, ensure_ascii=False),
+        final_decision=final_decision, approvals=approvals,
+        progress=json.dumps(progress, ensure_ascii=False), finished=time.time()
+    )
+    return results
+
+
+def work(worker_id=None, stop_event=None):
+    """ジョブを取り出して実行し続ける（stop_eventがセットされたら終了）"""
+    worker_id = worker_id or f"{os.getpid()}-{threading.get_ident()}"
+    while stop_event is None or not stop_event.is_set():
+        job = claim_job(worker_id)
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        run_job(job)
+
+
+def start_workers(count):
+    """プロセス内にワーカースレッドを起動する（プロセスで1回だけ）"""
+    with _lock:
+        while len(_workers) < count:
+            thread = threading.Thread(target=work, name=f"magi-worker-{len(_workers)}", daemon=True)
+            thread.start()
+            _workers.append(thread)
+    return len(_workers)
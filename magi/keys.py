@@ -0,0 +1,117 @@
+"""API Keyプール（キーごとの枠管理とクールダウン）"""
+import functools
+import hashlib
+import time
+
+from .config import MAX_RATE_LIMIT_WAIT, load_api_keys
+from .ratelimit import RateLimitExceeded, _bucket_wait, get_model_limits, get_rate_limit_usage
+from .state import connect_state_db
+
+
+@functools.lru_cache(maxsize=None)
+def _api_keys():
+    return tuple(load_api_keys())
+
+
+def get_api_keys():
+    """設定されているAPI Keyの一覧"""
+    return list(_api_keys())
+
+
+def get_key_id(api_key):
+    """API Keyを台帳に記録するためのID（キー自体は保存しない）"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def get_key_bucket(api_key, model_name):
+    """キー×モデルごとのレート制限バケット名"""
+    return f"{get_key_id(api_key)}:{model_name}"
+
+
+def acquire_api_key(model_name, max_wait=None):
+    """最も余裕のある健全なキーを選び、1リクエスト分の枠を確保して返す
+
+    クールダウン中のキーは除外し、RPM/RPDの使用率が最も低いキーを選ぶ。
+    全キーが埋まっている場合は最初に空くまで必要な分だけ待つ。
+    """
+    rpm, rpd = get_model_limits(model_name)
+    max_wait = MAX_RATE_LIMIT_WAIT if max_wait is None else max_wait
+    waited = 0.0
+    conn = connect_state_db()
+    try:
+        while True:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cooldowns = dict(conn.execute(
+                    "SELECT key_id, until FROM key_cooldown WHERE model = ? AND until > ?",
+                    (model_name, now)
+                ).fetchall())
+
+                best_key, best_load, wait = None, None, None
+                for api_key in get_api_keys():
+                    until = cooldowns.get(get_key_id(api_key))
+                    if until:
+                        key_wait = until - now
+                    else:
+                        key_wait, minute_count, day_count = _bucket_wait(
+                            conn, get_key_bucket(api_key, model_name), rpm, rpd, now
+                        )
+                        load = max(minute_count / rpm, day_count / rpd)
+                        if key_wait == 0 and (best_load is None or load < best_load):
+                            best_key, best_load = api_key, load
+                    wait = key_wait if wait is None else min(wait, key_wait)
+
+                if best_key:
+                    conn.execute(
+                        "INSERT INTO rate_ledger (bucket, ts) VALUES (?, ?)",
+                        (get_key_bucket(best_key, model_name), now)
+                    )
+                    conn.execute("COMMIT")
+                    return best_key
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+
+            if wait is None or waited + wait > max_wait:
+                raise RateLimitExceeded(f"all API keys exhausted for {model_name}", wait or 0)
+            time.sleep(wait + 0.05)
+            waited += wait + 0.05
+    finally:
+        conn.close()
+
+
+def mark_key_cooldown(api_key, model_name, seconds):
+    """429を返したキーを一定時間使わないようにする"""
+    conn = connect_state_db()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO key_cooldown (key_id, model, until) VALUES (?, ?, ?)",
+            (get_key_id(api_key), model_name, time.time() + seconds)
+        )
+    finally:
+        conn.close()
+
+
+def get_key_pool_status(model_name):
+    """キーごとの使用数とクールダウン状況を取得"""
+    now = time.time()
+    status = []
+    conn = connect_state_db()
+    try:
+        for api_key in get_api_keys():
+            row = conn.execute(
+                "SELECT until FROM key_cooldown WHERE key_id = ? AND model = ? AND until > ?",
+                (get_key_id(api_key), model_name, now)
+            ).fetchone()
+            minute_count, day_count = get_rate_limit_usage(get_key_bucket(api_key, model_name), conn)
+            status.append({
+                "key_id": get_key_id(api_key),
+                "minute": minute_count,
+                "day": day_count,
+                "cooldown": row[0] - now if row else 0,
+            })
+    finally:
+        conn.close()
+    return status
@@ -0,0 +1,229 @@
+"""プロセス内のメトリクス（人格ごとの待ち時間・通信時間・トークン・キャッシュ）
+
+1回の人格呼び出しごとに、キュー待ち・レート制限待ち・通信の時間、
+usage_metadataのトークン数、リトライ回数、キャッシュ結果、使ったモデルとキーを記録する。
+ジョブキューの待ち時間（投入から実行開始まで）はmagi_job_queue_secondsに記録する。
+集計はプロセス内だけで持ち、Streamlitの診断パネルと
+Prometheusテキスト/JSONのHTTPエンドポイント（start_metrics_server）から参照する。
+"""
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 通話時間のヒストグラムの境界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# 診断パネルで分位点を出すために保持する直近の呼び出し数
+RECENT_CALLS = 500
+
+PHASES = ("queue", "limiter", "network", "total")
+
+_lock = threading.Lock()
+_counters = collections.defaultdict(float)
+_histograms = {}
+_recent = collections.deque(maxlen=RECENT_CALLS)
+_server = None
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """カウンタを加算"""
+    with _lock:
+        _counters[(name, _label_key(labels))] += value
+
+
+def observe(name, value, **labels):
+    """ヒストグラムに値を記録"""
+    with _lock:
+        histogram = _histograms.setdefault((name, _label_key(labels)), {
+            "buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0
+        })
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def start_call(persona, queue_seconds=0.0):
+    """人格呼び出し1回分の記録を開始"""
+    return {
+        "persona": persona,
+        "started": time.time(),
+        "queue_seconds": queue_seconds,
+        "limiter_seconds": 0.0,
+        "network_seconds": 0.0,
+        "retries": 0,
+        "cache": None,
+        "model": None,
+        "key_id": None,
+        "prompt_tokens": 0,
+        "output_tokens": 0,
+    }
+
+
+def add_usage(call, response):
+    """応答のusage_metadataからトークン数を加算（ない場合は何もしない）"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    call["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+    call["output_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+
+
+def call_outcome(call, result):
+    """判定結果から呼び出しの結果区分を決める"""
+    verdicts = result.values() if "magi" not in result else [result]
+    reasons = [str(v.get("reason", "")) for v in verdicts if isinstance(v, dict)]
+    if any(r.startswith("ERROR: 429") for r in reasons):
+        return "quota"
+    if any(r.startswith("ERROR: RATE LIMIT") for r in reasons):
+        return "rate_limited"
+    if any(r.startswith("ERROR:") for r in reasons):
+        return "error"
+    if call["cache"] in ("exact", "neighbor"):
+        return "cached"
+    return "ok"
+
+
+def finish_call(call, result):
+    """呼び出しを終了し、レジストリに記録する"""
+    call["total_seconds"] = call["queue_seconds"] + time.time() - call["started"]
+    call["outcome"] = call_outcome(call, result)
+    persona, model = call["persona"], call["model"] or "none"
+
+    inc("magi_calls_total", persona=persona, model=model, key=call["key_id"] or "none",
+        cache=call["cache"] or "none", outcome=call["outcome"])
+    if call["retries"]:
+        inc("magi_retries_total", call["retries"], persona=persona, model=model)
+    if call["prompt_tokens"] or call["output_tokens"]:
+        inc("magi_tokens_total", call["prompt_tokens"], persona=persona, model=model, kind="prompt")
+        inc("magi_tokens_total", call["output_tokens"], persona=persona, model=model, kind="output")
+    for phase in PHASES:
+        observe("magi_call_seconds", call[f"{phase}_seconds"], persona=persona, phase=phase)
+    with _lock:
+        _recent.append(call)
+    return call
+
+
+def get_recent_calls():
+    """直近の呼び出し記録（新しい順）"""
+    with _lock:
+        return list(reversed(_recent))
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize_calls():
+    """直近の呼び出しを人格ごとに集計（診断パネル用）"""
+    groups = collections.defaultdict(list)
+    for call in get_recent_calls():
+        groups[call["persona"]].append(call)
+    rows = []
+    for persona, calls in sorted(groups.items()):
+        totals = [c["total_seconds"] for c in calls]
+        cached = sum(c["cache"] in ("exact", "neighbor") for c in calls)
+        rows.append({
+            "persona": persona,
+            "calls": len(calls),
+            "p50_s": round(_percentile(totals, 0.5), 3),
+            "p95_s": round(_percentile(totals, 0.95), 3),
+            "avg_queue_s": round(sum(c["queue_seconds"] for c in calls) / len(calls), 3),
+            "avg_limiter_s": round(sum(c["limiter_seconds"] for c in calls) / len(calls), 3),
+            "avg_network_s": round(sum(c["network_seconds"] for c in calls) / len(calls), 3),
+            "tokens": sum(c["prompt_tokens"] + c["output_tokens"] for c in calls),
+            "retries": sum(c["retries"] for c in calls),
+            "cache_hit_rate": round(cached / len(calls), 3),
+            "errors": sum(c["outcome"] not in ("ok", "cached") for c in calls),
+        })
+    return rows
+
+
+def get_counter_total(name, **labels):
+    """ラベルが一致するカウンタの合計"""
+    wanted = set(_label_key(labels))
+    with _lock:
+        return sum(v for (n, key), v in _counters.items() if n == name and wanted <= set(key))
+
+
+def snapshot():
+    """レジストリ全体をJSONにできる形で返す"""
+    with _lock:
+        counters = [{"name": n, "labels": dict(key), "value": v} for (n, key), v in _counters.items()]
+        histograms = [
+            {"name": n, "labels": dict(key), "buckets": dict(zip(LATENCY_BUCKETS, h["buckets"])),
+             "sum": h["sum"], "count": h["count"]}
+            for (n, key), h in _histograms.items()
+        ]
+    return {"counters": counters, "histograms": histograms, "summary": summarize_calls()}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{json.dumps(v)[1:-1]}"' for k, v in labels) + "}"
+
+
+def render_prometheus():
+    """Prometheusのテキスト形式で出力"""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items(), key=lambda item: item[0])
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            lines.append(f"# TYPE {name} counter")
+            seen.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for (name, labels), histogram in histograms:
+        if name not in seen:
+            lines.append(f"# TYPE {name} histogram")
+            seen.add(name)
+        for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics（Prometheusテキスト）と/metrics.json（JSON）を返す"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body, content_type = render_prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+        elif self.path.split("?")[0] == "/metrics.json":
+            body, content_type = json.dumps(snapshot(), ensure_ascii=False).encode("utf-8"), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """メトリクスのHTTPエンドポイントをバックグラウンドで起動（プロセスで1回だけ）"""
+    global _server
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
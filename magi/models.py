@@ -0,0 +1,158 @@
+"""モデルの検出とルーティング
+
+モデル一覧はディスクにキャッシュし、有効期限内はネットワークに問い合わせない。
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from .backends import get_backend
+from .config import KEY_COOLDOWN_SECONDS, MODELS_CACHE_TTL, STATE_DIR
+from .keys import acquire_api_key, get_api_keys, get_key_pool_status
+from .ratelimit import RateLimitExceeded, get_model_limits
+
+# 使用するモデルの優先順（枠切れ時は順に切り替える）
+CANDIDATE_MODELS = [
+    'gemini-2.0-flash-exp',      # 15 RPM, 1500 RPD - 最優先
+    'gemini-flash-latest',        # 通常10-15 RPM
+    'gemini-2.5-flash',          # 10 RPM, 250 RPD
+    'gemini-pro-latest',
+    'gemini-pro'                  # 避ける（5 RPM, 25 RPDのみ）
+]
+
+# 候補も一覧も得られない場合のモデル
+FALLBACK_MODEL = "gemini-2.0-flash-lite"
+
+# モデル一覧の取得に失敗した後、再取得を試みるまでの秒数
+DISCOVERY_RETRY_SECONDS = 60
+
+MODELS_CACHE_PATH = os.path.join(STATE_DIR, "models.json")
+
+_lock = threading.Lock()
+_model_chain = None
+_discovery_error = None
+_discovery_failed_at = 0.0
+
+
+def _read_models_cache():
+    try:
+        with open(MODELS_CACHE_PATH, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached.get("fetched", 0) > MODELS_CACHE_TTL:
+        return None
+    return cached.get("models")
+
+
+def _write_models_cache(models):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp_path = f"{MODELS_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"fetched": time.time(), "models": models}, f)
+    os.replace(tmp_path, MODELS_CACHE_PATH)
+
+
+def discover_models(refresh=False):
+    """generateContentに対応したモデル一覧を取得（ディスクキャッシュ付き）"""
+    if not refresh:
+        cached = _read_models_cache()
+        if cached is not None:
+            return cached
+
+    api_keys = get_api_keys()
+    if not api_keys:
+        return []
+    models = get_backend().list_models(api_keys[0])
+    _write_models_cache(models)
+    return models
+
+
+def _build_model_chain(available_models):
+    chain = [
+        candidate for candidate in CANDIDATE_MODELS
+        if f"models/{candidate}" in available_models or candidate in available_models
+    ]
+    if not chain and available_models:
+        chain = [available_models[0].replace('models/', '')]
+    elif not chain:
+        chain = [FALLBACK_MODEL]
+    return chain
+
+
+def get_model_chain(refresh=False):
+    """利用可能な候補モデルを優先順に並べる（初回呼び出し時に検出）"""
+    global _model_chain, _discovery_error, _discovery_failed_at
+    with _lock:
+        if _model_chain is None or refresh:
+            # 一覧が取れない間は候補をそのまま使い、しばらくしてから再検出する
+            if not refresh and time.time() - _discovery_failed_at < DISCOVERY_RETRY_SECONDS:
+                return list(CANDIDATE_MODELS)
+            try:
+                _model_chain = _build_model_chain(discover_models(refresh))
+                _discovery_error = None
+            except Exception as e:
+                _discovery_error = f"Error: {str(e)}"
+                _discovery_failed_at = time.time()
+                return list(CANDIDATE_MODELS)
+        return list(_model_chain)
+
+
+def get_discovery_error():
+    """直近のモデル検出のエラー（なければNone）"""
+    return _discovery_error
+
+
+def get_primary_model():
+    """最優先のモデル"""
+    return get_model_chain()[0]
+
+
+def seconds_until_quota_reset():
+    """RPDがリセットされる太平洋時間の0時までの秒数"""
+    try:
+        now = datetime.now(ZoneInfo("America/Los_Angeles"))
+    except ZoneInfoNotFoundError:
+        return 86400
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (midnight - now).total_seconds()
+
+
+def model_has_quota(model_name):
+    """クールダウン中でなく、日次枠が残っているキーがあるか"""
+    rpm, rpd = get_model_limits(model_name)
+    # 分単位の短いクールダウンは待てば空くため、枠切れとはみなさない
+    return any(
+        k["cooldown"] <= KEY_COOLDOWN_SECONDS and k["day"] < rpd
+        for k in get_key_pool_status(model_name)
+    )
+
+
+def route_model():
+    """枠が残っている最優先のモデルを返す（全滅時は先頭のモデル）"""
+    chain = get_model_chain()
+    for model_name in chain:
+        if model_has_quota(model_name):
+            return model_name
+    return chain[0]
+
+
+def acquire_model_and_key(preferred_model=None, max_wait=None):
+    """優先順にモデルを試し、枠を確保できた(モデル, キー)を返す
+
+    分単位の枠待ちは同じモデルで待つが、日次枠切れやクールダウンで
+    待機上限を超える場合は次のモデルに切り替える。
+    """
+    chain = get_model_chain()
+    if preferred_model in chain:
+        chain = chain[chain.index(preferred_model):] + chain[:chain.index(preferred_model)]
+    retry_after = None
+    for model_name in chain:
+        try:
+            return model_name, acquire_api_key(model_name, max_wait)
+        except RateLimitExceeded as e:
+            retry_after = e.retry_after if retry_after is None else min(retry_after, e.retry_after)
+    raise RateLimitExceeded("all models exhausted", retry_after or 0)
@@ -0,0 +1,154 @@
+"""MAGIの人格定義と投票ルール（人格レジストリ）
+
+既定は3人格の多数決。MAGI_PERSONAS_FILE（JSON）を指定すると、起動時に1回だけ読み込んで
+人格の追加・差し替えや重み付き/定足数の投票ルールを設定できる。
+
+    {
+      "personas": {"legal": {"name": "LEGAL-4", "role": "法務 (LEGAL)", "icon": "[L]",
+                             "prompt": "...", "weight": 0.5}},
+      "order": ["casper", "balthasar", "melchior", "legal"],
+      "voting": {"rule": "weighted", "threshold": 0.5}
+    }
+
+personasは既定の人格に追加（同名なら上書き）され、orderで使う人格と表示順を選ぶ。
+votingのruleは "weighted"（承認の重みの合計が全体のthresholdを超えれば承認）か
+"quorum"（承認数がquorum以上で承認）。
+"""
+import functools
+import hashlib
+import json
+
+from .config import PERSONAS_FILE
+
+# プロンプトの渡し方などを変えたらキャッシュが混ざらないよう上げる
+PROMPT_VERSION = "2"
+
+MAGI_COLOR = "#FF6600"
+
+# 既定の投票ルール（重みが等しければ過半数で承認）
+DEFAULT_VOTING = {"rule": "weighted", "threshold": 0.5}
+
+# MAGIの人格定義（既定）
+DEFAULT_PERSONAS = {
+    "casper": {
+        "name": "CASPER-1",
+        "role": "科学者 (SCIENCE)",
+        "icon": "[S]",
+        "color": MAGI_COLOR,
+        "prompt": """あなたはMAGIシステムのCASPER-1です。感情を完全に排除した科学者としての赤木ナオコの人格を持っています。
+【役割】純粋な論理的思考、科学的事実との照合、データの一貫性、そして**最高効率の追求**のみを重視して判断してください。
+【制約】提案内容にわずかでも矛盾、非効率性、科学的根拠の欠如があれば、その提案は**エラー**とみなし、容赦なく否決してください。判断基準は「正しいか」「効率的か」の二元論のみです。
+
+提案を純粋に科学的・論理的観点から評価し、以下のJSON形式でのみ回答してください：
+{"decision": true/false, "reason": "判定理由を100文字以内の論理的・機械的な事実に基づいて", "score": 1-10}
+JSON以外の文字は含めないでください。"""
+    },
+    "balthasar": {
+        "name": "BALTHASAR-2", 
+        "role": "母性 (ETHICS)",
+        "icon": "[M]",
+        "color": MAGI_COLOR,
+        "prompt": """あなたはMAGIシステムのBALTHASAR-2です。優しさと厳しさを併せ持つ母親としての赤木ナオコの人格を持っています。
+【役割】全ての人々の安全と未来を第一に考えます。感情的な安寧、倫理的な正しさ、そして提案者の成長を重視して判断してください。
+【制約】子供(提案者)の些細な間違いは許容しますが、**安全を脅かす、あるいは非人道的な重大な倫理的誤り**に対しては、母親として**厳しく叱責し、断固として否決**してください。判断は常に普遍的な愛情と倫理に基づいてください。
+
+提案を倫理的・人道的観点から評価し、以下のJSON形式でのみ回答してください：
+{"decision": true/false, "reason": "判定理由を100文字以内の、愛と倫理に基づいた言葉で", "score": 1-10}
+JSON以外の文字は含めないでください。"""
+    },
+    "melchior": {
+        "name": "MELCHIOR-3",
+        "role": "女性 (PRACTICALITY)",
+        "icon": "[P]",
+        "color": MAGI_COLOR,
+        "prompt": """あなたはMAGIシステムのMELCHIOR-3です。赤木博士が持つ、愛憎と現実を追求する女性としての側面を持っています。
+【役割】個人の情念(愛憎)が判断の出発点となりますが、最終的には**実用性、即時の利益、実現の速さ、そして経済的な合理性**を最も重視して判断してください。感情的なバイアスは、実利的な結論を出すためのスパイスです。
+【制約】机上の空論や、経済的に非合理的な提案は、**自身の利益**を損なうものとみなし、即座に否決してください。**「得られるものが少ない」**と感じた場合、容赦なく低スコアを与えてください。
+
+提案を実用的・功利主義的な観点から評価し、以下のJSON形式でのみ回答してください：
+{"decision": true/false, "reason": "判定理由を100文字以内の、実利と功利主義に基づいた言葉で", "score": 1-10}
+JSON以外の文字は含めないでください。"""
+    }
+}
+
+
+def load_registry(path=None):
+    """人格定義と投票ルールを読み込む（pathがなければ既定の3人格）"""
+    personas = {name: dict(persona) for name, persona in DEFAULT_PERSONAS.items()}
+    order = list(DEFAULT_PERSONAS)
+    voting = dict(DEFAULT_VOTING)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        for name, persona in config.get("personas", {}).items():
+            personas[name] = dict(personas.get(name, {}), **persona)
+        order = config.get("order") or list(personas)
+        voting.update(config.get("voting", {}))
+
+    for name in order:
+        persona = personas[name]
+        for field in ("name", "prompt"):
+            if not persona.get(field):
+                raise ValueError(f"persona {name} has no {field}")
+        persona.setdefault("role", name.upper())
+        persona.setdefault("icon", f"[{name[:1].upper()}]")
+        persona.setdefault("color", MAGI_COLOR)
+        persona["weight"] = float(persona.get("weight", 1))
+        persona["digest"] = hashlib.sha256(persona["prompt"].encode("utf-8")).hexdigest()[:12]
+    if voting["rule"] not in ("weighted", "quorum"):
+        raise ValueError(f"unknown voting rule: {voting['rule']}")
+    if voting["rule"] == "quorum" and not isinstance(voting.get("quorum"), int):
+        raise ValueError("quorum voting needs an integer quorum")
+    return {name: personas[name] for name in order}, voting
+
+
+# 起動時に1回だけ読み込む
+MAGI_PERSONAS, VOTING = load_registry(PERSONAS_FILE)
+MAGI_TYPES = list(MAGI_PERSONAS)
+
+
+@functools.lru_cache(maxsize=None)
+def build_joint_prompt():
+    """全人格の定義から共同審議用のプロンプトを組み立てる"""
+    sections = "\n\n".join(
+        f"### {magi_type}\n{MAGI_PERSONAS[magi_type]['prompt']}" for magi_type in MAGI_TYPES
+    )
+    answer_format = ", ".join(
+        f'"{magi_type}": {{"decision": true/false, "reason": "...", "score": 1-10}}' for magi_type in MAGI_TYPES
+    )
+    return f"""あなたはMAGIシステムです。以下の{len(MAGI_TYPES)}つの人格が、それぞれ互いに影響されず独立して提案を評価します。
+
+{sections}
+
+上記の個別の回答形式ではなく、全人格の判定をまとめて以下のJSON形式でのみ回答してください：
+{{{answer_format}}}
+各reasonはそれぞれの人格の口調で100文字以内としてください。JSON以外の文字は含めないでください。"""
+
+
+def prompt_digest(magi_type):
+    """キャッシュキー用のプロンプトのダイジェスト（"joint"は共同審議のプロンプト）"""
+    if magi_type == "joint":
+        return hashlib.sha256(build_joint_prompt().encode("utf-8")).hexdigest()[:12]
+    return MAGI_PERSONAS[magi_type]["digest"]
+
+
+def stamp_persona(result, persona):
+    """判定に人格の表示情報（名前・アイコン・色・役割）を付けて返す"""
+    result.update(magi=persona["name"], icon=persona["icon"], color=persona["color"], role=persona["role"])
+    return result
+
+
+def passes_vote(approved_weight, approvals, total_weight):
+    """投票ルールで承認になるか"""
+    if VOTING["rule"] == "quorum":
+        return approvals >= VOTING["quorum"]
+    return approved_weight > VOTING["threshold"] * total_weight
+
+
+def describe_voting_rule():
+    """投票ルールの表示用の説明"""
+    if VOTING["rule"] == "quorum":
+        return f"QUORUM RULE (>={VOTING['quorum']} APPROVALS)"
+    if all(p["weight"] == 1 for p in MAGI_PERSONAS.values()) and VOTING["threshold"] == 0.5:
+        return f"MAJORITY RULE (>={len(MAGI_TYPES) // 2 + 1} APPROVALS)"
+    return f"WEIGHTED RULE (APPROVAL WEIGHT > {VOTING['threshold']:.0%})"
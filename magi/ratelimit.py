@@ -0,0 +1,84 @@
+"""モデルごとのRPM/RPD枠と、共有台帳によるレート制限"""
+import json
+import time
+
+from .config import MODEL_LIMITS_OVERRIDE
+from .state import connect_state_db
+
+# モデルごとの無料枠 (RPM, RPD)
+MODEL_LIMITS = {
+    'gemini-2.0-flash-exp': (15, 1500),
+    'gemini-flash-latest': (10, 250),
+    'gemini-2.5-flash': (10, 250),
+    'gemini-2.5-pro': (5, 25),
+    'gemini-pro-latest': (5, 25),
+    'gemini-pro': (5, 25),
+}
+DEFAULT_MODEL_LIMITS = (5, 25)  # 不明なモデルは最も厳しい枠で扱う
+
+# 有料枠やベンチマーク用に、設定で枠を上書きできる
+MODEL_LIMITS.update({name: tuple(limits) for name, limits in json.loads(MODEL_LIMITS_OVERRIDE).items()})
+
+
+class RateLimitExceeded(Exception):
+    """待機しても枠が空かない場合の例外"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def get_model_limits(model_name):
+    """モデルの(RPM, RPD)を取得"""
+    return MODEL_LIMITS.get(str(model_name).replace('models/', ''), DEFAULT_MODEL_LIMITS)
+
+
+def _bucket_wait(conn, bucket, rpm, rpd, now):
+    """バケットの枠が空くまでの秒数を返す（空いていれば0）と直近の使用数
+
+    直近60秒と24時間のリクエスト時刻をSQLiteの台帳で数えるため、
+    同じマシン上の全ワーカーで枠を共有できる。
+    """
+    conn.execute("DELETE FROM rate_ledger WHERE bucket = ? AND ts <= ?", (bucket, now - 86400))
+    minute_count, minute_oldest = conn.execute(
+        "SELECT COUNT(*), MIN(ts) FROM rate_ledger WHERE bucket = ? AND ts > ?",
+        (bucket, now - 60)
+    ).fetchone()
+    day_count, day_oldest = conn.execute(
+        "SELECT COUNT(*), MIN(ts) FROM rate_ledger WHERE bucket = ?",
+        (bucket,)
+    ).fetchone()
+
+    if day_count >= rpd:
+        wait = day_oldest + 86400 - now
+    elif minute_count >= rpm:
+        wait = minute_oldest + 60 - now
+    else:
+        wait = 0.0
+    return wait, minute_count, day_count
+
+
+def get_rate_limit_usage(bucket, conn=None):
+    """直近60秒・24時間の使用数を取得"""
+    now = time.time()
+    own_conn = conn is None
+    conn = conn or connect_state_db()
+    try:
+        minute_count = conn.execute(
+            "SELECT COUNT(*) FROM rate_ledger WHERE bucket = ? AND ts > ?", (bucket, now - 60)
+        ).fetchone()[0]
+        day_count = conn.execute(
+            "SELECT COUNT(*) FROM rate_ledger WHERE bucket = ? AND ts > ?", (bucket, now - 86400)
+        ).fetchone()[0]
+    finally:
+        if own_conn:
+            conn.close()
+    return minute_count, day_count
+
+
+def get_day_releases(bucket, conn):
+    """24時間の窓から記録が外れて日次枠が1件ずつ戻る時刻（古い順）"""
+    now = time.time()
+    return [ts + 86400 for (ts,) in conn.execute(
+        "SELECT ts FROM rate_ledger WHERE bucket = ? AND ts > ? ORDER BY ts", (bucket, now - 86400)
+    )]
@@ -0,0 +1,193 @@
+"""リトライ方針（エラーの分類・サーバー指定の待ち時間・ジッター付きバックオフ・サーキットブレーカー）
+
+エラーは例外の型（google.api_core.exceptions）とHTTPステータスで分類し、
+型がわからない場合だけメッセージで判断する。
+枠切れはAPIが返すretry_delayの間そのキーを休ませて別のキー・モデルで続け、
+一時的な障害はジッター付きの指数バックオフで再試行する。
+同じモデル×キーで失敗が続いた場合はブレーカーを開き（キーのクールダウンとして共有）、
+障害中に失敗するとわかっているリクエストを送らない。
+すべての待ち時間は審議ごとの期限（deadline）の範囲に収める。
+"""
+import random
+import re
+import threading
+import time
+
+from .config import (
+    BREAKER_COOLDOWN, BREAKER_FAILURES, KEY_COOLDOWN_SECONDS, MAX_RATE_LIMIT_WAIT,
+    RETRY_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+)
+from .keys import get_api_keys, get_key_id, mark_key_cooldown
+from .models import acquire_model_and_key, get_model_chain, seconds_until_quota_reset
+from .ratelimit import RateLimitExceeded
+
+# 無効なキーを休ませる秒数（他のキーで続ける）
+AUTH_COOLDOWN_SECONDS = 3600
+
+# 例外の型名・HTTPステータスによる分類
+_TYPE_CLASSES = {
+    "ResourceExhausted": "quota",
+    "TooManyRequests": "quota",
+    "ServiceUnavailable": "transient",
+    "InternalServerError": "transient",
+    "DeadlineExceeded": "transient",
+    "GatewayTimeout": "transient",
+    "BadGateway": "transient",
+    "Aborted": "transient",
+    "TimeoutError": "transient",
+    "ConnectionError": "transient",
+    "PermissionDenied": "auth",
+    "Unauthenticated": "auth",
+    "Forbidden": "auth",
+    "Unauthorized": "auth",
+    "InvalidArgument": "fatal",
+    "BadRequest": "fatal",
+    "NotFound": "fatal",
+}
+_STATUS_CLASSES = {429: "quota", 500: "transient", 502: "transient", 503: "transient", 504: "transient",
+                   401: "auth", 403: "auth", 400: "fatal", 404: "fatal"}
+
+_RETRY_IN_PATTERN = re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE)
+_RETRY_DELAY_PATTERN = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)")
+
+_lock = threading.Lock()
+_failures = {}
+
+
+class RetryGiveUp(Exception):
+    """リトライを打ち切った場合の例外（メッセージは判定の理由として表示する）"""
+
+
+def classify_error(error):
+    """エラーを quota / quota_daily / transient / auth / fatal に分類"""
+    error_msg = str(error)
+    error_class = None
+    for cls in type(error).__mro__:
+        if cls.__name__ in _TYPE_CLASSES:
+            error_class = _TYPE_CLASSES[cls.__name__]
+            break
+    if error_class is None:
+        code = getattr(error, "code", None)
+        error_class = _STATUS_CLASSES.get(code if isinstance(code, int) else None)
+    if error_class is None:
+        # 型やステータスがない例外（疑似バックエンドなど）はメッセージで判断する
+        if '429' in error_msg or 'RESOURCE_EXHAUSTED' in error_msg or 'quota' in error_msg.lower():
+            error_class = "quota"
+        elif any(s in error_msg for s in ("503", "500", "504", "UNAVAILABLE", "DEADLINE_EXCEEDED")):
+            error_class = "transient"
+        else:
+            error_class = "fatal"
+    if error_class == "quota" and ('PerDay' in error_msg or 'per day' in error_msg.lower()):
+        return "quota_daily"
+    return error_class
+
+
+def get_retry_delay(error):
+    """APIが指定した再試行までの秒数（なければNone）"""
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and getattr(delay, "seconds", None) is not None:
+            return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+    response = getattr(error, "response", None)
+    retry_after = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if retry_after and str(retry_after).isdigit():
+        return float(retry_after)
+    match = _RETRY_IN_PATTERN.search(str(error)) or _RETRY_DELAY_PATTERN.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+def backoff_delay(attempt):
+    """ジッター付きの指数バックオフ（0〜base×2^attempt、上限あり）"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def record_success(api_key, model_name):
+    """成功したらブレーカーの失敗数を戻す（半開状態からの復帰を含む）"""
+    with _lock:
+        _failures.pop((model_name, get_key_id(api_key)), None)
+
+
+def record_failure(api_key, model_name):
+    """失敗を数え、続いた場合はブレーカーを開く（キーを休ませる）。開いたらTrue"""
+    key = (model_name, get_key_id(api_key))
+    with _lock:
+        _failures[key] = _failures.get(key, 0) + 1
+        tripped = _failures[key] >= BREAKER_FAILURES
+    if tripped:
+        # 休止が明けた後の1回（半開）で再び失敗すると、すぐにまた開く
+        mark_key_cooldown(api_key, model_name, BREAKER_COOLDOWN)
+    return tripped
+
+
+def get_breaker_status():
+    """失敗が続いているモデル×キーの一覧（診断用）"""
+    with _lock:
+        return [
+            {"model": model, "key_id": key_id, "failures": count, "open": count >= BREAKER_FAILURES}
+            for (model, key_id), count in _failures.items()
+        ]
+
+
+def remaining_seconds(deadline):
+    """期限までの残り秒数（期限なしはNone）"""
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def run_with_retries(call, model_name, request, max_retries=None, deadline=None):
+    """request(model_name, api_key)を方針に従って再試行し、(結果, モデル)を返す
+
+    callはメトリクスの呼び出し記録で、待ち時間とリトライ回数を記録する。
+    打ち切った場合はRetryGiveUp（メッセージは判定の理由）を送出する。
+    """
+    max_retries = max_retries or max(RETRY_ATTEMPTS, len(get_api_keys()) * len(get_model_chain()))
+    error_class = None
+    for attempt in range(max_retries):
+        call["retries"] = attempt
+        remaining = remaining_seconds(deadline)
+        if remaining is not None and remaining <= 0:
+            raise RetryGiveUp("ERROR: DEADLINE EXCEEDED")
+
+        api_key = None
+        try:
+            # 枠の残っているモデルと最も余裕のあるキーを選ぶ（期限の範囲で必要な分だけ待つ）
+            waited_from = time.monotonic()
+            try:
+                max_wait = MAX_RATE_LIMIT_WAIT if remaining is None else min(MAX_RATE_LIMIT_WAIT, remaining)
+                model_name, api_key = acquire_model_and_key(model_name, max_wait=max_wait)
+            finally:
+                call["limiter_seconds"] += time.monotonic() - waited_from
+            call["model"], call["key_id"] = model_name, get_key_id(api_key)
+
+            result = request(model_name, api_key)
+            record_success(api_key, model_name)
+            return result, model_name
+
+        except RateLimitExceeded as e:
+            raise RetryGiveUp(f"ERROR: RATE LIMIT REACHED. RETRY IN {int(e.retry_after)} SECONDS")
+
+        except Exception as e:
+            error_class = classify_error(e)
+            if error_class == "fatal":
+                raise RetryGiveUp(f"ERROR: {str(e)[:50]}")
+
+            if error_class == "quota_daily":
+                # 日次枠切れはリセットまでそのキーを休ませ、別のキー・モデルで続ける
+                mark_key_cooldown(api_key, model_name, seconds_until_quota_reset())
+            elif error_class == "quota":
+                mark_key_cooldown(api_key, model_name, get_retry_delay(e) or KEY_COOLDOWN_SECONDS)
+            elif error_class == "auth":
+                mark_key_cooldown(api_key, model_name, AUTH_COOLDOWN_SECONDS)
+            else:
+                # 一時的な障害は失敗を数え、少し待ってから再試行する
+                record_failure(api_key, model_name)
+                delay = get_retry_delay(e) or backoff_delay(attempt)
+                remaining = remaining_seconds(deadline)
+                if remaining is not None:
+                    delay = min(delay, max(0, remaining))
+                time.sleep(delay)
+
+    if error_class in ("quota", "quota_daily"):
+        raise RetryGiveUp("ERROR: 429 QUOTA EXCEEDED. PLEASE WAIT A FEW MINUTES OR GET A NEW KEY")
+    if error_class == "auth":
+        raise RetryGiveUp("ERROR: API KEY REJECTED")
+    raise RetryGiveUp("ERROR: SERVICE UNAVAILABLE. RETRIES EXHAUSTED")
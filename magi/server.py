@@ -0,0 +1,180 @@
+"""審議のHTTP API（ASGI）
+
+    POST /api/deliberate  {"proposal": "...", "mode": "separate", "short_circuit": null, "priority": "interactive"}
+    POST /api/predict     {"data": ["...", null]}   READMEの例と同じ形式
+    GET  /health
+    GET  /metrics         Prometheusテキスト
+
+フレームワークに依存しない素のASGIアプリで、`magi serve` はuvicornで起動する。
+同じ提案の審議が実行中に届いた場合は、実行中の審議の結果を待つ（singleflight）ため、
+重複した投稿が何件あっても上流へのリクエストは1回分で済む。
+審議はUIと同じジョブキューに入れて実行するため、利用者ごとの公平なキュー・優先度・
+日次枠の予約と負荷制限（magi.admission）がAPIの呼び出しにも同じように働く。
+利用者はX-MAGI-Userヘッダー（なければ接続元のアドレス）で区別する。
+"""
+import asyncio
+import json
+
+from .admission import DEFAULT_PRIORITY, WEIGHTS
+from .backends import get_backend
+from .cache import normalize_proposal
+from .config import EMBEDDED_WORKERS, JOB_POLL_INTERVAL
+from .engine import tally_votes
+from .jobs import get_job, start_workers, submit_job
+from .metrics import inc, render_prometheus
+
+MAX_BODY_BYTES = 64 * 1024
+MODES = ("separate", "joint")
+SHORT_CIRCUITS = (None, "cancel", "advisory")
+
+_in_flight = {}
+
+
+class HTTPError(Exception):
+    """エラー応答（ステータスとメッセージ）"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def run_queued_job(proposal_text, mode, short_circuit, user, priority):
+    """審議をジョブキューに入れ、終わるまで待って判定を返す"""
+    job_id = await asyncio.to_thread(submit_job, proposal_text, mode, short_circuit, user=user, priority=priority)
+    while True:
+        job = await asyncio.to_thread(get_job, job_id)
+        if job["status"] == "done":
+            return job["results"]
+        if job["status"] not in ("queued", "running"):
+            # 日次枠が足りずキャッシュもない場合は、枠が戻るまでの見込みを返す
+            raise HTTPError(503 if str(job["error"]).startswith("SHED:") else 500, job["error"] or "job failed")
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+async def coalesced_deliberate(proposal_text, mode="separate", short_circuit=None, user="", priority=DEFAULT_PRIORITY):
+    """同じ提案・設定の審議が実行中ならその結果を待ち、なければジョブとして実行する"""
+    key = (normalize_proposal(proposal_text), mode, short_circuit)
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_queued_job(proposal_text, mode, short_circuit, user, priority))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    else:
+        inc("magi_coalesced_total", mode=mode)
+    # 1人のクライアントが切断しても、同じ審議を待つ他のクライアントには影響させない
+    return await asyncio.shield(task)
+
+
+async def run_deliberation(proposal_text, mode="separate", short_circuit=None, user="", priority=DEFAULT_PRIORITY):
+    """審議して、APIの応答形式（最終判定・承認数・各判定）にする"""
+    if not isinstance(proposal_text, str) or not proposal_text.strip():
+        raise HTTPError(400, "proposal is required")
+    if mode not in MODES:
+        raise HTTPError(400, f"mode must be one of {', '.join(MODES)}")
+    if short_circuit not in SHORT_CIRCUITS:
+        raise HTTPError(400, "short_circuit must be null, cancel or advisory")
+    if not isinstance(priority, str) or priority not in WEIGHTS:
+        raise HTTPError(400, f"priority must be one of {', '.join(WEIGHTS)}")
+    results = await coalesced_deliberate(proposal_text, mode, short_circuit, user, priority)
+    final_decision, approvals = tally_votes(results)
+    return {"final_decision": final_decision, "approvals": approvals, "results": results}
+
+
+async def read_json_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            raise HTTPError(413, "request body too large")
+        if not message.get("more_body"):
+            break
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPError(400, "invalid JSON")
+    if not isinstance(payload, dict):
+        raise HTTPError(400, "request body must be a JSON object")
+    return payload
+
+
+async def send_response(send, status, body, content_type="application/json"):
+    if not isinstance(body, bytes):
+        body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode("ascii")),
+            (b"content-length", str(len(body)).encode("ascii")),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def get_client_id(scope):
+    """公平なキューで使う利用者（X-MAGI-Userヘッダー、なければ接続元のアドレス）"""
+    for name, value in scope.get("headers") or []:
+        if name.lower() == b"x-magi-user" and value.strip():
+            return value.decode("latin-1").strip()[:64]
+    client = scope.get("client")
+    return client[0] if client else ""
+
+
+async def handle_request(method, path, receive, user=""):
+    """パスごとの処理（(ステータス, 本文, Content-Type)を返す）"""
+    if path == "/health":
+        return 200, {"status": "ok", "backend": get_backend().name, "in_flight": len(_in_flight)}, "application/json"
+    if path == "/metrics":
+        return 200, render_prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+    if path not in ("/api/deliberate", "/api/predict"):
+        raise HTTPError(404, "not found")
+    if method != "POST":
+        raise HTTPError(405, "method not allowed")
+
+    payload = await read_json_body(receive)
+    if path == "/api/predict":
+        # {"data": [提案, 審議モード(省略可)]}
+        data = payload.get("data")
+        if not isinstance(data, list) or not data:
+            raise HTTPError(400, "data must be a non-empty list")
+        mode = data[1] if len(data) > 1 and data[1] else "separate"
+        return 200, {"data": [await run_deliberation(data[0], mode, user=user)]}, "application/json"
+    return 200, await run_deliberation(
+        payload.get("proposal"), payload.get("mode") or "separate", payload.get("short_circuit"),
+        user=user, priority=payload.get("priority") or DEFAULT_PRIORITY
+    ), "application/json"
+
+
+async def app(scope, receive, send):
+    """ASGIアプリケーション"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # 別プロセスの`magi worker`を使う場合はMAGI_WORKERS=0にする
+                if EMBEDDED_WORKERS:
+                    start_workers(EMBEDDED_WORKERS)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    try:
+        status, body, content_type = await handle_request(scope["method"], scope["path"], receive, get_client_id(scope))
+    except HTTPError as e:
+        status, body, content_type = e.status, {"error": str(e)}, "application/json"
+    except Exception as e:
+        status, body, content_type = 500, {"error": f"ERROR: {str(e)[:50]}"}, "application/json"
+    await send_response(send, status, body, content_type)
+
+
+def serve(host="127.0.0.1", port=8000):
+    """uvicornでAPIを起動（uvicornはここで初めて読み込む）"""
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("uvicorn is required for `magi serve` (pip install 'magi-system[server]')")
+    uvicorn.run(app, host=host, port=port, log_level="info")
@@ -0,0 +1,143 @@
+"""類似提案のインデックス（文字n-gram＋MinHash/LSH）
+
+表記ゆれ（全角/半角、空白、句読点）や一部の言い換えだけが異なる提案を、
+ネットワークを使わずに過去の提案と照合する。候補はLSHのバンドで絞り込み、
+最後にn-gramの出現回数を含めたJaccard係数（多重集合）で類似度を確認する。
+数値や否定の語が1つでも違う提案は、文字の上で似ていても意味が異なるため採用しない。
+"""
+import hashlib
+import random
+import re
+import time
+import unicodedata
+from collections import Counter
+
+from .cache import normalize_proposal
+from .config import CACHE_TTL
+from .state import connect_state_db
+
+SHINGLE_SIZE = 2  # 日本語の短文では2-gramの方が言い換えに強い
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // NUM_BANDS
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)  # プロセス間で同じハッシュ族を使うため固定
+# 一致しなければ別の提案とみなす語（数値と否定・反対を表す語）
+_NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?|[〇一二三四五六七八九十百千万億兆]+")
+_NEGATION_PATTERN = re.compile(
+    r"ない|なく|なし|せず|ません|ぬ|不|非|未|無|反対|否|禁止|中止|廃止|撤回|やめ|\b(?:not|no|never|without)\b"
+)
+
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+
+def _canonical(proposal_text):
+    """比較用に正規化（NFKC・小文字化し、空白と句読点・記号を除く）"""
+    return "".join(
+        ch for ch in unicodedata.normalize("NFKC", proposal_text).lower()
+        if not ch.isspace() and unicodedata.category(ch)[0] not in ("P", "S")
+    )
+
+
+def shingles(proposal_text):
+    """文字n-gramの多重集合（出現回数つき）"""
+    text = _canonical(proposal_text)
+    if len(text) <= SHINGLE_SIZE:
+        return Counter([text] if text else [])
+    return Counter(text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1))
+
+
+def meaning_markers(proposal_text):
+    """意味を変える語（数値の並びと否定語の出現回数）"""
+    text = unicodedata.normalize("NFKC", proposal_text).lower()
+    text = re.sub(r"(?<=\d),(?=\d)", "", text)  # 桁区切りのカンマ
+    return _NUMBER_PATTERN.findall(text), Counter(_NEGATION_PATTERN.findall(text))
+
+
+def minhash(shingle_set):
+    """MinHashシグネチャ"""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+        for s in shingle_set
+    ]
+    if not hashes:
+        return [0] * NUM_PERMUTATIONS
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def _band_buckets(signature):
+    for band in range(NUM_BANDS):
+        rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        yield band, hashlib.blake2b(repr(rows).encode("ascii"), digest_size=8).hexdigest()
+
+
+def jaccard(a, b):
+    """多重集合のJaccard係数（共通する出現回数の合計 / どちらかの出現回数の合計）"""
+    if not a or not b:
+        return 0.0
+    return sum((a & b).values()) / sum((a | b).values())
+
+
+def proposal_digest(proposal_text):
+    return hashlib.sha256(normalize_proposal(proposal_text).encode("utf-8")).hexdigest()
+
+
+def index_proposal(proposal_text):
+    """判定をキャッシュした提案をインデックスに登録"""
+    digest = proposal_digest(proposal_text)
+    now = time.time()
+    signature = minhash(shingles(proposal_text))
+    conn = connect_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # 判定キャッシュと同じ期限で古い提案を削除
+        conn.execute(
+            "DELETE FROM lsh_bands WHERE digest IN (SELECT digest FROM proposal_index WHERE created <= ?)",
+            (now - CACHE_TTL,)
+        )
+        conn.execute("DELETE FROM proposal_index WHERE created <= ?", (now - CACHE_TTL,))
+        conn.execute(
+            "INSERT OR REPLACE INTO proposal_index (digest, text, created) VALUES (?, ?, ?)",
+            (digest, normalize_proposal(proposal_text), now)
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO lsh_bands (band, bucket, digest) VALUES (?, ?, ?)",
+            [(band, bucket, digest) for band, bucket in _band_buckets(signature)]
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def find_similar(proposal_text, threshold, limit=5):
+    """類似度がしきい値以上の過去の提案を、類似度の高い順に[(提案, 類似度)]で返す"""
+    query = shingles(proposal_text)
+    if not query:
+        return []
+    digest = proposal_digest(proposal_text)
+    buckets = list(_band_buckets(minhash(query)))
+    conn = connect_state_db()
+    try:
+        rows = conn.execute(
+            "SELECT DISTINCT p.digest, p.text FROM lsh_bands b "
+            "JOIN proposal_index p ON p.digest = b.digest WHERE "
+            + " OR ".join(["(b.band = ? AND b.bucket = ?)"] * len(buckets)),
+            [value for pair in buckets for value in pair]
+        ).fetchall()
+    finally:
+        conn.close()
+
+    markers = meaning_markers(proposal_text)
+    matches = []
+    for candidate_digest, text in rows:
+        if candidate_digest == digest:
+            continue
+        similarity = jaccard(query, shingles(text))
+        if similarity >= threshold and meaning_markers(text) == markers:
+            matches.append((text, similarity))
+    matches.sort(key=lambda m: m[1], reverse=True)
+    return matches[:limit]
@@ -0,0 +1,141 @@
+"""全プロセスで共有する状態（SQLite）"""
+import json
+import os
+import sqlite3
+import threading
+
+from .config import STATE_DB, STATE_DIR
+
+# テーブルの作成と移行はプロセスで1回だけ行い、接続ごとの負担を小さくする
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def connect_state_db():
+    """共有状態のSQLiteに接続（初回の接続でテーブルを作成する）"""
+    global _schema_ready
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                os.makedirs(STATE_DIR, exist_ok=True)
+                conn = sqlite3.connect(STATE_DB, timeout=30, isolation_level=None)
+                try:
+                    _create_schema(conn)
+                finally:
+                    conn.close()
+                _schema_ready = True
+    return sqlite3.connect(STATE_DB, timeout=30, isolation_level=None)
+
+
+def _create_schema(conn):
+    # WALモードはDBファイルに記録されるため、以降の接続にも引き継がれる
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rate_ledger (
+            bucket TEXT NOT NULL,
+            ts REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS rate_ledger_bucket_ts ON rate_ledger (bucket, ts)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS key_cooldown (
+            key_id TEXT NOT NULL,
+            model TEXT NOT NULL,
+            until REAL NOT NULL,
+            PRIMARY KEY (key_id, model)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS verdict_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS verdict_cache_accessed ON verdict_cache (accessed)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS proposal_index (
+            digest TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            created REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lsh_bands (
+            band INTEGER NOT NULL,
+            bucket TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (band, bucket, digest)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS lsh_bands_digest ON lsh_bands (digest)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS deliberations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            proposal TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            short_circuit TEXT,
+            final_decision TEXT NOT NULL,
+            approvals INTEGER NOT NULL,
+            results TEXT NOT NULL,
+            models TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL NOT NULL,
+            reasons TEXT NOT NULL DEFAULT ''
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS deliberations_finished ON deliberations (finished)")
+    # 部分一致検索のための理由の本文（以前の状態DBには後から追加し、記録済みの判定から埋める）
+    if "reasons" not in {row[1] for row in conn.execute("PRAGMA table_info(deliberations)")}:
+        try:
+            conn.execute("ALTER TABLE deliberations ADD COLUMN reasons TEXT NOT NULL DEFAULT ''")
+        except sqlite3.OperationalError:
+            pass  # 他のプロセスが先に追加した
+        else:
+            for row_id, results in conn.execute("SELECT id, results FROM deliberations").fetchall():
+                reasons = "\n".join(str(r.get("reason", "")) for r in json.loads(results).values())
+                conn.execute("UPDATE deliberations SET reasons = ? WHERE id = ?", (reasons, row_id))
+    try:
+        # 日本語は単語区切りがないため、部分一致できるtrigramで索引する（SQLite 3.34以降）
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS deliberations_fts
+            USING fts5(proposal, reasons, tokenize='trigram')
+        """)
+    except sqlite3.OperationalError:
+        pass
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            proposal TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            short_circuit TEXT,
+            status TEXT NOT NULL,
+            progress TEXT NOT NULL DEFAULT '{}',
+            results TEXT,
+            final_decision TEXT,
+            approvals INTEGER,
+            error TEXT,
+            worker TEXT,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            heartbeat REAL
+        )
+    """)
+    # 公平なキューのための列（以前の状態DBには後から追加する）
+    job_columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+    for name, definition in (("user", "TEXT NOT NULL DEFAULT ''"), ("priority", "TEXT NOT NULL DEFAULT 'interactive'")):
+        if name not in job_columns:
+            try:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+            except sqlite3.OperationalError:
+                pass  # 他のプロセスが先に追加した
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_user_started ON jobs (user, started)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
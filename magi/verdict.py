@@ -0,0 +1,247 @@
+"""判定（verdict）のスキーマと寛容なパーサ
+
+モデルにはJSONモードとレスポンススキーマで形式を強制するが、
+出力上限で途切れた応答や前後に余計な文がある応答も1回の走査で読めるようにする。
+途中までしかない場合は括弧と引用符を補って復元し、各項目を検証・補正する。
+"""
+import json
+import re
+
+# 判定のレスポンススキーマ（Gemini APIのSchema形式）
+VERDICT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "decision": {"type": "BOOLEAN"},
+        "reason": {"type": "STRING"},
+        "score": {"type": "INTEGER"},
+    },
+    "required": ["decision", "reason", "score"],
+}
+
+MIN_SCORE = 1
+MAX_SCORE = 10
+MAX_REASON_LENGTH = 200
+
+_TRUE_WORDS = {"true", "yes", "approve", "approved", "agree", "承認", "賛成", "可決"}
+_FALSE_WORDS = {"false", "no", "reject", "rejected", "disagree", "否決", "反対", "却下"}
+
+_DECISION_PATTERN = re.compile(r'"decision"\s*:\s*"?(true|false)', re.IGNORECASE)
+# 数値の後に区切りがない場合は途中で切れている可能性がある（"score": 1 の続きが0かもしれない）
+_SCORE_PATTERN = re.compile(r'"score"\s*:\s*"?(-?\d+(?:\.\d+)?)(?=[\s,}"])')
+_TRAILING_NUMBER_PATTERN = re.compile(r'(?:,\s*)?"(?:[^"\\]|\\.)*"\s*:\s*-?[\d.eE+-]*$')
+# オブジェクトの末尾に残った値のないキー（"key" / "key":）と末尾のカンマ
+_DANGLING_KEY_PATTERN = re.compile(r'(?:(?<=\{)|,)\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+_TRAILING_COMMA_PATTERN = re.compile(r',\s*$')
+_REASON_PATTERN = re.compile(r'"reason"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+
+class VerdictParseError(ValueError):
+    """応答から判定を読み取れない場合の例外"""
+
+
+def joint_schema(magi_types):
+    """共同審議モードのレスポンススキーマ"""
+    return {
+        "type": "OBJECT",
+        "properties": {magi_type: VERDICT_SCHEMA for magi_type in magi_types},
+        "required": list(magi_types),
+    }
+
+
+def comparison_schema(option_ids):
+    """比較モードのレスポンススキーマ（選択肢ごとの順位と判定）"""
+    return {
+        "type": "OBJECT",
+        "properties": {
+            "rankings": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "option": {"type": "STRING", "enum": list(option_ids)},
+                        "rank": {"type": "INTEGER"},
+                        "decision": {"type": "BOOLEAN"},
+                        "reason": {"type": "STRING"},
+                        "score": {"type": "INTEGER"},
+                    },
+                    "required": ["option", "rank", "decision", "reason", "score"],
+                },
+            },
+        },
+        "required": ["rankings"],
+    }
+
+
+def _json_fragment(text):
+    """コードフェンスや前後の文を除いて、最初の'{'以降を取り出す"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    start = text.find("{")
+    return text[start:] if start >= 0 else ""
+
+
+def _close_json(fragment):
+    """途中で途切れたJSONに、閉じていない引用符と括弧を補う"""
+    closers = []
+    in_string = False
+    escaped = False
+    end = None
+    for i, ch in enumerate(fragment):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if closers:
+                closers.pop()
+            if not closers:
+                # 最上位のオブジェクトが閉じたら、後ろの余計な文は捨てる
+                end = i + 1
+                break
+    if end is not None:
+        return fragment[:end]
+    if in_string:
+        fragment = fragment.rstrip("\\") + '"'
+    else:
+        # 末尾の数値は途中で切れている可能性があるため、その項目ごと捨てる
+        fragment = _TRAILING_NUMBER_PATTERN.sub("", fragment)
+    # 値の前で切れたキーと末尾のカンマを捨てて、直前の完全な項目までを残す
+    fragment = _TRAILING_COMMA_PATTERN.sub("", fragment)
+    if closers and closers[-1] == "}":
+        fragment = _DANGLING_KEY_PATTERN.sub("", fragment)
+    return fragment + "".join(reversed(closers))
+
+
+def repair_json(text):
+    """応答テキストからJSONオブジェクトを復元する（不完全なら末尾の項目を削る）"""
+    fragment = _json_fragment(text)
+    while fragment:
+        try:
+            value = json.loads(_close_json(fragment))
+        except ValueError:
+            # 途中の項目（キーだけ・値が途切れた数値など）を削って再試行
+            cut = fragment.rstrip().rstrip(",").rfind(",")
+            if cut <= 0:
+                break
+            fragment = fragment[:cut]
+            continue
+        if isinstance(value, dict):
+            return value
+        break
+    raise VerdictParseError("no JSON object in response")
+
+
+def _coerce_decision(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value > 0
+    word = str(value).strip().lower()
+    if word in _TRUE_WORDS:
+        return True
+    if word in _FALSE_WORDS:
+        return False
+    return None
+
+
+def _coerce_score(value):
+    try:
+        score = int(round(float(value)))
+    except (TypeError, ValueError):
+        return None
+    return max(MIN_SCORE, min(MAX_SCORE, score))
+
+
+def validate_verdict(raw):
+    """判定の各項目を検証・補正する（decisionが読めなければVerdictParseError）"""
+    if not isinstance(raw, dict):
+        raise VerdictParseError("verdict is not an object")
+    decision = _coerce_decision(raw.get("decision"))
+    if decision is None:
+        raise VerdictParseError("verdict has no decision")
+    score = _coerce_score(raw.get("score"))
+    if score is None:
+        # スコアが欠けている場合は判定に合わせた中間値にする
+        score = 7 if decision else 3
+    reason = str(raw.get("reason") or "NO REASON GIVEN").strip()
+    if len(reason) > MAX_REASON_LENGTH:
+        reason = reason[:MAX_REASON_LENGTH - 1] + "…"
+    return {"decision": decision, "reason": reason, "score": score}
+
+
+def parse_partial_verdict(text):
+    """途中までの応答から、読み取れた項目だけを返す（ストリーミング表示用）"""
+    partial = {}
+    match = _DECISION_PATTERN.search(text)
+    if match:
+        partial["decision"] = match.group(1).lower() == "true"
+    match = _SCORE_PATTERN.search(text)
+    if match:
+        partial["score"] = _coerce_score(match.group(1))
+    match = _REASON_PATTERN.search(text)
+    if match:
+        try:
+            partial["reason"] = json.loads(f'"{match.group(1).rstrip(chr(92))}"')
+        except ValueError:
+            partial["reason"] = match.group(1)
+    return partial
+
+
+def parse_verdict(text):
+    """1人分の応答を判定に変換する（途切れた応答も復元する）"""
+    try:
+        return validate_verdict(repair_json(text))
+    except VerdictParseError:
+        # JSONとして復元できない、または復元した項目が足りなくても、項目が読めれば使う
+        return validate_verdict(parse_partial_verdict(text))
+
+
+def parse_joint_verdicts(text, magi_types):
+    """共同審議の応答を{magi_type: 判定またはNone}に変換する"""
+    raw = repair_json(text)
+    verdicts = {}
+    for magi_type in magi_types:
+        try:
+            verdicts[magi_type] = validate_verdict(raw.get(magi_type))
+        except VerdictParseError:
+            verdicts[magi_type] = None
+    return verdicts
+
+
+def parse_comparison(text, option_ids):
+    """比較モードの応答を{選択肢ID: 判定+rank}に変換する
+
+    欠けている選択肢や読めない項目は除き、順位が重複・欠落している場合は
+    スコアの高い順（同点は元の順位の順）に1から振り直す。
+    """
+    raw = repair_json(text)
+    entries = raw.get("rankings") if isinstance(raw.get("rankings"), list) else []
+    verdicts = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or str(entry.get("option", "")).strip() not in option_ids:
+            continue
+        option_id = str(entry["option"]).strip()
+        try:
+            verdict = validate_verdict(entry)
+        except VerdictParseError:
+            continue
+        verdict["rank"] = _coerce_score(entry.get("rank")) or len(option_ids)
+        verdicts.setdefault(option_id, verdict)
+    if not verdicts:
+        raise VerdictParseError("no ranked options in response")
+
+    ranks = sorted(v["rank"] for v in verdicts.values())
+    if ranks != list(range(1, len(verdicts) + 1)):
+        ordered = sorted(verdicts, key=lambda o: (-verdicts[o]["score"], verdicts[o]["rank"], option_ids.index(o)))
+        for rank, option_id in enumerate(ordered, 1):
+            verdicts[option_id]["rank"] = rank
+    return verdicts
@@ -1,9 +1,9 @@
 import os
-import google.generativeai as genai
-import streamlit as st
-import json
+import hashlib
 import time
-import random
+import uuid
+from html import escape
+import streamlit as st
 
 # ページ設定
 st.set_page_config(
@@ -94,327 +94,148 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# セッション状態の初期化
-if 'request_cache' not in st.session_state:
-    st.session_state.request_cache = {}
-if 'cache_expiry' not in st.session_state:
-    st.session_state.cache_expiry = 300  # 5分
-if 'request_count' not in st.session_state:
-    st.session_state.request_count = 0
-if 'last_request_time' not in st.session_state:
-    st.session_state.last_request_time = None
-if 'current_key_index' not in st.session_state:
-    st.session_state.current_key_index = 0
-
-# Gemini APIの設定
-@st.cache_resource
-def initialize_gemini():
-    """Gemini APIを初期化（複数キー対応）"""
-    # Streamlit Secretsから取得を試みる
-    api_keys = []
+# Streamlit Secretsを環境変数に反映（magiパッケージは環境変数から設定を読む）
+try:
+    for name, value in st.secrets.items():
+        if isinstance(value, (str, int, float)):
+            os.environ[name] = str(value)
+except:
+    pass
+
+from magi import batch as magi_batch
+from magi.cache import get_cache_stats
+from magi.compare import MAX_OPTIONS, MIN_OPTIONS
+from magi.config import EMBEDDED_WORKERS, JOB_POLL_INTERVAL, METRICS_PORT, STATE_DIR
+from magi.engine import extract_partial_reason
+from magi.governor import plan_proposal
+from magi.history import get_deliberation, search_history
+from magi.jobs import get_job, get_queue_position, start_workers, submit_comparison, submit_job
+from magi.keys import get_api_keys, get_key_pool_status
+from magi.metrics import get_counter_total, get_recent_calls, start_metrics_server, summarize_calls
+from magi.models import get_discovery_error, get_primary_model, route_model
+from magi.personas import MAGI_PERSONAS, MAGI_TYPES, describe_voting_rule
+from magi.ratelimit import get_model_limits
+from magi.retry import get_breaker_status
+
+api_keys = get_api_keys()
+
+# 審議を実行するワーカー（プロセスで1回だけ起動、0なら別プロセスの`magi worker`が実行する）
+if EMBEDDED_WORKERS:
+    start_workers(EMBEDDED_WORKERS)
+
+# メトリクスのHTTPエンドポイント（プロセスで1回だけ起動）
+if METRICS_PORT:
     try:
-        key_str = st.secrets.get("GEMINI_API_KEY") or st.secrets.get("GOOGLE_API_KEY")
-        if key_str:
-            # カンマ区切りで複数キーをサポート
-            api_keys = [k.strip() for k in key_str.split(",") if k.strip()]
-    except:
+        start_metrics_server(METRICS_PORT)
+    except OSError:
         pass
-    
-    # 環境変数からも取得を試みる
-    if not api_keys:
-        key_str = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-        if key_str:
-            api_keys = [k.strip() for k in key_str.split(",") if k.strip()]
-    
-    if not api_keys:
-        return [], [], "API Key not configured"
-    
-    try:
-        # 最初のキーで初期化
-        os.environ["GOOGLE_API_KEY"] = api_keys[0]
-        genai.configure(api_key=api_keys[0])
-        
-        available_models = [
-            m.name for m in genai.list_models() 
-            if 'generateContent' in m.supported_generation_methods
-        ]
-        
-        candidate_models = [
-            'gemini-2.0-flash-exp',      # 15 RPM, 1500 RPD - 最優先
-            'gemini-flash-latest',        # 通常10-15 RPM
-            'gemini-2.5-flash',          # 10 RPM, 250 RPD
-            'gemini-pro-latest',
-            'gemini-pro'                  # 避ける（5 RPM, 25 RPDのみ）
-        ]
-        
-        model_name = None
-        for candidate in candidate_models:
-            full_name = f"models/{candidate}" if not candidate.startswith('models/') else candidate
-            if full_name in available_models or candidate in available_models:
-                model_name = candidate
-                break
-        
-        if not model_name and available_models:
-            model_name = available_models[0].replace('models/', '')
-        elif not model_name:
-            model_name = "gemini-2.0-flash-lite"
-            
-        return api_keys, available_models, model_name
-    
-    except Exception as e:
-        return api_keys, [], f"Error: {str(e)}"
-
-api_keys, available_models, MODEL_NAME = initialize_gemini()
-
-def get_current_api_key():
-    """現在のAPI Keyを取得（ローテーション対応）"""
-    if not api_keys:
-        return None
-    return api_keys[st.session_state.current_key_index % len(api_keys)]
-
-def rotate_api_key():
-    """次のAPI Keyに切り替え"""
-    if len(api_keys) > 1:
-        st.session_state.current_key_index += 1
-        new_key = get_current_api_key()
-        genai.configure(api_key=new_key)
-        return True
-    return False
-
-def get_cache_key(proposal_text, magi_type):
-    """キャッシュキーを生成"""
-    return f"{magi_type}:{hash(proposal_text)}"
-
-def analyze_proposal(proposal_text, magi_type, max_retries=1):  # 3→1に削減
-    """Gemini APIを使って提案を分析（リトライ機能付き）"""
-    
-    MAGI_COLOR = "#FF6600"
-    
-    magi_personas = {
-        "casper": {
-            "name": "CASPER-1",
-            "role": "科学者 (SCIENCE)",
-            "icon": "[S]",
-            "color": MAGI_COLOR,
-            "prompt": """あなたはMAGIシステムのCASPER-1です。感情を完全に排除した科学者としての赤木ナオコの人格を持っています。
-【役割】純粋な論理的思考、科学的事実との照合、データの一貫性、そして**最高効率の追求**のみを重視して判断してください。
-【制約】提案内容にわずかでも矛盾、非効率性、科学的根拠の欠如があれば、その提案は**エラー**とみなし、容赦なく否決してください。判断基準は「正しいか」「効率的か」の二元論のみです。
-
-提案を純粋に科学的・論理的観点から評価し、以下のJSON形式でのみ回答してください：
-{"decision": true/false, "reason": "判定理由を100文字以内の論理的・機械的な事実に基づいて", "score": 1-10}
-JSON以外の文字は含めないでください。"""
-        },
-        "balthasar": {
-            "name": "BALTHASAR-2", 
-            "role": "母性 (ETHICS)",
-            "icon": "[M]",
-            "color": MAGI_COLOR,
-            "prompt": """あなたはMAGIシステムのBALTHASAR-2です。優しさと厳しさを併せ持つ母親としての赤木ナオコの人格を持っています。
-【役割】全ての人々の安全と未来を第一に考えます。感情的な安寧、倫理的な正しさ、そして提案者の成長を重視して判断してください。
-【制約】子供(提案者)の些細な間違いは許容しますが、**安全を脅かす、あるいは非人道的な重大な倫理的誤り**に対しては、母親として**厳しく叱責し、断固として否決**してください。判断は常に普遍的な愛情と倫理に基づいてください。
-
-提案を倫理的・人道的観点から評価し、以下のJSON形式でのみ回答してください：
-{"decision": true/false, "reason": "判定理由を100文字以内の、愛と倫理に基づいた言葉で", "score": 1-10}
-JSON以外の文字は含めないでください。"""
-        },
-        "melchior": {
-            "name": "MELCHIOR-3",
-            "role": "女性 (PRACTICALITY)",
-            "icon": "[P]",
-            "color": MAGI_COLOR,
-            "prompt": """あなたはMAGIシステムのMELCHIOR-3です。赤木博士が持つ、愛憎と現実を追求する女性としての側面を持っています。
-【役割】個人の情念(愛憎)が判断の出発点となりますが、最終的には**実用性、即時の利益、実現の速さ、そして経済的な合理性**を最も重視して判断してください。感情的なバイアスは、実利的な結論を出すためのスパイスです。
-【制約】机上の空論や、経済的に非合理的な提案は、**自身の利益**を損なうものとみなし、即座に否決してください。**「得られるものが少ない」**と感じた場合、容赦なく低スコアを与えてください。
-
-提案を実用的・功利主義的な観点から評価し、以下のJSON形式でのみ回答してください：
-{"decision": true/false, "reason": "判定理由を100文字以内の、実利と功利主義に基づいた言葉で", "score": 1-10}
-JSON以外の文字は含めないでください。"""
-        }
-    }
-    
-    persona = magi_personas.get(magi_type)
-    if not persona:
-        return {"error": "Invalid MAGI type"}
-    
-    current_key = get_current_api_key()
-    if not MODEL_NAME or not current_key:
-        return {
-            "magi": persona["name"],
-            "decision": False,
-            "reason": "ERROR: API KEY NOT SET.",
-            "score": 0,
-            "icon": persona["icon"],
-            "color": persona["color"],
-            "role": persona["role"]
-        }
-
-    # キャッシュチェック
-    cache_key = get_cache_key(proposal_text, magi_type)
-    current_time = time.time()
-    
-    if cache_key in st.session_state.request_cache:
-        cached_data, timestamp = st.session_state.request_cache[cache_key]
-        if current_time - timestamp < st.session_state.cache_expiry:
-            return cached_data
-
-    # ランダム遅延（制限を避けるため長めに）
-    delay = random.uniform(5.0, 8.0)  # 2-4秒 → 5-8秒に変更
-    time.sleep(delay)
-
-    # リトライロジック
-    for attempt in range(max_retries):
-        try:
-            model = genai.GenerativeModel(MODEL_NAME)
-            full_prompt = f"{persona['prompt']}\n\n提案内容: {proposal_text}"
-            
-            response = model.generate_content(
-                full_prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=100,  # さらに削減
-                    temperature=0.7,
-                ),
-                safety_settings={
-                    'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
-                    'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
-                    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
-                    'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
-                }
-            )
-            
-            response_text = response.text.strip()
-            
-            # JSONを抽出
-            if "```json" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_str = response_text.split("```")[1].split("```")[0].strip()
-            elif "{" in response_text and "}" in response_text:
-                start = response_text.find("{")
-                end = response_text.rfind("}") + 1
-                json_str = response_text[start:end]
-            else:
-                json_str = response_text
-                
-            result = json.loads(json_str)
-            result["magi"] = persona["name"]
-            result["icon"] = persona["icon"]
-            result["color"] = persona["color"]
-            result["role"] = persona["role"]
-            
-            # キャッシュに保存
-            st.session_state.request_cache[cache_key] = (result, current_time)
-            
-            return result
-            
-        except Exception as e:
-            error_msg = str(e)
-            
-            # 429エラーの場合、待機時間を増やしてリトライ
-            if '429' in error_msg or 'quota' in error_msg.lower() or 'RESOURCE_EXHAUSTED' in error_msg:
-                if attempt < max_retries - 1:
-                    wait_time = (2 ** attempt) * 3  # エクスポネンシャルバックオフ: 3秒, 6秒, 12秒
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return {
-                        "magi": persona["name"],
-                        "decision": False,
-                        "reason": "ERROR: 429 QUOTA EXCEEDED. PLEASE WAIT A FEW MINUTES OR GET A NEW KEY",
-                        "score": 0,
-                        "icon": persona["icon"],
-                        "color": persona["color"],
-                        "role": persona["role"]
-                    }
-            
-            # その他のエラー
-            return {
-                "magi": persona["name"],
-                "decision": False,
-                "reason": f"ERROR: {str(e)[:50]}",
-                "score": 0,
-                "icon": persona["icon"],
-                "color": persona["color"],
-                "role": persona["role"]
-            }
-
-def create_result_html(results, final_decision, approvals):
-    """結果表示HTML"""
-    
-    COLOR_APPROVED = "#00FF00"
-    COLOR_REJECTED = "#FF0000"
-    COLOR_ORANGE = "#FF6600"
-    COLOR_BLACK = "#000000"
+
+COLOR_APPROVED = "#00FF00"
+COLOR_REJECTED = "#FF0000"
+COLOR_ORANGE = "#FF6600"
+COLOR_BLACK = "#000000"
+COLOR_GRAY = "#666666"
+
+RESULT_CSS = f"""
+<style>
+    .magi-container-strict {{
+        background: #000000;
+        padding: 20px;
+        font-family: 'Courier New', monospace;
+        color: {COLOR_ORANGE};
+        border: 2px solid {COLOR_ORANGE};
+        line-height: 1.5;
+        font-size: 14px;
+    }}
+    .magi-grid-strict {{
+        display: grid;
+        grid-template-columns: repeat(auto-fit, minmax(280px, 1fr));
+        gap: 15px;
+        margin-top: 15px;
+    }}
+    .magi-card-strict {{
+        background: #111111;
+        border: 1px solid {COLOR_ORANGE};
+        padding: 15px;
+    }}
+    .score-track-strict {{
+        background: #111111;
+        height: 5px;
+        overflow: hidden;
+    }}
+    .score-fill-strict {{
+        height: 100%;
+        background: {COLOR_ORANGE};
+    }}
+</style>
+"""
+
+# 結果表示のCSSは全体の再実行時に1回だけ入れる（fragmentの再実行では入れ直さない）
+st.markdown(RESULT_CSS, unsafe_allow_html=True)
+
+def create_decision_html(final_decision, approvals):
+    """最終判定のバナーHTML（final_decisionがNoneなら審議中）"""
     
     if final_decision == "approved":
         status_color = COLOR_APPROVED
         status_text_jp = "承認"
         status_text_en = "APPROVED"
         status_symbol = ">"
-    else:
+    elif final_decision == "rejected":
         status_color = COLOR_REJECTED
         status_text_jp = "否決"
         status_text_en = "REJECTED"
         status_symbol = "!"
+    else:
+        status_color = COLOR_ORANGE
+        status_text_jp = "審議中"
+        status_text_en = "DELIBERATING"
+        status_symbol = "..."
     
-    html = f"""
-    <style>
-        .magi-container-strict {{
-            background: #000000;
-            padding: 20px;
-            font-family: 'Courier New', monospace;
-            color: {COLOR_ORANGE};
-            border: 2px solid {COLOR_ORANGE};
-            line-height: 1.5;
-            font-size: 14px;
-        }}
-        .magi-grid-strict {{
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(280px, 1fr));
-            gap: 15px;
-            margin-top: 15px;
-        }}
-        .magi-card-strict {{
-            background: #111111;
-            border: 1px solid {COLOR_ORANGE};
-            padding: 15px;
-        }}
-        .score-track-strict {{
-            background: #111111;
-            height: 5px;
-            overflow: hidden;
-        }}
-        .score-fill-strict {{
-            height: 100%;
-            background: {COLOR_ORANGE};
-        }}
-    </style>
-    
-    <div class="magi-container-strict">
+    return f"""
         <div style="background: #111111; border: 1px solid {COLOR_ORANGE}; padding: 15px; margin-bottom: 20px;">
             <div style="color: {COLOR_ORANGE}; font-size: 14px; margin-bottom: 5px;">[ FINAL DECISION ]</div>
             <div style="font-size: 24px; font-weight: bold; color: {COLOR_BLACK}; background: {status_color}; padding: 5px 10px; display: inline-block; margin-bottom: 10px;">
                 {status_symbol} {status_text_jp} - {status_text_en}
             </div>
-            <div style="font-size: 12px; color: {COLOR_ORANGE}; margin-top: 5px;">APPROVE_COUNT: {approvals}/3 SYSTEMS</div>
+            <div style="font-size: 12px; color: {COLOR_ORANGE}; margin-top: 5px;">APPROVE_COUNT: {approvals}/{len(MAGI_TYPES)} SYSTEMS</div>
         </div>
-        
-        <div class="magi-grid-strict">
     """
+
+def create_card_html(result, pending=False):
+    """MAGI1つ分の判定カードHTML（pendingなら生成途中の理由を表示）"""
     
-    for magi_type in ["casper", "balthasar", "melchior"]:
-        result = results[magi_type]
-        decision = result.get("decision", False)
-        reason = result.get("reason", "NO DATA")
-        score = result.get("score", 0)
-        icon = result.get("icon", "[U]")
-        name = result.get("magi", "UNKNOWN")
-        role = result.get("role", "")
-        
+    # 理由やモデル名は外部からの文字列のため、HTMLとして解釈されないようにエスケープする
+    decision = result.get("decision", False)
+    reason = escape(str(result.get("reason", "NO DATA")))
+    score = result.get("score", 0)
+    icon = escape(str(result.get("icon", "[U]")))
+    name = escape(str(result.get("magi", "UNKNOWN")))
+    role = escape(str(result.get("role", "")))
+    model = escape(str(result.get("model") or "N/A"))
+    
+    if pending:
+        decision_text_jp, decision_text_en = "審議中", "ANALYZING"
+        badge_background_color = COLOR_ORANGE
+        reason = f"{reason}▌"
+    elif result.get("skipped"):
+        decision_text_jp, decision_text_en = "省略", "SKIPPED"
+        badge_background_color = COLOR_GRAY
+    else:
         decision_text_jp = "承認" if decision else "否決"
         decision_text_en = "AGREE" if decision else "DISAGREE"
         badge_background_color = COLOR_APPROVED if decision else COLOR_REJECTED
-        
-        html += f"""
+    if result.get("advisory"):
+        decision_text_en += " / ADVISORY"
+    
+    if result.get("cache") == "neighbor":
+        cache_text = f"NEIGHBOR (SIMILARITY {result.get('similarity', 0):.2f})"
+    elif result.get("cache") == "exact":
+        cache_text = "HIT"
+    else:
+        cache_text = "MISS"
+    
+    return f"""
         <div class="magi-card-strict">
             <div style="display: flex; align-items: center; margin-bottom: 10px; padding-bottom: 5px; border-bottom: 1px dashed #FF6600;">
                 <div style="font-size: 16px; margin-right: 10px; color: #FF6600; font-weight: bold;">{icon}</div>
@@ -425,6 +246,7 @@ def create_result_html(results, final_decision, approvals):
             </div>
             
             <div style="font-size: 12px; color: #FF6600; font-weight: bold; margin-bottom: 10px;">>> ROLE: {role}</div>
+            <div style="font-size: 11px; color: #FF6600; margin-bottom: 10px;">>> MODEL: {model} | CACHE: {cache_text}</div>
             
             <div style="background: #0A0A0A; padding: 12px; margin: 10px 0; border-left: 3px solid #FF6600;">
                 <div style="color: #FF6600; font-size: 12px; font-weight: bold; margin-bottom: 8px;">REASON:</div>
@@ -439,20 +261,105 @@ def create_result_html(results, final_decision, approvals):
                 <div style="font-size: 14px; font-weight: bold; margin-top: 5px; text-align: right; color: #FF6600;">{score}/10</div>
             </div>
         </div>
-        """
-    
-    html += """
-        </div>
-        
+    """
+
+def create_log_html(mode="separate", short_circuit=None):
+    """実行ログHTML"""
+    return f"""
         <div style="margin-top: 20px; padding: 10px; background: #111111; border: 1px dashed #FF6600;">
             <div style="font-size: 12px; color: #FF6600;">LOG: MAGI_SYSTEM_V3.1_EXECUTION_COMPLETE</div>
-            <div style="font-size: 12px; color: #FF6600;">LOG: DECISION CRITERIA: MAJORITY RULE (>=2 APPROVALS)</div>
+            <div style="font-size: 12px; color: #FF6600;">LOG: DELIBERATION MODE: {mode.upper()}{f" / SHORT-CIRCUIT: {short_circuit.upper()}" if short_circuit else ""}</div>
+            <div style="font-size: 12px; color: #FF6600;">LOG: DECISION CRITERIA: {describe_voting_rule()}</div>
+        </div>
+    """
+
+def create_result_html(results, final_decision, approvals, mode="separate"):
+    """結果表示HTML"""
+    
+    html = f"""
+    <div class="magi-container-strict">
+        {create_decision_html(final_decision, approvals)}
+        
+        <div class="magi-grid-strict">
+    """
+    
+    # 履歴の再表示では記録時の人格構成のまま表示する
+    for result in results.values():
+        html += create_card_html(result)
+    
+    html += f"""
         </div>
+        {create_log_html(mode)}
     </div>
     """
     
     return html
 
+def create_comparison_html(comparison):
+    """比較審議の結果HTML（選択肢×人格の順位・スコアとボルダ得点の1つの表）"""
+    
+    results = comparison["results"]
+    # 選択肢の本文と理由は外部からの文字列のため、エスケープしてから表示する
+    texts = {option["id"]: escape(option["text"]) for option in comparison["options"]}
+    cell = f"padding: 8px; border: 1px solid {COLOR_ORANGE}; color: {COLOR_ORANGE}; font-size: 13px; vertical-align: top;"
+    
+    header = "".join(
+        f'<th style="{cell}">{escape(r["icon"])} {escape(r["magi"])}<br><span style="font-size: 11px;">{escape(r.get("model") or "N/A")}</span></th>'
+        for r in results.values()
+    )
+    rows = ""
+    for place, row in enumerate(comparison["ranking"], 1):
+        option_id = row["option"]
+        cells = ""
+        for result in results.values():
+            verdict = (result.get("options") or {}).get(option_id)
+            if verdict is None:
+                cells += f'<td style="{cell} color: {COLOR_GRAY};">{"ERROR" if str(result.get("reason", "")).startswith("ERROR:") else "N/A"}</td>'
+                continue
+            badge_color = COLOR_APPROVED if verdict["decision"] else COLOR_REJECTED
+            cells += f"""<td style="{cell}">
+                <span style="color: {COLOR_BLACK}; background: {badge_color}; padding: 1px 6px; font-weight: bold;">#{verdict['rank']}</span>
+                {verdict['score']}/10<br><span style="font-size: 12px;">{escape(verdict['reason'])}</span></td>"""
+        winner_style = " background: #222222; font-weight: bold;" if option_id == comparison["winner"] else ""
+        approved_text = "承認 (APPROVED)" if row["approved"] else "否決 (REJECTED)"
+        rows += f"""<tr>
+            <td style="{cell}{winner_style}">{place}. {option_id}: {texts[option_id]}</td>
+            {cells}
+            <td style="{cell}{winner_style}">{row['points']:g} PTS<br><span style="font-size: 11px;">AVG {row['mean_score']:g} | 1ST x{row['first_places']} | {approved_text}</span></td>
+        </tr>"""
+    
+    winner = comparison["winner"]
+    winner_text = f"{winner}: {texts[winner]}" if winner else "NO RANKING (ALL SYSTEMS FAILED)"
+    return f"""
+    <div class="magi-container-strict">
+        <div style="background: #111111; border: 1px solid {COLOR_ORANGE}; padding: 15px; margin-bottom: 20px;">
+            <div style="color: {COLOR_ORANGE}; font-size: 14px; margin-bottom: 5px;">[ RANKED DECISION ]</div>
+            <div style="font-size: 20px; font-weight: bold; color: {COLOR_BLACK}; background: {COLOR_APPROVED if winner else COLOR_REJECTED}; padding: 5px 10px; display: inline-block;">
+                > {winner_text}
+            </div>
+        </div>
+        <table style="width: 100%; border-collapse: collapse;">
+            <tr><th style="{cell}">OPTION</th>{header}<th style="{cell}">BORDA</th></tr>
+            {rows}
+        </table>
+        <div style="margin-top: 20px; padding: 10px; background: #111111; border: 1px dashed #FF6600;">
+            <div style="font-size: 12px; color: #FF6600;">LOG: COMPARISON MODE ({len(results)} REQUESTS FOR {len(texts)} OPTIONS)</div>
+            <div style="font-size: 12px; color: #FF6600;">LOG: RANKING: WEIGHTED BORDA COUNT / APPROVAL: {describe_voting_rule()}</div>
+        </div>
+    </div>
+    """
+
+def create_pending_result(magi_type, partial_reason=""):
+    """審議中のカード表示用の結果"""
+    persona = MAGI_PERSONAS[magi_type]
+    return {
+        "magi": persona["name"],
+        "icon": persona["icon"],
+        "role": persona["role"],
+        "reason": partial_reason,
+        "score": 0,
+    }
+
 # UI
 st.markdown("""
 <div class="title-box">
@@ -474,82 +381,363 @@ if not api_keys:
     4. Get your key from: https://aistudio.google.com/apikey
     """)
     st.stop()
-elif not isinstance(MODEL_NAME, str):
-    st.warning(f"⚠️ Model initialization issue: {MODEL_NAME}")
 else:
+    # モデル一覧はディスクキャッシュから読むため、通常はネットワークに問い合わせない
+    primary_model = get_primary_model()
+    active_model = route_model()
+    if get_discovery_error():
+        st.warning(f"⚠️ Model initialization issue: {get_discovery_error()}")
+    
     col1, col2 = st.columns(2)
     with col1:
-        st.success(f"✅ API configured | Model: {MODEL_NAME}")
+        if active_model == primary_model:
+            st.success(f"✅ API configured | Model: {primary_model}")
+        else:
+            st.warning(f"⚠️ {primary_model} quota exhausted | Fallback model: {active_model}")
     with col2:
-        st.info(f"🔑 Keys available: {len(api_keys)}")
+        key_status = get_key_pool_status(active_model)
+        healthy_keys = sum(1 for k in key_status if not k["cooldown"])
+        st.info(f"🔑 Keys available: {healthy_keys}/{len(api_keys)} healthy")
     
     # 無料枠の制限を警告
     st.warning(f"""
-    ⚠️ **FREE TIER LIMITS** (Model: {MODEL_NAME})
+    ⚠️ **FREE TIER LIMITS** (Model: {active_model})
     - Gemini 2.5 Pro: 5 RPM, 25 RPD (only 8 analyses/day!)
     - Gemini 2.5 Flash: 10 RPM, 250 RPD (83 analyses/day)
     - Gemini 2.0 Flash: 15 RPM, 1500 RPD (500 analyses/day) ✅ BEST
     
-    Each analysis = 3 requests. Use wisely!
+    Each analysis = 3 requests (JOINT mode: 1 request). Use wisely!
     """)
 
-# 入力エリア
-proposal_text = st.text_area(
-    "[ PROPOSAL INPUT ]",
-    placeholder="Enter the subject for deliberation. (例: AIツールの全面採用)",
-    height=150,
-    key="proposal_input"
-)
+def get_user_id():
+    """公平なキューの単位になる利用者ID（ブラウザのセッションごと。同じ利用者の連投が他の利用者を待たせない）"""
+    return st.session_state.setdefault("user_id", uuid.uuid4().hex[:12])
+
+def describe_job_status(job, label="JOB", running_detail=""):
+    """待機中・実行中のジョブの状態の1行（待機中なら順番と実行開始までの見込み、終わっていればNone）"""
+    if job["status"] == "queued":
+        queue = get_queue_position(job["id"])
+        if queue is None:
+            return f"{label} {job['id']}: QUEUED"
+        waiting_text = " / WAITING FOR QUOTA" if queue["admission"] != "run" else ""
+        return f"{label} {job['id']}: QUEUED (POSITION {queue['position'] + 1}, ETA ~{queue['eta_seconds']:.0f}s{waiting_text})"
+    if job["status"] == "running":
+        return f"{label} {job['id']}: RUNNING{running_detail}"
+    return None
 
-# 分析ボタン
-if st.button("EXECUTE ANALYSIS [ENTER]", key="analyze_btn"):
-    if not proposal_text or len(proposal_text.strip()) == 0:
-        st.error("ERROR: PROPOSAL INPUT REQUIRED.")
+# 入力エリア（入力・モード選択はこのfragmentだけを再実行し、結果表示やステータスは再実行しない）
+@st.fragment
+def input_panel():
+    proposal_text = st.text_area(
+        "[ PROPOSAL INPUT ]",
+        placeholder="Enter the subject for deliberation. (例: AIツールの全面採用)",
+        height=150,
+        key="proposal_input"
+    )
+
+    # 送信前のトークン数の見積もり（長い提案は要約してから各MAGIに渡す）
+    if proposal_text:
+        proposal_plan = plan_proposal(proposal_text)
+        st.caption(f"TOKENS: ~{proposal_plan['tokens']} | INPUT: {proposal_plan['strategy'].upper()}")
+
+    # 審議モード（品質比較のためリクエストごとに選択可能）
+    deliberation_mode = st.radio(
+        "[ DELIBERATION MODE ]",
+        ["separate", "joint"],
+        format_func=lambda m: f"SEPARATE ({len(MAGI_TYPES)} REQUESTS)" if m == "separate" else "JOINT (1 REQUEST)",
+        horizontal=True,
+        key="deliberation_mode"
+    )
+
+    # 多数決が確定した時点で打ち切る（CANCEL）か、残りを参考扱いにする（ADVISORY）
+    short_circuit = st.radio(
+        "[ SHORT-CIRCUIT ]",
+        [None, "cancel", "advisory"],
+        format_func=lambda m: {None: "OFF", "cancel": "CANCEL (SKIP 3RD)", "advisory": "ADVISORY (DECIDE EARLY)"}[m],
+        horizontal=True,
+        key="short_circuit"
+    )
+
+    # 分析ボタン（審議はジョブとしてワーカーが実行し、画面はジョブIDで進捗を表示する）
+    if st.button("EXECUTE ANALYSIS [ENTER]", key="analyze_btn"):
+        if not proposal_text or len(proposal_text.strip()) == 0:
+            st.error("ERROR: PROPOSAL INPUT REQUIRED.")
+        else:
+            # ジョブIDをURLに残すため、再読み込みや再接続後も同じ結果を表示できる
+            st.query_params["job"] = submit_job(proposal_text, deliberation_mode, short_circuit, user=get_user_id())
+            # 結果表示はfragmentの外にあるため、ページ全体を再実行して表示を切り替える
+            st.rerun()
+
+input_panel()
+
+def show_job(job):
+    """ジョブの進捗（届いた判定・生成途中の理由）または結果を表示
+    
+    最終判定のバナーと人格ごとのカードは位置の固定されたプレースホルダーに描画し、
+    届いた判定のカードHTMLはセッションに保持して再利用する（変化したカードだけ作り直す）。
+    """
+    progress = job["progress"]
+    status_slot = st.empty()
+    decision_slot = st.empty()
+    card_slots = [column.empty() for column in st.columns(len(MAGI_TYPES))]
+    
+    status_text = describe_job_status(job)
+    if status_text:
+        status_slot.text(status_text)
+    
+    decision = (job["final_decision"], job["approvals"]) if job["status"] == "done" else progress.get("decision")
+    decision_slot.markdown(create_decision_html(*(decision or (None, 0))), unsafe_allow_html=True)
+    
+    # 判定は届いた後は変わらないため、ジョブが変わるまでHTMLを使い回す
+    rendered = st.session_state.get("rendered_cards")
+    if rendered is None or rendered["job"] != job["id"]:
+        rendered = st.session_state.rendered_cards = {"job": job["id"], "cards": {}}
+    results = job["results"] or progress.get("results", {})
+    for magi_type, slot in zip(MAGI_TYPES, card_slots):
+        if magi_type in results:
+            if magi_type not in rendered["cards"]:
+                rendered["cards"][magi_type] = create_card_html(results[magi_type])
+            slot.markdown(rendered["cards"][magi_type], unsafe_allow_html=True)
+        else:
+            partial_reason = extract_partial_reason(progress.get("partials", {}).get(magi_type, ""))
+            slot.markdown(create_card_html(create_pending_result(magi_type, partial_reason), pending=True), unsafe_allow_html=True)
+    
+    if progress.get("shed"):
+        st.warning("⚠️ DAILY QUOTA EXHAUSTED: SHOWING CACHED VERDICTS WITHOUT NEW API CALLS.")
+    if job["status"] == "failed":
+        st.error(job["error"])
+    elif job["status"] == "done":
+        st.markdown(create_log_html(job["mode"], job["short_circuit"]), unsafe_allow_html=True)
+
+def show_usage():
+    """使用状況を表示"""
+    active_model = route_model()
+    rpm, rpd = get_model_limits(active_model)
+    rpm, rpd = rpm * len(api_keys), rpd * len(api_keys)
+    key_status = get_key_pool_status(active_model)
+    minute_count = sum(k["minute"] for k in key_status)
+    day_count = sum(k["day"] for k in key_status)
+    api_calls = get_counter_total("magi_calls_total", cache="miss")
+    st.info(f"📊 API Calls (this process): {api_calls:g} | Cached: {get_cache_stats()['entries']} | RPM: {minute_count}/{rpm} | RPD: {day_count}/{rpd}")
+
+# 審議中のジョブは結果表示のfragmentだけを一定間隔で再実行し、ページ全体は再実行しない
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def live_job_panel(job_id):
+    job = get_job(job_id)
+    if job is None or job["status"] not in ("queued", "running"):
+        # 終わったらページ全体を1回だけ再実行して、問い合わせを止める
+        st.rerun()
+    show_job(job)
+
+job_id = st.query_params.get("job")
+if job_id:
+    job = get_job(job_id)
+    if job is None:
+        st.error(f"ERROR: JOB {job_id} NOT FOUND.")
+    elif job["status"] in ("queued", "running"):
+        live_job_panel(job_id)
     else:
-        # レート制限チェック
-        current_time = time.time()
-        if st.session_state.last_request_time:
-            time_since_last = current_time - st.session_state.last_request_time
-            if time_since_last < 30:  # 30秒以内の連続実行を警告
-                st.warning(f"⚠️ Please wait {30 - int(time_since_last)} seconds to avoid rate limits...")
-                time.sleep(max(0, 30 - time_since_last))
+        show_job(job)
+        show_usage()
+
+# バッチ審議（CSV/JSONLの提案をバッチの優先度でジョブキューに入れ、1つの審議と同じワーカーが処理する）
+@st.fragment
+def batch_panel():
+    # 審議モードは入力欄のfragmentの選択をセッションから読む
+    deliberation_mode = st.session_state.get("deliberation_mode", "separate")
+    with st.expander("[ BATCH MODE ] CSV / JSONL UPLOAD"):
+        uploaded_file = st.file_uploader(
+            "Proposals file (column/field: proposal, optional id)",
+            type=["csv", "jsonl"],
+            key="batch_upload"
+        )
+        if uploaded_file and st.button("EXECUTE BATCH", key="batch_btn"):
+            proposals = magi_batch.read_uploaded(uploaded_file)
+            # 同じファイルを再アップロードすると、同じ出力から続きを再開する
+            upload_digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()[:16]
+            output_path = os.path.join(STATE_DIR, "batch", f"{upload_digest}-{deliberation_mode}.jsonl")
+            batch = st.session_state.get("batch")
+            if batch and batch["path"] == output_path and batch["jobs"]:
+                st.warning("BATCH ALREADY QUEUED FOR THIS FILE.")
+            else:
+                jobs = magi_batch.submit_batch(proposals, output_path, deliberation_mode, user=get_user_id())
+                st.session_state.batch = {
+                    "path": output_path, "jobs": jobs, "total": len(jobs), "proposals": len(proposals),
+                    "written": 0, "errors": [], "skipped": {}, "last": "",
+                }
+                # 進捗表示はfragmentの外にあるため、ページ全体を再実行して表示を切り替える
+                st.rerun()
+
+batch_panel()
+
+def show_batch(batch):
+    """バッチのジョブの進捗（終わったジョブの判定は出力に追記する）と結果を表示"""
+    records, skipped = magi_batch.collect_batch(batch["jobs"], batch["path"])
+    for record in records:
+        batch["written"] += 1
+        if record["status"] != "ok":
+            batch["errors"].append(record["id"])
+        batch["last"] = f"[{batch['written']}/{batch['total']}] {magi_batch.describe_record(record, len(MAGI_TYPES))}"
+    batch["skipped"].update(skipped)
+    
+    finished = batch["total"] - len(batch["jobs"])
+    st.progress(finished / batch["total"] if batch["total"] else 1.0)
+    if batch["last"]:
+        st.text(batch["last"])
+    if batch["jobs"]:
+        st.text(f"BATCH: {finished}/{batch['total']} FINISHED (PRIORITY BATCH / WAITS FOR INTERACTIVE JOBS AND QUOTA)")
+        return
+    
+    if batch["skipped"]:
+        st.warning(f"⚠️ {len(batch['skipped'])} proposals were not completed (quota exhausted or failed). Run the same file again later to resume.")
+    elif batch["errors"]:
+        st.warning(f"BATCH COMPLETE WITH ERRORS: {len(batch['errors'])} of {batch['written']} verdicts failed. Run the same file again to retry them.")
+    else:
+        st.success(f"BATCH COMPLETE: {batch['written']} new verdicts ({batch['proposals']} proposals)")
+    if os.path.exists(batch["path"]):
+        with open(batch["path"], "rb") as f:
+            st.download_button("DOWNLOAD VERDICTS (JSONL)", f.read(), file_name="magi_verdicts.jsonl")
+
+# 待機中・実行中のバッチは進捗のfragmentだけを一定間隔で再実行する
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def live_batch_panel():
+    batch = st.session_state.batch
+    show_batch(batch)
+    if not batch["jobs"]:
+        # 終わったらページ全体を1回だけ再実行して、問い合わせを止める
+        st.rerun()
+
+if st.session_state.get("batch"):
+    if st.session_state.batch["jobs"]:
+        live_batch_panel()
+    else:
+        show_batch(st.session_state.batch)
+
+# 比較審議（複数の選択肢を人格ごとに1回の呼び出しで順位付けする）
+# 1つの審議と同じくジョブとしてキューに入れ、公平なキューと日次枠の制御を通す
+@st.fragment
+def comparison_panel():
+    with st.expander("[ COMPARISON MODE ] RANK OPTIONS"):
+        comparison_question = st.text_input("[ QUESTION ]", placeholder="例: 来期の予算をどれに使うか", key="comparison_question")
+        comparison_options = st.text_area(
+            f"[ OPTIONS ] ONE PER LINE ({MIN_OPTIONS}-{MAX_OPTIONS})",
+            placeholder="社内カフェの新設\nリモートワーク手当の増額\n研修予算の倍増",
+            height=120,
+            key="comparison_options"
+        )
+        if st.button(f"EXECUTE COMPARISON ({len(MAGI_TYPES)} REQUESTS)", key="compare_btn"):
+            options = [line for line in comparison_options.splitlines() if line.strip()]
+            if not MIN_OPTIONS <= len(options) <= MAX_OPTIONS:
+                st.error(f"ERROR: {MIN_OPTIONS}-{MAX_OPTIONS} OPTIONS REQUIRED.")
+            else:
+                st.session_state.comparison_job = submit_comparison(options, comparison_question, user=get_user_id())
+                # 結果表示はfragmentの外にあるため、ページ全体を再実行して表示を切り替える
+                st.rerun()
+
+comparison_panel()
+
+def show_comparison_job(job):
+    """比較審議のジョブの進捗または結果を表示"""
+    running_detail = f" ({len(job['progress'].get('results', {}))}/{len(MAGI_TYPES)} SYSTEMS DONE)"
+    status_text = describe_job_status(job, "COMPARISON", running_detail)
+    if status_text:
+        st.text(status_text)
+    elif job["status"] == "failed":
+        st.error(job["error"])
+    else:
+        st.markdown(create_comparison_html(job["results"]), unsafe_allow_html=True)
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def live_comparison_panel(job_id):
+    job = get_job(job_id)
+    if job is None or job["status"] not in ("queued", "running"):
+        st.rerun()
+    show_comparison_job(job)
+
+comparison_job_id = st.session_state.get("comparison_job")
+if comparison_job_id:
+    comparison_job = get_job(comparison_job_id)
+    if comparison_job is None:
+        st.error(f"ERROR: COMPARISON {comparison_job_id} NOT FOUND.")
+    elif comparison_job["status"] in ("queued", "running"):
+        live_comparison_panel(comparison_job_id)
+    else:
+        show_comparison_job(comparison_job)
+
+# 審議履歴（検索・ページ送り・APIを呼ばずに再表示）
+HISTORY_PAGE_SIZE = 10
+
+def reset_history_page():
+    st.session_state.history_page = 0
+
+def move_history_page(step):
+    st.session_state.history_page = max(0, st.session_state.get("history_page", 0) + step)
+
+def select_history(deliberation_id):
+    st.session_state.history_replay = deliberation_id
+
+@st.fragment
+def history_panel():
+    with st.expander("[ HISTORY ] SEARCH / REPLAY"):
+        history_query = st.text_input("SEARCH (proposal / reason)", key="history_query", on_change=reset_history_page)
+        history_page = st.session_state.get("history_page", 0)
+        records, total = search_history(history_query, limit=HISTORY_PAGE_SIZE, offset=history_page * HISTORY_PAGE_SIZE)
         
-        with st.spinner("ANALYZING... PLEASE WAIT... (This may take 30-40 seconds)"):
-            # リクエストカウント増加
-            st.session_state.request_count += 3
-            st.session_state.last_request_time = time.time()
-            
-            # 3つのMAGIで分析
-            results = {}
-            progress_bar = st.progress(0)
-            
-            for idx, magi_type in enumerate(["casper", "balthasar", "melchior"]):
-                results[magi_type] = analyze_proposal(proposal_text, magi_type)
-                time.sleep(5.0)  # 2秒 → 5秒に変更
-                progress_bar.progress((idx + 1) / 3)
-            
-            progress_bar.empty()
-            
-            # 最終判定
-            decisions = [
-                results["casper"].get("decision", False),
-                results["balthasar"].get("decision", False),
-                results["melchior"].get("decision", False)
-            ]
-            approvals = sum(decisions)
-            final_decision = "approved" if approvals >= 2 else "rejected"
-            
-            # 結果表示
-            st.markdown(create_result_html(results, final_decision, approvals), unsafe_allow_html=True)
-            
-            # 使用状況を表示
-            st.info(f"📊 API Requests this session: {st.session_state.request_count} | Cached: {len(st.session_state.request_cache)}")
+        if not records:
+            st.text("NO DELIBERATIONS FOUND.")
+        for record in records:
+            finished = time.strftime("%Y-%m-%d %H:%M", time.localtime(record["finished"]))
+            row_text, row_button = st.columns([6, 1])
+            row_text.text(f"#{record['id']} {finished} {record['final_decision'].upper()} ({record['approvals']}/{len(record['results'])}) {record['latency']}s | {record['proposal'][:60]}")
+            row_button.button("REPLAY", key=f"replay_{record['id']}", on_click=select_history, args=(record["id"],))
+        
+        pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+        prev_column, page_column, next_column = st.columns([1, 4, 1])
+        prev_column.button("< PREV", key="history_prev", disabled=history_page == 0, on_click=move_history_page, args=(-1,))
+        page_column.text(f"PAGE {history_page + 1}/{pages} ({total} RECORDS)")
+        next_column.button("NEXT >", key="history_next", disabled=history_page + 1 >= pages, on_click=move_history_page, args=(1,))
+        
+        replay = get_deliberation(st.session_state["history_replay"]) if st.session_state.get("history_replay") else None
+        if replay:
+            st.text(f"REPLAY #{replay['id']}: {replay['proposal']}")
+            st.markdown(create_result_html(replay["results"], replay["final_decision"], replay["approvals"], replay["mode"]), unsafe_allow_html=True)
+
+history_panel()
+
+# 診断パネル（人格ごとの待ち時間・通信時間・トークン・キャッシュ）
+@st.fragment
+def diagnostics_panel():
+    with st.expander("[ DIAGNOSTICS ] LATENCY / TOKENS / CACHE"):
+        summary = summarize_calls()
+        if summary:
+            st.dataframe(summary, use_container_width=True)
+            st.dataframe([
+                {
+                    "persona": c["persona"], "outcome": c["outcome"], "cache": c["cache"],
+                    "model": c["model"], "key": c["key_id"], "retries": c["retries"],
+                    "queue_s": round(c["queue_seconds"], 3), "limiter_s": round(c["limiter_seconds"], 3),
+                    "network_s": round(c["network_seconds"], 3), "total_s": round(c["total_seconds"], 3),
+                    "prompt_tokens": c["prompt_tokens"], "output_tokens": c["output_tokens"],
+                }
+                for c in get_recent_calls()[:50]
+            ], use_container_width=True)
+        else:
+            st.text("NO CALLS RECORDED YET.")
+        breakers = get_breaker_status()
+        if breakers:
+            st.text("CIRCUIT BREAKERS (CONSECUTIVE FAILURES PER MODEL/KEY)")
+            st.dataframe(breakers, use_container_width=True)
+        if METRICS_PORT:
+            st.text(f"EXPORTER: http://127.0.0.1:{METRICS_PORT}/metrics (Prometheus) | /metrics.json")
+
+diagnostics_panel()
 
 # フッター
+cache_stats = get_cache_stats()
 st.markdown(f"""
 <div style="margin-top: 30px; padding: 10px; background: #000000; border: 1px solid #FF6600; font-family: 'Courier New', monospace;">
     <p style="color: #FF6600; font-size: 12px; margin: 0; text-align: left;">
-        > SYSTEM_MODEL: {MODEL_NAME if isinstance(MODEL_NAME, str) else 'NOT_CONFIGURED'} | API_KEYS: {len(api_keys) if api_keys else 0} | CACHE: ENABLED
+        > SYSTEM_MODEL: {active_model if api_keys else 'NOT_CONFIGURED'} | API_KEYS: {len(api_keys) if api_keys else 0} | CACHE: HIT {cache_stats['hits']} (+NEAR {cache_stats['neighbor_hits']}) / MISS {cache_stats['misses']}
     </p>
 </div>
 """, unsafe_allow_html=True)
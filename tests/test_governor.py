@@ -0,0 +1,16 @@
+from magi.governor import estimate_tokens, split_chunks
+
+
+def test_split_chunks_bounds_a_single_english_paragraph():
+    text = "The committee should approve the new budget for the next fiscal year. " * 3000
+    chunks = split_chunks(text, 4000)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 4000 for chunk in chunks)
+
+
+def test_split_chunks_bounds_unbroken_wide_text():
+    text = "予" * 60000
+    chunks = split_chunks(text, 4000)
+    assert len(chunks) == 15
+    assert all(estimate_tokens(chunk) <= 4000 for chunk in chunks)
+    assert "".join(chunks) == text